@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import asyncio
+import socket
+import threading
+
+from app.framing import FrameBuffer, FrameError
+from app.metrics import metrics
+from config import Constant
+from log import logger
+
+
+class TransportConn:
+    """
+    @:把asyncio的transport包装成handler使用的socket接口(sendall/writelines/close/getpeername/fileno)
+    @:handler运行在线程池中，sendall在transport写缓冲区超过高水位时阻塞等待drain，
+    @:数据通过call_soon_threadsafe交给事件循环异步写出
+    """
+
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+        self.writable = threading.Event()
+        self.writable.set()
+        self.closed = False
+
+    def sendall(self, data):
+        if not self.writable.wait(Constant.TIME) or self.closed:
+            raise socket.error('连接已关闭或写缓冲区长时间未drain')
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def writelines(self, buffers):
+        """
+        @:与sendall相同，多个缓冲区交给transport.writelines写出
+        """
+        if not self.writable.wait(Constant.TIME) or self.closed:
+            raise socket.error('连接已关闭或写缓冲区长时间未drain')
+        self.loop.call_soon_threadsafe(self._writelines, buffers)
+
+    def _write(self, data):
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def _writelines(self, buffers):
+        if not self.transport.is_closing():
+            self.transport.writelines(buffers)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writable.set()
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+    def getpeername(self):
+        return self.transport.get_extra_info('peername')
+
+    def fileno(self):
+        if self.closed:
+            return -1
+        sock = self.transport.get_extra_info('socket')
+        return sock.fileno() if sock is not None else -1
+
+
+class NullSelector:
+    """
+    @:asyncio引擎下连接不注册在selector中，handler中的sel.unregister(conn)为空操作
+    """
+
+    def unregister(self, conn):
+        pass
+
+
+class MetadataProtocol(asyncio.Protocol):
+    """
+    @:每个连接一个Protocol实例，使用FrameBuffer重组消息帧后交给TcpServer.data_handler，
+    @:业务处理(MySQL、ConfigServer)在TcpServer的线程池中执行，不阻塞事件循环
+    """
+
+    def __init__(self, aio_server):
+        self.aio_server = aio_server
+        self.tcp_server = aio_server.tcp_server
+        self.frame_buffer = FrameBuffer()
+        self.transport = None
+        self.conn = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn = TransportConn(self.aio_server.loop, transport)
+        self.tcp_server.frame_buffers[self.conn] = self.frame_buffer
+        metrics.incr('tcp.accepted')
+        logger.info('Accepted connection from: '
+                    '{}'.format(transport.get_extra_info('peername')))
+
+    def data_received(self, data):
+        self.frame_buffer.feed(data)
+        self.handle_frames()
+
+    def handle_frames(self):
+        """
+        @:依次处理缓冲区中的完整消息帧，下一帧要提交的线程池队列已满时暂停读取该连接
+        """
+        try:
+            while True:
+                kind = self.tcp_server.blocked_on(self.frame_buffer)
+                if kind is not None:
+                    self.transport.pause_reading()
+                    self.tcp_server.paused[self] = kind
+                    metrics.incr('tcp.paused')
+                    metrics.incr('tcp.paused.{}'.format(kind))
+                    break
+                frame = self.frame_buffer.next_frame()
+                if frame is None:
+                    break
+                head_unpack, body = frame
+                logger.info("TcpServer收到的head_unpack:{}".format(head_unpack))
+                logger.info("TcpServer收到的body:{}".format(body))
+                self.tcp_server.data_handler(head_unpack, body, self.conn,
+                                             self.aio_server.sel)
+                if self.conn.closed:
+                    break
+        except FrameError as e:
+            logger.error('TcpServer拆分消息帧出错:{}'.format(e))
+            self.conn.close()
+        except:
+            logger.error('TcpServer数据处理出现错误')
+            self.conn.close()
+
+    def resume(self):
+        """
+        @:线程池队列有空闲后恢复读取，并先处理缓冲区中已收到的消息帧
+        """
+        if self.conn.closed:
+            return
+        self.transport.resume_reading()
+        self.handle_frames()
+
+    def pause_writing(self):
+        self.conn.writable.clear()
+
+    def resume_writing(self):
+        self.conn.writable.set()
+
+    def connection_lost(self, exc):
+        self.conn.closed = True
+        self.conn.writable.set()
+        self.tcp_server.paused.pop(self, None)
+        self.tcp_server.frame_buffers.pop(self.conn, None)
+        logger.info('对端已关闭连接')
+
+
+class AioServer:
+    """
+    @:基于asyncio的服务引擎，在meta.ini的[listening]中配置engine = asyncio启用
+    """
+
+    def __init__(self, loop, tcp_server):
+        self.loop = loop
+        self.tcp_server = tcp_server
+        self.sel = NullSelector()
+
+    def protocol_factory(self):
+        return MetadataProtocol(self)
+
+    def check_paused(self):
+        """
+        @:定时检查被暂停读取的连接，并写运行指标日志
+        """
+        paused = self.tcp_server.paused
+        pools = self.tcp_server.pools
+        for protocol, kind in list(paused.items()):
+            if not pools[kind].full():
+                del paused[protocol]
+                protocol.resume()
+        self.tcp_server.report_stats()
+        self.loop.call_later(Constant.SELECT_TIMEOUT, self.check_paused)
+
+    def serve(self, listener):
+        coro = self.loop.create_server(self.protocol_factory, sock=listener)
+        self.loop.run_until_complete(coro)
+        self.loop.call_later(Constant.SELECT_TIMEOUT, self.check_paused)
+        self.loop.run_forever()
+
+
+def run(listener, tcp_server):
+    """
+    @:asyncio引擎下工作进程的入口
+    """
+    tcp_server.start_pools()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    aio_server = AioServer(loop, tcp_server)
+    aio_server.serve(listener)
@@ -1,19 +1,37 @@
 #!/usr/bin/python3
 # -*- coding=utf-8 -*-
+import base64
+import heapq
+from itertools import islice
 import json
 from operator import itemgetter
 import socket
-import struct
-import time
 
-from sqlalchemy import and_, desc, asc
+from sqlalchemy import and_, or_, desc, asc
 
-from app.configserver import config_server
-from app.models import ClientStatus, MetadataInfo, session_scope
+from app.confcache import conf_cache
+from app.countcache import count_cache
+from app.fanout import fanout
+from app.framing import send_buffers
+from app.metrics import metrics
+from app.models import MetadataInfo, session_scope
+from app.muxconn import remote_pool
+from app.protocol import (HEAD, TASKINFO_FIXED, TASKINFO_SEND, CLIENT_HB,
+                          LOCAL_SRC_ID, MessageBuffer, pack_remote_rows,
+                          unpack_remote_rows)
+from app.writebehind import (client_status_writer, metadata_info_writer,
+                             WriteTicket)
 from config import Config, Constant
 from log import logger
 
 
+# 查询元数据时只取回需要的列，结果为元组，不创建ORM对象
+QUERY_COLUMNS = (MetadataInfo.id, MetadataInfo.site_id, MetadataInfo.app_id,
+                 MetadataInfo.file_name, MetadataInfo.region_id,
+                 MetadataInfo.user_id, MetadataInfo.customer_id,
+                 MetadataInfo.timestamp)
+
+
 class Client:
     
     def __init__(self):
@@ -31,75 +49,39 @@ class Client:
         """
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        offset = head_unpack[12]
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        offset = head_unpack.offset
 
         body_json = json.dumps(body_version)
         body_pack = body_json.encode('utf-8')
 
         total = count = len(body_pack)
         total_size = Constant.HEAD_LENGTH + total
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_HB_RESP
 
         # 生成头部
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence,
                   command,
                   ack_code, total, offset, count]
         logger.info("回复Client心跳消息的head：{}".format(header))
         logger.info("回复Client心跳消息的body：{}".format(body_pack))
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         data = head_pack + body_pack
         return data
     
-    def get_conf1(self, site_id, conf_info):
-        '''
-        @:向ConfigServer查询Client的配置信息
-        @:查询不成功查3次
-        '''
-        logger.info('执行get_conf,向ConfigServer发送查询信息')
-        for i in range(Constant.try_times):
-            logger.info('第{}次发送查询信息'.format(i+1))
-            config_server.send_msg(site_id)
-            key = str(site_id)
-            body_unpack = conf_info.get(key)
-            logger.info("get_conf中的body_unpack:{}".format(body_unpack))
-            if body_unpack:
-                conf_info.pop(key)
-                return body_unpack
-            else:
-                logger.info('延时2秒发送查询请求')
-                time.sleep(2)
-        else:
-            logger.error('查询3次未查到site_id:{}的配置信息'.format(site_id))
-            
     def get_conf(self, site_id, conf_info):
         '''
-        @:向ConfigServer查询Client的配置信息
+        @:查询Client的配置信息，优先使用conf_info中缓存的配置，见app.confcache
         '''
-        logger.info('执行get_conf,向ConfigServer发送查询信息')
-        config_server.send_msg(site_id)
-        try:
-            res = config_server.get_msg()
-            if res:
-                _, body = res
-                try:
-                    body_unpack = json.loads(body.decode('utf-8'))
-                except json.JSONDecodeError:
-                    body_unpack = None
-            else:
-                body_unpack = None
-        except:
-            logger.error('执行get_conf,查询site_id:{}配置失败'.format(site_id))
-        
-        else:
-            logger.info("get_conf中的body_unpack:{}".format(body_unpack))
-            return body_unpack
+        logger.info('执行get_conf,查询site_id:{}的配置信息'.format(site_id))
+        body_unpack = conf_cache.get(site_id, conf_info)
+        logger.info("get_conf中的body_unpack:{}".format(body_unpack))
+        return body_unpack
 
     def handle_hb(self, head_unpack, body, conn, sel, conf_info, version_info):
         """
@@ -110,8 +92,7 @@ class Client:
         """
         logger.info('执行handle_hb，处理Client心跳消息')
         try:
-            fmt_body = '!IQQHHII'
-            body_unpack = struct.unpack(fmt_body, body)
+            body_unpack = CLIENT_HB.unpack(body)
             logger.info("收到Client心跳消息的body:{}".format(body_unpack))
         except:
             logger.error('Client心跳的消息体解析出错。')
@@ -119,15 +100,14 @@ class Client:
             (site_id, client_disk_total, client_disk_free, config_version,
              client_version, transactions_num, timestamp) = body_unpack
 
-            client_status = ClientStatus(site_id=site_id,
-                                         client_disk_total=client_disk_total,
-                                         client_disk_free=client_disk_free,
-                                         config_version=config_version,
-                                         client_version=client_version,
-                                         transactions_num=transactions_num,
-                                         timestamp=timestamp)
-            with session_scope() as session:
-                session.add(client_status)
+            client_status = dict(site_id=site_id,
+                                 client_disk_total=client_disk_total,
+                                 client_disk_free=client_disk_free,
+                                 config_version=config_version,
+                                 client_version=client_version,
+                                 transactions_num=transactions_num,
+                                 timestamp=timestamp)
+            client_status_writer.put(client_status)
 
             if str(site_id) not in version_info:
                 conf_body_unpack = self.get_conf(site_id, conf_info)
@@ -157,7 +137,7 @@ class Client:
             response = self._generate_resp_hb(head_unpack, body_version,
                                               ack_code)
             try:
-                conn.sendall(response)
+                send_buffers(conn, [response])
             except socket.error:
                 sel.unregister(conn)
                 conn.close()
@@ -165,37 +145,16 @@ class Client:
                 sel.unregister(conn)
                 conn.close()
     
-    def select_addr(self, sgw_info, lock):
+    def select_addr(self, sgw_table):
         """
         @:选择一个存储网关地址
-        @:保存sgw信息的数据结构:
-        {group_id1: [disk_free, [[addr1, addr2, ...], region_id, system_id, group_id1]],
-        group_id2: [disk_free, [[addr3, addr4, ...], region_id, system_id, group_id2]],
-        ...}
-        addr = [ip, port, sgw_id]
+        @:存储网关信息保存在共享内存路由表中，读取时不需要IPC和全局锁
+        @:返回：addr, region_id, system_id, group_id；addr = (ip, port, sgw_id)
         """
         logger.info('选择一个存储网关地址')
-        lock.acquire()
-        try:
-            values = sgw_info.values()
-            sgw_disk_free = []
-            sgw_disk_temp = {}    
-            for item in values:
-                sgw_disk_free.append(item[0])
-                sgw_disk_temp[item[0]] = item[1]
-            sgw_disk_free.sort(reverse=True)        # 按降序排列后，选取可用磁盘容量最大的值
-            max_disk_free = sgw_disk_free[0]
-            addr_temp = sgw_disk_temp[max_disk_free][0]
-            addr = addr_temp.popleft()
-            addr_temp.append(addr)
-            region_id = sgw_disk_temp[max_disk_free][1]
-            system_id = sgw_disk_temp[max_disk_free][2]
-            group_id = sgw_disk_temp[max_disk_free][3]
-            return addr, region_id, system_id, group_id
-        finally:
-            lock.release()
+        return sgw_table.select()
         
-    def handle_upload(self, head_unpack, body, conn, sel, sgw_info, lock):
+    def handle_upload(self, head_unpack, body, conn, sel, sgw_table):
         """
         @:处理Client转存路径请求
         (operation, region_id, site_id, app_id, timestamp, sgw_port,
@@ -205,16 +164,15 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_upload,处理Client转存请求')
-        total_size = head_unpack[0]
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        
-        fmt = Constant.FMT_TASKINFO_FIXED
-        body_unpack = struct.unpack(fmt, body[: Constant.TASKINFO_FIXED_LENGTH])
+        total_size = head_unpack.total_size
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
+        
+        body_unpack = TASKINFO_FIXED.unpack_from(body)
         metadata_pack = body[Constant.TASKINFO_FIXED_LENGTH:]
         metadata_unpack = json.loads(metadata_pack.decode('utf-8'))
 #         (operation, region_id, site_id, app_id, timestamp, sgw_port,
@@ -229,70 +187,76 @@ class Client:
         file_name = body_unpack[13]
         metadata_len = body_unpack[14]
         
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         user_id = metadata_unpack.get('user_id')
         customer_id = metadata_unpack.get('customer_id')
         command = Constant.CLIENT_UPLOAD_ROUTE_RESP
         
-        values = sgw_info.values()
-        if not sgw_info or not values:
+        if not sgw_table:
             logger.error('sgw还没有发心跳消息注册')
-            ack_code = Constant.ACK_CLIENT_UPLOAD_ROUTE_NOTFOUND 
+            ack_code = Constant.ACK_CLIENT_UPLOAD_ROUTE_NOTFOUND
+            addr, region_id, system_id, group_id = ((0, 0, 0), Config.region_id,
+                                                    Config.system_id, 0)
         else:
             ack_code = Constant.ACK_CLIENT_UPLOAD_ROUTE
-            
-        addr, region_id, system_id, group_id = self.select_addr(sgw_info, lock)
+            addr, region_id, system_id, group_id = self.select_addr(sgw_table)
         sgw_ip = proxy_ip = addr[0]
         sgw_port = proxy_port = addr[1]
         sgw_id = proxy_id = addr[2]
         logger.info("处理Client转存请求,选择的地址为：{}".format(addr))
         
+        if ack_code == Constant.ACK_CLIENT_UPLOAD_ROUTE:
+            # 元数据交给批量写入队列，ack_mode为commit时等待写入数据库后再回复
+            metadata_row = dict(site_id=site_id,
+                                app_id=app_id,
+                                file_name=file_name,
+                                region_id=region_id,
+                                system_id=system_id,
+                                group_id=group_id,
+                                user_id=user_id,
+                                customer_id=customer_id,
+                                timestamp=timestamp)
+            if Config.upload_ack_mode == 'commit':
+                ticket = WriteTicket()
+                metadata_info_writer.put(metadata_row, ticket)
+                # 超时后撤回该行，回复失败时保证元数据没有写入，Client重试不会产生重复记录
+                if (not ticket.wait(Constant.TIME) and
+                        metadata_info_writer.withdraw(ticket)):
+                    logger.error('转存请求的元数据写入数据库失败')
+                    ack_code = Constant.ACK_CLIENT_UPLOAD_ROUTE_FAILED
+            elif not metadata_info_writer.put(metadata_row):
+                logger.error('元数据写入队列已满，转存请求的元数据被丢弃')
+                ack_code = Constant.ACK_CLIENT_UPLOAD_ROUTE_FAILED
+        
         # 构造响应消息头
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
         
         # 构造消息体
-        fmt_body = Constant.FMT_TASKINFO_FIXED
         body_resp = [operation, region_id, site_id, app_id, timestamp, sgw_port,
                      proxy_port, sgw_ip, proxy_ip, sgw_id, proxy_id, file_len,
                      file_md5, file_name, metadata_len]
-        body_pack = struct.pack(fmt_body, *body_resp)
+        message = MessageBuffer(TASKINFO_FIXED.size + len(metadata_pack))
+        message.pack(TASKINFO_FIXED, *body_resp)
+        message.write(metadata_pack)
         logger.info("处理Client转存请求，回复的head为：{}".format(header))
         logger.info("处理Client转存请求，回复的body为：{}".format(body_resp))
         logger.info("处理Client转存请求，回复的metadata为：{}".format(metadata_unpack))
-        data = head_pack + body_pack + metadata_pack
+        data = message.finish(*header[1:])
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
         
-#         metadata_internal = (site_id, app_id, file_name, region_id, system_id,
-#                              group_id, user_id, customer_id, timestamp)
-        metadata_info = MetadataInfo(site_id=site_id,
-                                     app_id=app_id,
-                                     file_name=file_name,
-                                     region_id=region_id,
-                                     system_id=system_id,
-                                     group_id=group_id,
-                                     user_id=user_id,
-                                     customer_id=customer_id,
-                                     timestamp=timestamp)
-#         sql_queue.put_nowait(metadata_info)
-        with session_scope() as session:
-            session.add(metadata_info)
-        
     def handle_upload_success(self, body, metadata_info):
         """
         @:在处理上传请求时，由于还没有确认文件是否上传成功，那时还没有将元数据写入数据库，构造出以file_md5为键，
         @:以要存入数据库的的元数据信息为值的全局域字典。在获得上传成功的命令字后，再写入数据库。
         """
-        fmt = Constant.FMT_TASKINFO_FIXED
-        bodypack = struct.unpack(fmt, body[: Constant.TASKINFO_FIXED_LENGTH])
+        bodypack = TASKINFO_FIXED.unpack_from(body)
         file_md5 = bodypack[10]
         try:
             metadata_internal = metadata_info.get(file_md5)
@@ -308,8 +272,9 @@ class Client:
                                         user_id=metadata_internal[6],
                                         customer_id=metadata_internal[7],
                                         timestamp=metadata_internal[8])
-            with session_scope() as session:
+            with session_scope(site_id=metadata_internal[0]) as session:
                 session.add(metadata_sql)
+            count_cache.invalidate([metadata_internal[0]])
             
             metadata_info.pop(file_md5)
             
@@ -338,12 +303,12 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_query_num,处理Client查询记录数量的请求')
-        total_size = head_unpack[0]
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        total_size = head_unpack.total_size
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        offset = head_unpack.offset
+        count = head_unpack.count
         
         local_res = self._get_local_query_num(body)
         logger.info("在本地查询到的记录数量为：{}".format(local_res))
@@ -355,37 +320,31 @@ class Client:
         if query_body_unpack:
             site_region_id = query_body_unpack.get(str(site_id))
             if site_region_id:
-                for region_id in site_region_id:
-                    remote_metadata_info = query_body_unpack.get(region_id)
-                    logger.info("remote_metadata_info"
-                                ":{}".format(remote_metadata_info))
-                    meta_ip = str(remote_metadata_info[1])
-                    meta_port = int(remote_metadata_info[2])
-                    meta_src_id = remote_metadata_info[3]
-                    addr = (meta_ip, meta_port)
-                    sock = self._generate_meta_sock(addr)
-                    self._send_query_num(head_unpack, body, sock, meta_src_id)
-                    num = self._parse_remote_query_num(sock)
-                    remote_res += num
+                results = fanout.run({
+                    region_id: (self._remote_request,
+                                (query_body_unpack.get(region_id),
+                                 self._generate_query_num, head_unpack, body))
+                    for region_id in site_region_id})
+                for remote_head_unpack, _ in results.values():
+                    remote_res += remote_head_unpack.total
         else:
             logger.error('经过{}次查询未查询到配置信息'.format(Constant.try_times))
         total = remote_res + local_res
         logger.info("在远端查询到的记录数量为：{}".format(remote_res))
         logger.info("查询到的记录数量总共为：{}".format(total))
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_QUERY_NUM_RESP
         ack_code = Constant.ACK_CLIENT_QUERY_NUM
         
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理Client查询记录数量的请求，回复的head为：{}".format(header))
         data = head_pack + body
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -412,31 +371,30 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_file_query_num,处理Fileportal查询记录数量的请求')
-        total_size = head_unpack[0]
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        total_size = head_unpack.total_size
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        offset = head_unpack.offset
+        count = head_unpack.count
         
         local_res = self._get_local_file_query_num(body)
         total = local_res
         logger.info("在本地查询到的记录数量为：{}".format(local_res))
         
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.FILE_QUERY_NUM_RESP
         ack_code = Constant.ACK_CLIENT_QUERY_NUM
         
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理Fileportal查询记录数量的请求，回复的head为：{}".format(header))
         data = head_pack + body
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -444,7 +402,7 @@ class Client:
             sel.unregister(conn)
             conn.close()
         
-    def handle_query_data(self, head_unpack, body, conn, sel, sgw_info, lock,
+    def handle_query_data(self, head_unpack, body, conn, sel, sgw_table,
                           conf_info):
         """
         @:查询元数据信息
@@ -452,9 +410,9 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_query_data,处理Client查询元数据信息的请求')
-        client_src_id = head_unpack[5]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        client_src_id = head_unpack.src_id
+        offset = head_unpack.offset
+        count = head_unpack.count
         site_id = client_src_id
         
         body_unpack = json.loads(body.decode('utf-8'))
@@ -463,35 +421,91 @@ class Client:
         
         query_body_unpack = self.get_conf(site_id, conf_info)
         logger.info("向ConfigServer查询到的信息为：{}".format(query_body_unpack))
-        if query_body_unpack:
+        if 'cursor' in body_unpack:
+            self.handle_query_data_cursor(head_unpack, body_unpack, conn, sel,
+                                          sgw_table, query_body_unpack)
+        elif query_body_unpack:
             site_region_id = query_body_unpack.get(str(site_id))
             if site_region_id:
-                local_ret = self._get_local_query_data(head_unpack, body,
-                                                       sgw_info, lock)
-                for region_id in site_region_id:
-                    remote_metadata_info = query_body_unpack.get(region_id)
-                    meta_ip = str(remote_metadata_info[1])
-                    meta_port = int(remote_metadata_info[2])
-                    meta_src_id = remote_metadata_info[3]
-                    addr = (meta_ip, meta_port)
-                    sock = self._generate_meta_sock(addr)
-                    self._send_query_data(head_unpack, body, sock, meta_src_id)
-                    meta_body = self.recv_remote_msg(sock)[1]
-                    meta_body_unpack = json.loads(meta_body.decode('utf-8'))
-                    remote_ret = meta_body_unpack.get('site_id')
-                    local_ret.extend(remote_ret)
-                local_tmp = sorted(local_ret, key=itemgetter(*order_by),
-                                   reverse=desc_key)
-                rets = local_tmp[offset: offset + count]
-                self.proxy_query_data(head_unpack, rets, conn, sel, sgw_info, lock)
+                pending = fanout.submit({
+                    region_id: (self._remote_request,
+                                (query_body_unpack.get(region_id),
+                                 self._generate_query_data, head_unpack, body))
+                    for region_id in site_region_id})
+                region_rets = [self._get_local_query_data(head_unpack, body,
+                                                          sgw_table)]
+                for remote_head_unpack, meta_body in fanout.collect(
+                        pending).values():
+                    region_rets.append(self._parse_remote_rows(
+                        remote_head_unpack, meta_body))
+                rets = list(islice(self._merge_regions(region_rets, order_by,
+                                                       desc_key),
+                                   offset, offset + count))
+                self.proxy_query_data(head_unpack, rets, conn, sel, sgw_table,
+                                      stream=body_unpack.get('stream'))
             else:
                 self.handle_local_query_data(head_unpack, body, conn, sel,
-                                             sgw_info, lock)
+                                             sgw_table)
         else:
             self.handle_local_query_data(head_unpack, body, conn, sel,
-                                         sgw_info, lock)
+                                         sgw_table)
             
-    def handle_file_query_data(self, head_unpack, body, conn, sel, sgw_info, lock):
+    def handle_query_data_cursor(self, head_unpack, body_unpack, conn, sel,
+                                 sgw_table, query_body_unpack):
+        """
+        @:游标分页查询元数据信息，请求中带有"cursor"时使用，第一页的cursor为null
+        @:每个region从游标中记录的该region上一页最后一条记录之后取count条，合并排序后取前count条，
+        @:下一页的游标放在最后一条记录metadata的"next_cursor"中，没有更多数据时为null
+        @:翻到第n页与第1页的代价相同，请求头中的offset不再使用
+        """
+        logger.info('执行handle_query_data_cursor,游标分页处理Client查询元数据信息的请求')
+        site_id = head_unpack.src_id
+        count = head_unpack.count
+        order_by = body_unpack.get('order_by')
+        desc_key = body_unpack.get('desc')
+        positions = self._decode_cursor(body_unpack.pop('cursor'), order_by,
+                                        desc_key)
+        
+        local_region = str(Config.region_id)
+        site_region_id = []
+        if query_body_unpack:
+            site_region_id = query_body_unpack.get(str(site_id)) or []
+        
+        requests = {}
+        for region_id in [local_region] + site_region_id:
+            body_unpack['after'] = positions.get(region_id)
+            region_body = json.dumps(body_unpack).encode('utf-8')
+            region_head = head_unpack._replace(
+                total_size=Constant.HEAD_LENGTH + len(region_body))
+            requests[region_id] = (region_head, region_body)
+        
+        local_head, local_body = requests.pop(local_region)
+        pending = fanout.submit({
+            region_id: (self._remote_request,
+                        (query_body_unpack.get(region_id),
+                         self._generate_query_data, region_head, region_body))
+            for region_id, (region_head, region_body) in requests.items()})
+        region_rets = {local_region: self._get_local_query_data(
+            local_head, local_body, sgw_table)}
+        for region_id, (remote_head_unpack, meta_body) in fanout.collect(
+                pending).items():
+            region_rets[region_id] = self._parse_remote_rows(
+                remote_head_unpack, meta_body)
+        
+        rets = list(islice(self._merge_regions(
+            [self._tag_region(region_id, region_ret)
+             for region_id, region_ret in region_rets.items()],
+            order_by, desc_key), count))
+        merge_key = self._merge_key(order_by)
+        for ret in rets:
+            positions[ret['cursor_region']] = list(merge_key(ret))
+        next_cursor = None
+        if rets and len(rets) == count:
+            next_cursor = self._encode_cursor(order_by, desc_key, positions)
+        self.proxy_query_data(head_unpack, rets, conn, sel, sgw_table,
+                              next_cursor, body_unpack.get('stream'))
+        
+    def handle_file_query_data(self, head_unpack, body, conn, sel, sgw_table):
         """
         @:查询元数据信息
         """
@@ -499,335 +513,123 @@ class Client:
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_file_query_data,处理Fileportal查询元数据信息的请求')
         self.handle_local_file_query_data(head_unpack, body, conn, sel,
-                                          sgw_info, lock)
+                                          sgw_table)
         
-    def proxy_query_data(self, head_unpack, rets, conn, sel, sgw_info, lock):
+    def proxy_query_data(self, head_unpack, rets, conn, sel, sgw_table,
+                         next_cursor=None, stream=False):
         """
         @:代理查询功能
-        """
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        @:游标分页时next_cursor放在最后一条记录的metadata中
+        @:stream为True时分多帧发送，见_stream_query_rows
+        """
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
 
-        addr = self.select_addr(sgw_info, lock)[0]
-        sgw_ip = addr[0]
-        sgw_port = addr[1]
-        sgw_id = addr[2]
-        
-        fmt_body = Constant.FMT_TASKINFO_SEND
-        body_tmp = []
-        for ret in rets:
-            site_id_tmp = ret.get('site_id')
-            app_id_tmp = ret.get('app_id')
-            file_name_tmp = ret.get('file_name')
-            region_id_tmp = ret.get('region_id')
-            user_id_tmp = ret.get('user_id')
-            customer_id_tmp = ret.get('customer_id')
-            timestamp_tmp = ret.get('timestamp')
-            sgw_ip_tmp = ret.get('sgw_ip')
-            sgw_port_tmp = ret.get('sgw_port')
-            sgw_id_tmp = ret.get('sgw_id')
-            proxy_ip_tmp = sgw_ip
-            proxy_port_tmp = sgw_port
-            proxy_id_tmp = sgw_id
-            file_name = file_name_tmp.encode('utf-8')
-            
-            metadata = {}
-            metadata['user_id'] = user_id_tmp
-            metadata['customer_id'] = customer_id_tmp
-            metadata_json = json.dumps(metadata)
-            metadata_pack = metadata_json.encode('utf-8')
-            metadata_len = len(metadata_pack)
-            
-            body_proxy = [region_id_tmp, site_id_tmp, app_id_tmp, timestamp_tmp,
-                          sgw_port_tmp, proxy_port_tmp, sgw_ip_tmp,
-                          proxy_ip_tmp, sgw_id_tmp, proxy_id_tmp, file_name,
-                          metadata_len]
-            body_pack = struct.pack(fmt_body, *body_proxy)
-            body_tmp.append(body_pack + metadata_pack)
-        body_query = b''.join(body_tmp)
-        body_size = len(body_query)
-        
-        total_size = Constant.HEAD_LENGTH + body_size
-        src_id = int(Config.src_id, 16)
-        dst_id = client_src_id
+        addr = self.select_addr(sgw_table)[0]
         command = Constant.CLIENT_QUERY_DATA_RESP
-        ack_code = Constant.ACK_CLIENT_QUERY_DATA
-         
-        # 构造消息头部
-        fmt_head = Constant.FMT_COMMON_HEAD
-        header = [total_size, self.major, self.minor, self.src_type,
-                  self.dst_type, src_id, dst_id, trans_id, sequence, command,
-                  ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
-        logger.info("处理Client查询元数据信息的请求，回复的head为：{}".format(header))
-        data = head_pack + body_query
         try:
-            conn.sendall(data)
+            if stream:
+                self._stream_query_rows(
+                    head_unpack, rets, conn, command,
+                    lambda chunk, final: self._pack_query_dicts(
+                        chunk, addr, next_cursor if final else None))
+                return
+            buffers = self._pack_query_dicts(rets, addr, next_cursor)
+            body_size = sum(len(buf) for buf in buffers)
+            
+            total_size = Constant.HEAD_LENGTH + body_size
+            src_id = LOCAL_SRC_ID
+            dst_id = client_src_id
+            ack_code = Constant.ACK_CLIENT_QUERY_DATA
+            
+            # 构造消息头部
+            header = [total_size, self.major, self.minor, self.src_type,
+                      self.dst_type, src_id, dst_id, trans_id, sequence,
+                      command, ack_code, total, offset, count]
+            logger.info("处理Client查询元数据信息的请求，回复的head为：{}".format(header))
+            send_buffers(conn, [HEAD.pack(*header)] + buffers)
         except socket.error:
             sel.unregister(conn)
             conn.close()
-            
-    def handle_query_data1(self, head_unpack, body, conn, sgw_info, lock,
-                          conf_info):
+    
+    def _pack_query_dicts(self, rets, addr, next_cursor=None):
         """
-        @:查询元数据信息
+        @:把合并后的查询结果(字典)打包为FMT_TASKINFO_SEND + metadata的缓冲区列表
+        @:proxy_ip/proxy_port/proxy_id为本地选择的网关地址
         """
-#         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
-#          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
-        client_src_id = head_unpack[5]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        site_id = client_src_id
-        
-        body_unpack = json.loads(body.decode('utf-8'))
-        order_by = body_unpack.get('order_by')
-        desc_key = body_unpack.get('desc')
-         
-        query_body_unpack = self.get_conf(site_id, conf_info)
-        logger.info("向ConfigServer查询到的信息为：{}".format(query_body_unpack))
-        
-        n = int(offset/count) + 1
-        if query_body_unpack:
-            site_region_id = query_body_unpack.get(str(site_id))
-            if site_region_id:
-                if n <= 10:
-                    self.handle_query_data(head_unpack, body, conn, sgw_info,
-                                           lock, conf_info)
-                else:    
-                    offset_local = 0
-                    local_ret = self._get_local_query_data1(body, sgw_info, lock,
-                                                            offset_local, count)
-                    local_remote_dict = {}
-                    local_remote_dict['region_id'] = local_ret
-                    sock_dict = {}
-                    for region_id in site_region_id:
-                        remote_metadata_info = query_body_unpack.get(region_id)
-                        meta_ip = str(remote_metadata_info[1])
-                        meta_port = int(remote_metadata_info[2])
-                        meta_src_id = remote_metadata_info[3]
-                        addr = (meta_ip, meta_port)
-                        sock = self._generate_meta_sock(addr)
-                        sock_dict[region_id] = sock
-                        offset_remote = 0
-                        self._send_query_data1(head_unpack, body, sock, meta_src_id,
-                                              offset_remote, count)
-                        meta_body = self.recv_remote_msg(sock)[1]
-                        meta_body_unpack = json.loads(meta_body.decode('utf-8'))
-                        remote_ret = meta_body_unpack.get('site_id')
-                        local_remote_dict[region_id] = remote_ret
-                        local_ret.extend(remote_ret)
-                    local_tmp = sorted(local_ret, key=itemgetter(*order_by),
-                                       reverse=desc_key)
-                    ret_tmp = local_tmp[: count]
-                    ret_tmp_set = set(ret_tmp)
-                    
-                    local_region_id = local_remote_dict.get('region_id')
-                    local_region_id_set = set(local_region_id)
-                    local_intersection_set = local_region_id_set.intersection(ret_tmp_set)
-                    local_intersection_list = list(local_intersection_set)
-                    local_num = len(local_intersection_list)
-                    for local_item in local_intersection_list:
-                        local_tmp.remove(local_item)
-                        local_region_id.remove(local_item)
-                    offset_local = offset_local + count
-                    local_ret1 = self._get_local_query_data1(body, sgw_info, lock,
-                                                            offset_local, local_num)    
-                    local_tmp.extend(local_ret1)
-                    local_region_id.extend(local_ret1)
-                    local_remote_dict['region_id'] = local_region_id
-                    
-                    for region_id in site_region_id:
-                        remote_region_id = local_remote_dict.get(region_id)
-                        remote_region_id_set = set(remote_region_id)
-                        remote_intersection_set = remote_region_id_set.intersection(ret_tmp_set)
-                        remote_intersection_list = list(remote_intersection_set)
-                        remote_num = len(remote_intersection_list)
-                        for remote_item in remote_intersection_list:
-                            local_tmp.remove(remote_item)
-                            remote_region_id.remove(remote_item)
-                            
-                        remote_metadata_info = query_body_unpack.get(region_id)
-                        meta_src_id = remote_metadata_info[3]   
-                        sock = sock_dict.get(region_id)
-                        
-                        offset_remote = offset_remote + count
-                        self._send_query_data1(head_unpack, body, sock, meta_src_id,
-                                              offset_remote, remote_num)
-                        meta_body = self.recv_remote_msg(sock)[1]
-                        meta_body_unpack = json.loads(meta_body.decode('utf-8'))
-                        remote_ret1 = meta_body_unpack.get('site_id')
-                        local_tmp.extend(remote_ret1)
-                        remote_region_id.extend(remote_ret1)
-                        local_remote_dict[region_id] = remote_ret1
-                    
-                    local_tmp.sort(key=itemgetter(*order_by), reverse=desc_key)
-                    ret_tmp1 = local_tmp[: count]
-                    ret_tmp_set1 = set(ret_tmp1)
-                    
-                    for _ in range(n-1):
-                        local_region_id1 = local_remote_dict.get('region_id')
-                        local_region_id_set1 = set(local_region_id1)
-                        local_intersection_set1 = local_region_id_set1.intersection(ret_tmp_set1)
-                        local_intersection_list1 = list(local_intersection_set1)
-                        local_num1 = len(local_intersection_list1)
-                        for local_item1 in local_intersection_list1:
-                            local_tmp.remove(local_item1)
-                            local_region_id1.remove(local_item1)
-                        offset_local = offset_local + local_num1
-                        local_ret2 = self._get_local_query_data1(body, sgw_info, lock,
-                                                                offset_local, local_num1)    
-                        local_tmp.extend(local_ret2)
-                        local_region_id1.extend(local_ret2)
-                        local_remote_dict['region_id'] = local_region_id1
-                        
-                        for region_id in site_region_id:
-                            remote_region_id1 = local_remote_dict.get(region_id)
-                            remote_region_id_set1 = set(remote_region_id1)
-                            remote_intersection_set1 = remote_region_id_set1.intersection(ret_tmp_set1)
-                            remote_intersection_list1 = list(remote_intersection_set1)
-                            remote_num1 = len(remote_intersection_list1)
-                            for remote_item1 in remote_intersection_list1:
-                                local_tmp.remove(remote_item1)
-                                remote_region_id1.remove(remote_item1)
-                                
-                            remote_metadata_info = query_body_unpack.get(region_id)
-                            meta_src_id = remote_metadata_info[3]   
-                            sock = sock_dict.get(region_id)
-                            
-                            offset_remote = offset_remote + remote_num1
-                            self._send_query_data1(head_unpack, body, sock, meta_src_id,
-                                                  offset_remote, remote_num1)
-                            meta_body = self.recv_remote_msg(sock)[1]
-                            meta_body_unpack = json.loads(meta_body.decode('utf-8'))
-                            remote_ret2 = meta_body_unpack.get('site_id')
-                            local_tmp.extend(remote_ret2)
-                            remote_region_id1.extend(remote_ret2)
-                            local_remote_dict[region_id] = remote_ret2
-                        
-                        local_tmp.sort(key=itemgetter(*order_by), reverse=desc_key)
-                        ret_tmp1 = local_tmp[: count]
-                        ret_tmp_set1 = set(ret_tmp1)
-                        
-                    local_tmp.sort(key=itemgetter(*order_by), reverse=desc_key)
-                    rets = local_tmp[: count]
-                    self.proxy_query_data(head_unpack, rets, conn, sgw_info, lock)
-            else:
-                self.handle_local_query_data(head_unpack, body, conn, sgw_info, lock)
-        else:
-            self.handle_local_query_data(head_unpack, body, conn, sgw_info, lock)
+        proxy_ip, proxy_port, proxy_id = addr
+        size = TASKINFO_SEND.size
+        fixed = bytearray(size * len(rets))
+        view = memoryview(fixed)
+        buffers = []
+        for i, ret in enumerate(rets):
+            metadata = {}
+            metadata['user_id'] = ret.get('user_id')
+            metadata['customer_id'] = ret.get('customer_id')
+            if next_cursor and i == len(rets) - 1:
+                metadata['next_cursor'] = next_cursor
+            metadata_pack = json.dumps(metadata).encode('utf-8')
             
-    def _get_local_query_data1(self, body, sgw_info, lock, offset, count):
-        """
-        :MetadataServer收到查询请求后进行本地查询
-        """
-        body_unpack = json.loads(body.decode('utf-8'))
-        site_id = body_unpack.get('site_id')[0]
-        app_id = body_unpack.get('app_id')
-        user_id = body_unpack.get('user_id')
-        customer_id = body_unpack.get('customer_id')
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
-        order_by = body_unpack.get('order_by')
-        desc_key = body_unpack.get('desc')
-         
-        addr = self.select_addr(sgw_info, lock)[0]
-        sgw_ip = proxy_ip = addr[0]
-        sgw_port = proxy_port = addr[1]
-        sgw_id = proxy_id = addr[2]
-         
-        local_metadata = []
-        with session_scope() as session:
-            query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.app_id.in_(app_id),
-                                     MetadataInfo.user_id.in_(user_id),
-                                     MetadataInfo.customer_id.in_(customer_id),
-                                     MetadataInfo.timestamp.between(start, end)))
-            if not desc_key:
-                for key in order_by:
-                    ret = filt_ret.order_by(asc(key)).all()
-            else:
-                for key in order_by:
-                    ret = filt_ret.order_by(desc(key)).all()
-             
-            for metadata_info in ret[offset: offset + count]:
-                site_id_tmp = metadata_info.site_id
-                app_id_tmp = metadata_info.app_id
-                file_name = metadata_info.file_name
-                region_id = metadata_info.region_id
-                user_id_tmp = metadata_info.user_id
-                customer_id_tmp = metadata_info.customer_id
-                timestamp_tmp = metadata_info.timestamp
-                 
-                tmp_dict = {}
-                tmp_dict['site_id'] = site_id_tmp
-                tmp_dict['app_id'] = app_id_tmp
-                tmp_dict['file_name'] = file_name
-                tmp_dict['region_id'] = region_id
-                tmp_dict['user_id'] = user_id_tmp
-                tmp_dict['customer_id'] = customer_id_tmp
-                tmp_dict['timestamp'] = timestamp_tmp
-                tmp_dict['sgw_ip'] = sgw_ip
-                tmp_dict['proxy_ip'] = proxy_ip
-                tmp_dict['sgw_port'] = sgw_port
-                tmp_dict['proxy_port'] = proxy_port
-                tmp_dict['sgw_id'] = sgw_id
-                tmp_dict['proxy_id'] = proxy_id
-                local_metadata.append(tmp_dict)
-        return local_metadata
+            TASKINFO_SEND.pack_into(fixed, i * size, ret.get('region_id'),
+                                    ret.get('site_id'), ret.get('app_id'),
+                                    ret.get('timestamp'), ret.get('sgw_port'),
+                                    proxy_port, ret.get('sgw_ip'), proxy_ip,
+                                    ret.get('sgw_id'), proxy_id,
+                                    ret.get('file_name').encode('utf-8'),
+                                    len(metadata_pack))
+            buffers.append(view[i * size: (i + 1) * size])
+            buffers.append(metadata_pack)
+        return buffers
     
-    def _send_query_data1(self, head_unpack, body, sock, meta_src_id,
-                          offset_remote, count_remote):
-        """
-        @:向RemoteMetadataServer发送查询消息
-        """
-#         (total_size, major, minor, src_type, dst_type, src_id, client_dst_id,
-#          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
-        total_size = head_unpack[0]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = offset_remote
-        count = count_remote
-         
-        dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
-        dst_id = int(meta_src_id, 16)
-        command = Constant.REMOTE_QUERY_DATA
-        
-        fmt_head = Constant.FMT_COMMON_HEAD
-        header = [total_size, self.major, self.minor, self.src_type, dst_type,
-                  src_id, dst_id, trans_id, sequence, command, ack_code,
-                  total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
-        data = head_pack + body
-        try:
-            sock.sendall(data)
-        except socket.error:
-            sock.close()
-        
-    def _generate_meta_sock(self, addr):
+    def _stream_query_rows(self, head_unpack, rows, conn, command, pack_rows):
+        """
+        @:流式发送查询结果，请求消息体中"stream": true时使用
+        @:rows可以是数据库游标，每取到Config.query_stream_rows条记录就打包发送一帧，服务端内存占用有上限，
+        @:Client不必等全部结果查询完就能收到第一批记录
+        @:每帧消息头的offset为本帧第一条记录在结果中的位置，count为本帧的记录数；
+        @:中间帧的ack_code为ACK_CLIENT_QUERY_DATA_PARTIAL，最后一帧为ACK_CLIENT_QUERY_DATA(可以不含记录)
+        @:pack_rows(chunk, final)返回一帧消息体的缓冲区列表
+        @:每帧由send_buffers在send_lock(conn)下完整写出，同一连接上其他请求的回复只会插在帧与帧之间，
+        @:取下一批记录时不持有该锁
+        """
+        chunk_rows = Config.query_stream_rows
+        rows = iter(rows)
+        offset = head_unpack.offset
+        chunk = list(islice(rows, chunk_rows))
+        while True:
+            next_chunk = list(islice(rows, chunk_rows)) if chunk else []
+            final = not next_chunk
+            ack_code = (Constant.ACK_CLIENT_QUERY_DATA if final else
+                        Constant.ACK_CLIENT_QUERY_DATA_PARTIAL)
+            buffers = pack_rows(chunk, final)
+            body_size = sum(len(buf) for buf in buffers)
+            header = [Constant.HEAD_LENGTH + body_size, self.major, self.minor,
+                      self.src_type, self.dst_type, LOCAL_SRC_ID,
+                      head_unpack.src_id, head_unpack.trans_id,
+                      head_unpack.sequence, command, ack_code,
+                      head_unpack.total, offset, len(chunk)]
+            send_buffers(conn, [HEAD.pack(*header)] + buffers)
+            metrics.incr('query.stream_frames')
+            if final:
+                break
+            offset += len(chunk)
+            chunk = next_chunk
+            
+    def _remote_request(self, remote_metadata_info, generate, head_unpack,
+                        body):
         """
-        @:创建与RemoteMetadataServer通信的socket
+        @:在fanout的线程中执行：通过长连接池向一个RemoteMetadataServer发送请求并等待回复
+        @:generate为生成请求消息的函数，返回(head_unpack, body)，连接失败、连接断开或超时返回None
         """
-        logger.info("执行_generate_meta_sock，生成与RemoteMetadataServer通信的socket")
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        except socket.error as e:
-            logger.error('Created metadata socket Failed:{}'.format(e))
-            
-        try:
-            sock.connect(addr)
-        except socket.error:
-            logger.error('该请求的地址{}无效，与RemoteMetadataServer连接失败'.format(addr))
-            sock.close()
-        return sock
+        meta_ip = str(remote_metadata_info[1])
+        meta_port = int(remote_metadata_info[2])
+        meta_src_id = remote_metadata_info[3]
+        data = generate(head_unpack, body, meta_src_id)
+        return remote_pool.request((meta_ip, meta_port, meta_src_id), data)
         
     def _generate_query_num(self, head_unpack, body, meta_src_id):
         """
@@ -837,23 +639,23 @@ class Client:
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info("执行_generate_query_num，生成向RemoteMetadataServer"
                     "查询记录数量的请求消息")
-        total_size = head_unpack[0]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        total_size = head_unpack.total_size
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        ack_code = head_unpack.ack_code
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
     
         dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = int(meta_src_id, 16)
         command = Constant.REMOTE_QUERY_NUM
         
         header = [total_size, self.major, self.minor, self.src_type, dst_type,
                   src_id, dst_id, trans_id, sequence, command, ack_code,
                   total, offset, count]
-        head_pack = struct.pack(Constant.FMT_COMMON_HEAD, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("生成向RemoteMetadataServer查询记录数量的请求消息的"
                     "head：{}".format(header))
         logger.info("生成向RemoteMetadataServer查询记录数量的请求消息的"
@@ -861,123 +663,41 @@ class Client:
         data = head_pack + body
         return data
     
-    def _send_query_num(self, head_unpack, body, sock, meta_src_id):
-        """
-        @:向RemoteMetadataServer发送查询消息
-        """
-        logger.info("执行_send_query_num，向RemoteMetadataServer发送查询消息")
-        data = self._generate_query_num(head_unpack, body, meta_src_id)
-        try:
-            sock.sendall(data)
-        except socket.error:
-            sock.close()
-        
     def _generate_query_data(self, headpack, body, meta_src_id):
         """
         @:生成向RemoteMetadataServer查询的请求消息
         """
 #         (total_size, major, minor, src_type, dst_type, src_id, client_dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = headpack
-        total_size = headpack[0]
-        trans_id = headpack[7]
-        sequence = headpack[8]
-        ack_code = headpack[10]
-        total = headpack[11]
-        offset = headpack[12]
-        count = headpack[13]
+        total_size = headpack.total_size
+        trans_id = headpack.trans_id
+        sequence = headpack.sequence
+        ack_code = headpack.ack_code
+        total = headpack.total
+        offset = headpack.offset
+        count = headpack.count
          
         dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = int(meta_src_id, 16)
         command = Constant.REMOTE_QUERY_DATA
+        # minor为希望对端回复的查询结果编码
+        minor = Constant.REMOTE_ROW_FORMATS.get(Config.remote_row_format,
+                                                Constant.REMOTE_ROWS_JSON)
         
-        header = [total_size, self.major, self.minor, self.src_type, dst_type,
+        header = [total_size, self.major, minor, self.src_type, dst_type,
                   src_id, dst_id, trans_id, sequence, command, ack_code,
                   total, offset, count]
-        headPack = struct.pack(Constant.FMT_COMMON_HEAD, *header)
+        headPack = HEAD.pack(*header)
         data = headPack + body
         return data
     
-    def _send_query_data(self, head_unpack, body, sock, meta_src_id):
-        """
-        @:向RemoteMetadataServer发送查询消息
-        """
-#         (total_size, major, minor, src_type, dst_type, src_id, client_dst_id,
-#          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
-        total_size = head_unpack[0]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-         
-        dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
-        dst_id = int(meta_src_id, 16)
-        command = Constant.REMOTE_QUERY_DATA
-        
-        fmt_head = Constant.FMT_COMMON_HEAD
-        header = [total_size, self.major, self.minor, self.src_type, dst_type,
-                  src_id, dst_id, trans_id, sequence, command, ack_code,
-                  total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
-        data = head_pack + body
-        try:
-            sock.sendall(data)
-        except socket.error:
-            sock.close()
-        
-    def recvall_remote(self, sock, length):
-        """
-        @:接收RemoteMetadataServer发回的消息
-        """
-        blocks = []
-        while length:
-            try:
-                block = sock.recv(length)
-            except:
-                sock.close()
-                break
-            else:
-                length -= len(block)
-                blocks.append(block)
-        return b''.join(blocks)
-     
-    def recv_remote_msg(self, sock):
-        """
-        @:解析RemoteMetadataServer发回的消息
-        """
-        header = self.recvall_remote(sock, Constant.HEAD_LENGTH)
-        fmt_head = Constant.FMT_COMMON_HEAD
-        try:
-            head_unpack = struct.unpack(fmt_head, header)
-        except struct.error:
-            sock.close()
-        else:
-            total_size = head_unpack[0]
-            body_size = total_size - Constant.HEAD_LENGTH
-            body = self.recvall_remote(sock, body_size)
-            return head_unpack, body
-            
-    def _parse_remote_query_num(self, sock):
-        """
-        @:解析RemoteMetadataServer返回查询到的记录条数
-        """
-        try:
-            headpack = self.recv_remote_msg(sock)[0]
-        except:
-            sock.close()
-        else:
-            total = headpack[11]
-            return total
-    
     def _parse_remote_del_msg(self, remote_head_unpack):
         """
         @:解析RemoteMetadataServer发送的删除消息
         """
         try:
-            ack_code = remote_head_unpack[10]
+            ack_code = remote_head_unpack.ack_code
         except:
             pass
         else:
@@ -989,6 +709,225 @@ class Client:
                 logger.error('RemoteMetadataServer使用了未定义的删除响应码')
             return flag
         
+    def _read_session(self, body_unpack):
+        """
+        @:查询元数据的只读session，读只读副本，site最近有写入时读主库
+        """
+        return session_scope(readonly=True,
+                             site_id=body_unpack.get('site_id')[0])
+    
+    def _query_filter(self, body_unpack):
+        """
+        @:Client查询元数据的过滤条件，查询、计数共用
+        """
+        site_id = body_unpack.get('site_id')[0]
+        start, end = body_unpack.get('timestamp')[: 2]
+        return and_(MetadataInfo.site_id == site_id,
+                    MetadataInfo.app_id.in_(body_unpack.get('app_id')),
+                    MetadataInfo.user_id.in_(body_unpack.get('user_id')),
+                    MetadataInfo.customer_id.in_(body_unpack.get('customer_id')),
+                    MetadataInfo.timestamp.between(start, end))
+    
+    def _file_query_filter(self, body_unpack):
+        """
+        @:Fileportal查询元数据的过滤条件，查询、计数共用
+        """
+        site_id = body_unpack.get('site_id')[0]
+        start, end = body_unpack.get('timestamp')[: 2]
+        return and_(MetadataInfo.site_id == site_id,
+                    MetadataInfo.timestamp.between(start, end))
+    
+    def _order_keys(self, order_by):
+        """
+        @:order_by中metadata_info允许排序的列名，最后加上id保证相同排序值的记录在分页时顺序固定
+        """
+        keys = []
+        for key in order_by or []:
+            if key not in Constant.METADATA_ORDER_KEYS:
+                logger.error('不支持的排序关键字:{}'.format(key))
+                continue
+            keys.append(key)
+        keys.append('id')
+        return keys
+    
+    def _order_clauses(self, order_by, desc_key):
+        """
+        @:把order_by中的所有关键字转换为一个ORDER BY
+        """
+        direction = desc if desc_key else asc
+        return [direction(getattr(MetadataInfo, key))
+                for key in self._order_keys(order_by)]
+    
+    def _merge_regions(self, region_rets, order_by, desc_key):
+        """
+        @:k路归并各region的查询结果，每个region的结果已按相同的排序关键字(_order_keys)排好序，
+        @:用堆逐条取出，调用方用islice取到offset+count条后即停止，不再对所有region的结果整体排序
+        """
+        return heapq.merge(*region_rets, key=self._merge_key(order_by),
+                           reverse=bool(desc_key))
+    
+    def _merge_key(self, order_by):
+        """
+        @:归并和生成游标时使用的排序值，与_order_keys对应
+        @:旧版本RemoteMetadataServer的JSON回复中没有id，缺少id的记录按0比较，只按其他排序关键字排序
+        """
+        keys = self._order_keys(order_by)[:-1]
+        if not keys:
+            return lambda ret: (ret.get('id', 0),)
+        get_keys = itemgetter(*keys)
+        if len(keys) == 1:
+            return lambda ret: (get_keys(ret), ret.get('id', 0))
+        return lambda ret: get_keys(ret) + (ret.get('id', 0),)
+    
+    def _tag_region(self, region_id, region_ret):
+        """
+        @:在归并时标记每条记录来自哪个region，用于生成下一页的游标
+        """
+        for ret in region_ret:
+            ret['cursor_region'] = region_id
+            yield ret
+    
+    def _seek_filter(self, order_by, after, desc_key):
+        """
+        @:游标分页的定位条件，等价于WHERE (k1, k2, ..., id) > (v1, v2, ..., vid)，
+        @:展开为 k1 > v1 OR (k1 = v1 AND k2 > v2) OR ...，便于MySQL使用索引
+        @:desc为True时比较方向为 <
+        """
+        columns = [getattr(MetadataInfo, key)
+                   for key in self._order_keys(order_by)]
+        clauses = []
+        for i, column in enumerate(columns):
+            equals = [columns[j] == after[j] for j in range(i)]
+            seek = column < after[i] if desc_key else column > after[i]
+            clauses.append(and_(*(equals + [seek])))
+        return or_(*clauses)
+    
+    def _query_page(self, session, criterion, body_unpack, offset, count,
+                    merged=False, stream=False):
+        """
+        @:排序和分页都在SQL中完成，只取回客户端需要的一页数据
+        @:merged为True时结果还要与其他region的结果合并排序，需要返回前offset + count条
+        @:请求中带有after时为游标分页，从after之后取count条，不再使用offset
+        @:stream为True时使用服务端游标(yield_per)，边取边发送，不把整页结果缓存在内存中
+        """
+        order_by = body_unpack.get('order_by')
+        desc_key = body_unpack.get('desc')
+        query = session.query(*QUERY_COLUMNS).filter(criterion)
+        if 'after' in body_unpack:
+            after = body_unpack.get('after')
+            if after and (not isinstance(after, list) or
+                          len(after) != len(self._order_keys(order_by))):
+                logger.error('请求中的after与排序关键字不一致，从第一条开始查询')
+                after = None
+            if after:
+                query = query.filter(self._seek_filter(order_by, after,
+                                                       desc_key))
+            offset = 0
+        elif merged:
+            offset, count = 0, offset + count
+        query = query.order_by(*self._order_clauses(order_by, desc_key))
+        query = query.offset(offset).limit(count)
+        if stream:
+            query = query.yield_per(Config.query_stream_rows)
+        return query
+    
+    def _query_rows_to_dicts(self, rows, addr):
+        """
+        @:把查询结果(QUERY_COLUMNS元组)转换为跨region合并、转发时使用的字典
+        """
+        sgw_ip, sgw_port, sgw_id = addr
+        return [{'id': row_id,
+                 'site_id': site_id,
+                 'app_id': app_id,
+                 'file_name': file_name,
+                 'region_id': region_id,
+                 'user_id': user_id,
+                 'customer_id': customer_id,
+                 'timestamp': timestamp,
+                 'sgw_ip': sgw_ip,
+                 'proxy_ip': sgw_ip,
+                 'sgw_port': sgw_port,
+                 'proxy_port': sgw_port,
+                 'sgw_id': sgw_id,
+                 'proxy_id': sgw_id}
+                for (row_id, site_id, app_id, file_name, region_id, user_id,
+                     customer_id, timestamp) in rows]
+    
+    def _parse_remote_rows(self, remote_head_unpack, meta_body):
+        """
+        @:解析RemoteMetadataServer回复的查询结果，按回复头的minor选择编码，返回与本地查询相同的字典
+        """
+        row_format = remote_head_unpack.minor
+        if row_format == Constant.REMOTE_ROWS_JSON:
+            return json.loads(meta_body.decode('utf-8')).get('site_id')
+        rows, addr = unpack_remote_rows(
+            meta_body, row_format == Constant.REMOTE_ROWS_COLUMNAR)
+        return self._query_rows_to_dicts(rows, addr)
+    
+    def _pack_query_rows(self, rows, addr):
+        """
+        @:把查询结果(QUERY_COLUMNS元组)打包为FMT_TASKINFO_SEND + metadata的缓冲区列表，交给send_buffers
+        @:所有记录的定长部分用pack_into写入同一个预分配的bytearray，每条记录只引用其中的memoryview切片，
+        @:记录之间、消息头与消息体之间都不再拼接
+        """
+        sgw_ip, sgw_port, sgw_id = addr
+        rows = list(rows)
+        size = TASKINFO_SEND.size
+        fixed = bytearray(size * len(rows))
+        view = memoryview(fixed)
+        buffers = []
+        for i, (_, site_id, app_id, file_name, region_id, user_id, customer_id,
+                timestamp) in enumerate(rows):
+            metadata_pack = json.dumps({'user_id': user_id,
+                                        'customer_id': customer_id}
+                                       ).encode('utf-8')
+            TASKINFO_SEND.pack_into(fixed, i * size, region_id, site_id, app_id,
+                                    timestamp, sgw_port, sgw_port, sgw_ip,
+                                    sgw_ip, sgw_id, sgw_id,
+                                    file_name.encode('utf-8'),
+                                    len(metadata_pack))
+            buffers.append(view[i * size: (i + 1) * size])
+            buffers.append(metadata_pack)
+        return buffers
+    
+    def _encode_cursor(self, order_by, desc_key, positions):
+        """
+        @:生成游标：记录每个region上一页最后一条记录的排序键，对Client不透明
+        """
+        cursor = {'order_by': order_by, 'desc': bool(desc_key),
+                  'after': positions}
+        cursor_json = json.dumps(cursor, separators=(',', ':'))
+        return base64.urlsafe_b64encode(cursor_json.encode('utf-8')).decode()
+    
+    def _decode_cursor(self, cursor, order_by, desc_key):
+        """
+        @:解析游标，返回{region: 排序键}；游标为空、无法解析、格式不对或与本次请求的排序方式不一致时从第一页开始
+        """
+        if not cursor:
+            return {}
+        try:
+            if not isinstance(cursor, str):
+                raise TypeError('游标不是字符串')
+            cursor_json = base64.urlsafe_b64decode(cursor.encode('utf-8'))
+            cursor = json.loads(cursor_json.decode('utf-8'))
+            if not isinstance(cursor, dict):
+                raise TypeError('游标不是json对象')
+        except (ValueError, TypeError):
+            logger.error('无法解析的查询游标:{}'.format(cursor))
+            return {}
+        if (cursor.get('order_by') != order_by or
+                cursor.get('desc') != bool(desc_key)):
+            logger.error('查询游标与请求的排序方式不一致，从第一页开始查询')
+            return {}
+        positions = cursor.get('after') or {}
+        key_count = len(self._order_keys(order_by))
+        if not isinstance(positions, dict) or not all(
+                isinstance(after, list) and len(after) == key_count
+                for after in positions.values()):
+            logger.error('查询游标中的排序键格式不对，从第一页开始查询')
+            return {}
+        return positions
+    
     def _get_local_query_num(self, body):
         """
         @:MetadataServer收到远端查询请求后只进行本地查询
@@ -1004,22 +943,17 @@ class Client:
         body_unpack = json.loads(body.decode('utf-8'))
         logger.info(body_unpack)
         site_id = body_unpack.get('site_id')[0]
-        app_id = body_unpack.get('app_id')
-        user_id = body_unpack.get('user_id')
-        customer_id = body_unpack.get('customer_id')
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
+        key = count_cache.key('query', body_unpack)
+        query_nums = count_cache.get(key, site_id)
+        if query_nums is not None:
+            return query_nums
+        generation = count_cache.generation(site_id)
         
         # 只查询数量 ，不用排序
-        with session_scope() as session:
+        with session_scope(readonly=True, site_id=site_id) as session:
             query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.app_id.in_(app_id),
-                                     MetadataInfo.user_id.in_(user_id),
-                                     MetadataInfo.customer_id.in_(customer_id),
-                                     MetadataInfo.timestamp.between(start, end)))
-            query_nums = filt_ret.count()
+            query_nums = query.filter(self._query_filter(body_unpack)).count()
+        count_cache.put(key, generation, query_nums)
         return query_nums
     
     def _get_local_file_query_num(self, body):
@@ -1034,16 +968,18 @@ class Client:
         body_unpack = json.loads(body.decode('utf-8'))
         logger.info(body_unpack)
         site_id = body_unpack.get('site_id')[0]
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
+        key = count_cache.key('file_query', body_unpack)
+        query_nums = count_cache.get(key, site_id)
+        if query_nums is not None:
+            return query_nums
+        generation = count_cache.generation(site_id)
         
         # 只查询数量 ，不用排序
-        with session_scope() as session:
+        with session_scope(readonly=True, site_id=site_id) as session:
             query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.timestamp.between(start, end)))
-            query_nums = filt_ret.count()
+            query_nums = query.filter(
+                self._file_query_filter(body_unpack)).count()
+        count_cache.put(key, generation, query_nums)
         return query_nums
     
     def handle_remote_query_num(self, head_unpack, body, conn, sel):
@@ -1054,14 +990,14 @@ class Client:
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_remote_query_num,处理远端MetadataServer'
                     '查询元数据记录数量的请求')
-        total_size = head_unpack[0]
-        meta_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        offset = head_unpack[12]
+        total_size = head_unpack.total_size
+        meta_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        offset = head_unpack.offset
          
         dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = meta_src_id
         command = Constant.REMOTE_QUERY_NUM_RESP
         ack_code = Constant.ACK_REMOTE_QUERY_NUM
@@ -1069,83 +1005,36 @@ class Client:
         total = self._get_local_query_num(body)
         count = 0
         
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type, dst_type,
                   src_id, dst_id, trans_id, sequence, command, ack_code,
                   total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         data = head_pack + body
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
         
-    def _get_local_query_data(self, head_unpack, body, sgw_info, lock):
+    def _get_local_query_data(self, head_unpack, body, sgw_table):
         """
         @:MetadataServer收到查询请求后进行本地查询
         """
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        offset = head_unpack.offset
+        count = head_unpack.count
         
         body_unpack = json.loads(body.decode('utf-8'))
-        site_id = body_unpack.get('site_id')[0]
-        app_id = body_unpack.get('app_id')
-        user_id = body_unpack.get('user_id')
-        customer_id = body_unpack.get('customer_id')
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
-        order_by = body_unpack.get('order_by')
-        desc_key = body_unpack.get('desc')
         
-        addr = self.select_addr(sgw_info, lock)[0]
-        sgw_ip = proxy_ip = addr[0]
-        sgw_port = proxy_port = addr[1]
-        sgw_id = proxy_id = addr[2]
+        addr = self.select_addr(sgw_table)[0]
         
         local_metadata = []
-        with session_scope() as session:
-            query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.app_id.in_(app_id),
-                                     MetadataInfo.user_id.in_(user_id),
-                                     MetadataInfo.customer_id.in_(customer_id),
-                                     MetadataInfo.timestamp.between(start, end)))
-            if not desc_key:
-                for key in order_by:
-                    ret = filt_ret.order_by(asc(key)).all()
-            else:
-                for key in order_by:
-                    ret = filt_ret.order_by(desc(key)).all()
-            
-            for metadata_info in ret[: offset + count]:
-                site_id_tmp = metadata_info.site_id
-                app_id_tmp = metadata_info.app_id
-                file_name = metadata_info.file_name
-                region_id = metadata_info.region_id
-                user_id_tmp = metadata_info.user_id
-                customer_id_tmp = metadata_info.customer_id
-                timestamp_tmp = metadata_info.timestamp
-                
-                tmp_dict = {}
-                tmp_dict['site_id'] = site_id_tmp
-                tmp_dict['app_id'] = app_id_tmp
-                tmp_dict['file_name'] = file_name
-                tmp_dict['region_id'] = region_id
-                tmp_dict['user_id'] = user_id_tmp
-                tmp_dict['customer_id'] = customer_id_tmp
-                tmp_dict['timestamp'] = timestamp_tmp
-                tmp_dict['sgw_ip'] = sgw_ip
-                tmp_dict['proxy_ip'] = proxy_ip
-                tmp_dict['sgw_port'] = sgw_port
-                tmp_dict['proxy_port'] = proxy_port
-                tmp_dict['sgw_id'] = sgw_id
-                tmp_dict['proxy_id'] = proxy_id
-                local_metadata.append(tmp_dict)
+        with self._read_session(body_unpack) as session:
+            ret = self._query_page(session, self._query_filter(body_unpack),
+                                   body_unpack, offset, count, merged=True)
+            local_metadata.extend(self._query_rows_to_dicts(ret, addr))
         return local_metadata
     
-    def handle_local_query_data(self, head_unpack, body, conn, sel, sgw_info, lock):
+    def handle_local_query_data(self, head_unpack, body, conn, sel, sgw_table):
         """
         :MetadataServer发送本地查询到的数据
         {"site_id": [id1, ...],
@@ -1154,98 +1043,64 @@ class Client:
         "customer_id": [id1, id2, ...],
         "timestamp": [start_time, end_time],
         "order_by": [keyword1, keyword2, ...],
-        "desc": bool}
+        "desc": bool,
+        "stream": bool}     # 可选，为true时分多帧流式返回
         """
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_local_query_data,本地处理Client查询元数据信息的请求')
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
          
-        addr = self.select_addr(sgw_info, lock)[0]
-        sgw_ip = proxy_ip = addr[0]
-        sgw_port = proxy_port = addr[1]
-        sgw_id = proxy_id = addr[2]
+        addr = self.select_addr(sgw_table)[0]
          
         body_unpack = json.loads(body.decode('utf-8'))
-        site_id = body_unpack.get('site_id')[0]
-        app_id = body_unpack.get('app_id')
-        user_id = body_unpack.get('user_id')
-        customer_id = body_unpack.get('customer_id')
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
-        order_by = body_unpack.get('order_by')
-        desc_key = body_unpack.get('desc')
         
-        fmt_body = Constant.FMT_TASKINFO_SEND
-        body_tmp = []
-        with session_scope() as session:
-            query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.app_id.in_(app_id),
-                                     MetadataInfo.user_id.in_(user_id),
-                                     MetadataInfo.customer_id.in_(customer_id),
-                                     MetadataInfo.timestamp.between(start, end)))
-            if not desc_key:
-                for key in order_by:
-                    ret = filt_ret.order_by(asc(key)).all()
-            else:
-                for key in order_by:
-                    ret = filt_ret.order_by(desc(key)).all()
-                
-            for metadata_info in ret[offset: offset + count]:
-                site_id_tmp = metadata_info.site_id
-                app_id_tmp = metadata_info.app_id
-                file_name_tmp = metadata_info.file_name
-                region_id_tmp = metadata_info.region_id
-                user_id_tmp = metadata_info.user_id
-                customer_id_tmp = metadata_info.customer_id
-                timestamp_tmp = metadata_info.timestamp
-                file_name = file_name_tmp.encode('utf-8')
-                
-                metadata = {}
-                metadata['user_id'] = user_id_tmp
-                metadata['customer_id'] = customer_id_tmp
-                metadata_json = json.dumps(metadata)
-                metadata_pack = metadata_json.encode('utf-8')
-                metadata_len = len(metadata_pack)
-                
-                body_resp = [region_id_tmp, site_id_tmp, app_id_tmp, timestamp_tmp,
-                             sgw_port, proxy_port, sgw_ip, proxy_ip, sgw_id,
-                             proxy_id, file_name, metadata_len]
-                body_pack = struct.pack(fmt_body, *body_resp)
-                body_tmp.append(body_pack + metadata_pack)
-        body_query = b''.join(body_tmp)
-        body_size = len(body_query)
+        if body_unpack.get('stream'):
+            try:
+                with self._read_session(body_unpack) as session:
+                    ret = self._query_page(session,
+                                           self._query_filter(body_unpack),
+                                           body_unpack, offset, count,
+                                           stream=True)
+                    self._stream_query_rows(
+                        head_unpack, ret, conn, Constant.CLIENT_QUERY_DATA_RESP,
+                        lambda chunk, final: self._pack_query_rows(chunk, addr))
+            except socket.error:
+                sel.unregister(conn)
+                conn.close()
+            return
+        
+        with self._read_session(body_unpack) as session:
+            ret = self._query_page(session, self._query_filter(body_unpack),
+                                   body_unpack, offset, count)
+            buffers = self._pack_query_rows(ret, addr)
+        body_size = sum(len(buf) for buf in buffers)
         
         total_size = Constant.HEAD_LENGTH + body_size
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_QUERY_DATA_RESP
         ack_code = Constant.ACK_CLIENT_QUERY_DATA
          
         # 构造消息头部
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
         logger.info("处理Client查询元数据信息的请求，回复的head为：{}".format(header))
-        logger.info("处理Client查询元数据信息的请求，回复的body为：{}".format(body_query))
-        data = head_pack + body_query
+        logger.info("处理Client查询元数据信息的请求，回复的body长度为：{}".format(body_size))
         try:
-            conn.sendall(data)
+            send_buffers(conn, [HEAD.pack(*header)] + buffers)
         except socket.error:
             sel.unregister(conn)
             conn.close()
             
     def handle_local_file_query_data(self, head_unpack, body, conn, sel, 
-                                     sgw_info, lock):
+                                     sgw_table):
         """
         :MetadataServer发送本地查询到的数据
         {"site_id": [id1, ...],
@@ -1256,81 +1111,38 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_local_file_query_data,本地处理Fileportal查询元数据信息的请求')
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
          
-        addr = self.select_addr(sgw_info, lock)[0]
-        sgw_ip = proxy_ip = addr[0]
-        sgw_port = proxy_port = addr[1]
-        sgw_id = proxy_id = addr[2]
+        addr = self.select_addr(sgw_table)[0]
          
         body_unpack = json.loads(body.decode('utf-8'))
-        site_id = body_unpack.get('site_id')[0]
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
-        order_by = body_unpack.get('order_by')
-        desc_key = body_unpack.get('desc')
         
-        fmt_body = Constant.FMT_TASKINFO_SEND
-        body_tmp = []
-        with session_scope() as session:
-            query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.timestamp.between(start, end)))
-            if not desc_key:
-                for key in order_by:
-                    ret = filt_ret.order_by(asc(key)).all()
-            else:
-                for key in order_by:
-                    ret = filt_ret.order_by(desc(key)).all()
-                
-            for metadata_info in ret[offset: offset + count]:
-                site_id_tmp = metadata_info.site_id
-                app_id_tmp = metadata_info.app_id
-                file_name_tmp = metadata_info.file_name
-                region_id_tmp = metadata_info.region_id
-                user_id_tmp = metadata_info.user_id
-                customer_id_tmp = metadata_info.customer_id
-                timestamp_tmp = metadata_info.timestamp
-                file_name = file_name_tmp.encode('utf-8')
-                
-                metadata = {}
-                metadata['user_id'] = user_id_tmp
-                metadata['customer_id'] = customer_id_tmp
-                metadata_json = json.dumps(metadata)
-                metadata_pack = metadata_json.encode('utf-8')
-                metadata_len = len(metadata_pack)
-                
-                body_resp = [region_id_tmp, site_id_tmp, app_id_tmp, timestamp_tmp,
-                             sgw_port, proxy_port, sgw_ip, proxy_ip, sgw_id,
-                             proxy_id, file_name, metadata_len]
-                body_pack = struct.pack(fmt_body, *body_resp)
-                body_tmp.append(body_pack + metadata_pack)
-        body_query = b''.join(body_tmp)
-        body_size = len(body_query)
+        with self._read_session(body_unpack) as session:
+            ret = self._query_page(session,
+                                   self._file_query_filter(body_unpack),
+                                   body_unpack, offset, count)
+            buffers = self._pack_query_rows(ret, addr)
+        body_size = sum(len(buf) for buf in buffers)
         
         total_size = Constant.HEAD_LENGTH + body_size
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.FILE_QUERY_DATA_RESP
         ack_code = Constant.ACK_CLIENT_QUERY_DATA
          
         # 构造消息头部
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
         logger.info("处理Fileportal查询元数据信息的请求，回复的head为：{}".format(header))
-        logger.info("处理Fileportal查询元数据信息的请求，回复的body为：{}".format(body_query))
-        data = head_pack + body_query
+        logger.info("处理Fileportal查询元数据信息的请求，回复的body长度为：{}".format(body_size))
         try:
-            conn.sendall(data)
+            send_buffers(conn, [HEAD.pack(*header)] + buffers)
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -1339,8 +1151,8 @@ class Client:
             conn.close()
             
         
-    def handle_remote_query_data(self, head_unpack, body, conn, sel, sgw_info,
-                                 lock):
+    def handle_remote_query_data(self, head_unpack, body, conn, sel,
+                                 sgw_table):
         """
         @:处理远端查询到的数据
         """
@@ -1348,97 +1160,54 @@ class Client:
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_remote_query_data,处理远端MetadataServer'
                     '查询元数据信息的请求')
-        meta_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        
-        addr = self.select_addr(sgw_info, lock)[0]
-        sgw_ip = proxy_ip = addr[0]
-        sgw_port = proxy_port = addr[1]
-        sgw_id = proxy_id = addr[2]
+        meta_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
+        
+        addr = self.select_addr(sgw_table)[0]
         
         body_unpack = json.loads(body.decode('utf-8'))
-        site_id = body_unpack.get('site_id')[0]
-        app_id = body_unpack.get('app_id')
-        user_id = body_unpack.get('user_id')
-        customer_id = body_unpack.get('customer_id')
-        timestamp = body_unpack.get('timestamp')
-        start = timestamp[0]
-        end = timestamp[1]
-        order_by = body_unpack.get('order_by')
-        desc_key = body_unpack.get('desc')
         
-        remote_metadata = []
-        with session_scope() as session:
-            query = session.query(MetadataInfo)
-            filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
-                                     MetadataInfo.app_id.in_(app_id),
-                                     MetadataInfo.user_id.in_(user_id),
-                                     MetadataInfo.customer_id.in_(customer_id),
-                                     MetadataInfo.timestamp.between(start, end)))
-            if not desc_key:
-                for key in order_by:
-                    ret = filt_ret.order_by(asc(key)).all()
+        # 请求头的minor为请求方希望的编码，老版本的请求方为0，仍然回复JSON
+        row_format = head_unpack.minor
+        if row_format not in (Constant.REMOTE_ROWS_BINARY,
+                              Constant.REMOTE_ROWS_COLUMNAR):
+            row_format = Constant.REMOTE_ROWS_JSON
+        with self._read_session(body_unpack) as session:
+            ret = self._query_page(session, self._query_filter(body_unpack),
+                                   body_unpack, offset, count, merged=True)
+            if row_format == Constant.REMOTE_ROWS_JSON:
+                body_json = json.dumps(
+                    {'site_id': self._query_rows_to_dicts(ret, addr)})
+                buffers = [body_json.encode('utf-8')]
             else:
-                for key in order_by:
-                    ret = filt_ret.order_by(desc(key)).all()
-                
-            for metadata_info in ret[: offset + count]:
-                site_id_tmp = metadata_info.site_id
-                app_id_tmp = metadata_info.app_id
-                file_name = metadata_info.file_name
-                region_id = metadata_info.region_id
-                user_id_tmp = metadata_info.user_id
-                customer_id_tmp = metadata_info.customer_id
-                timestamp_tmp = metadata_info.timestamp
-                
-                tmp_dict = {}
-                tmp_dict['site_id'] = site_id_tmp
-                tmp_dict['app_id'] = app_id_tmp
-                tmp_dict['file_name'] = file_name
-                tmp_dict['region_id'] = region_id
-                tmp_dict['user_id'] = user_id_tmp
-                tmp_dict['customer_id'] = customer_id_tmp
-                tmp_dict['timestamp'] = timestamp_tmp
-                tmp_dict['sgw_ip'] = sgw_ip
-                tmp_dict['proxy_ip'] = proxy_ip
-                tmp_dict['sgw_port'] = sgw_port
-                tmp_dict['proxy_port'] = proxy_port
-                tmp_dict['sgw_id'] = sgw_id
-                tmp_dict['proxy_id'] = proxy_id
-                remote_metadata.append(tmp_dict)
-        
-        body_tmp = {}
-        body_tmp['site_id'] = remote_metadata
-        body_json = json.dumps(body_tmp)
-        body_pack = body_json.encode('utf-8')
-        body_size = len(body_pack)
+                buffers = pack_remote_rows(
+                    ret, addr, row_format == Constant.REMOTE_ROWS_COLUMNAR)
+        body_size = sum(len(buf) for buf in buffers)
         
         total_size = Constant.HEAD_LENGTH + body_size
         dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = meta_src_id
         command = Constant.REMOTE_QUERY_DATA_RESP
         ack_code = Constant.ACK_REMOTE_QUERY_DATA
         
-        # 构造消息头部
-        fmt_head = Constant.FMT_COMMON_HEAD
-        header = [total_size, self.major, self.minor, self.src_type, dst_type,
+        # 构造消息头部，minor为消息体实际使用的编码
+        header = [total_size, self.major, row_format, self.src_type, dst_type,
                   src_id, dst_id, trans_id, sequence, command, ack_code, total,
                   offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         
-        data = head_pack + body_pack
         try:
-            conn.sendall(data)
+            send_buffers(conn, [head_pack] + buffers)
         except socket.error:
             sel.unregister(conn)
             conn.close()
                 
-    def handle_delete(self, head_unpack, body, conn, sel, sgw_info, lock,
+    def handle_delete(self, head_unpack, body, conn, sel, sgw_table,
                       conf_info):
         """
         @:处理Client的删除请求
@@ -1446,38 +1215,36 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_delete,处理Client删除元数据的请求')
-        total_size = head_unpack[0]
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        
-        fmt = Constant.FMT_TASKINFO_FIXED
-        body_unpack = struct.unpack(fmt, body[: Constant.TASKINFO_FIXED_LENGTH])
+        total_size = head_unpack.total_size
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        ack_code = head_unpack.ack_code
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
+        
+        body_unpack = TASKINFO_FIXED.unpack_from(body)
         metadata_pack = body[Constant.TASKINFO_FIXED_LENGTH:]
         metadata_unpack = json.loads(metadata_pack.decode('utf-8'))
         
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_DEL_RESP
             
         flag_local, resp_body_pack = self.handle_local_del(body_unpack,
-                                                metadata_unpack, sgw_info, lock)
+                                                metadata_unpack, sgw_table)
         if flag_local:
             ack_code = Constant.ACK_CLIENT_DEL_SUCCESS
             
-            fmt_head = Constant.FMT_COMMON_HEAD
             header = [total_size, self.major, self.minor, self.src_type,
                       self.dst_type, src_id, dst_id, trans_id, sequence, command,
                       ack_code, total, offset, count]
-            head_pack = struct.pack(fmt_head, *header)
+            head_pack = HEAD.pack(*header)
             logger.info("处理Client删除元数据的请求,回复的head为：{}".format(header))
             data = head_pack + resp_body_pack + metadata_pack
             try:
-                conn.sendall(data)
+                send_buffers(conn, [data])
             except socket.error:
                 sel.unregister(conn)
                 conn.close()
@@ -1485,83 +1252,78 @@ class Client:
             site_id = client_src_id
             query_body_unpack = self.get_conf(site_id, conf_info)
             logger.info("向ConfigServer查询到的信息为：{}".format(query_body_unpack))
-            site_region_id = query_body_unpack.get(str(site_id))
-            if site_region_id:
-                i = 0
-                while i < len(site_region_id):
-                    region_id = site_region_id[i]
-                    remote_metadata_info = query_body_unpack.get(region_id)
-                    meta_ip = str(remote_metadata_info[1])
-                    meta_port = int(remote_metadata_info[2])
-                    meta_src_id = remote_metadata_info[3]
-                    addr = (meta_ip, meta_port)
-                    sock = self._generate_meta_sock(addr)
-                    self._send_del_msg(head_unpack, body, sock, meta_src_id)
-                    remote_head_unpack, remote_body = self.recv_remote_msg(sock) 
-                    flag_remote = self._parse_remote_del_msg(remote_head_unpack)
-                    if flag_remote:
-                        self.proxy_del(head_unpack, remote_body, conn, sel,
-                                       sgw_info, lock)
+            site_region_id = []
+            if query_body_unpack:
+                site_region_id = query_body_unpack.get(str(site_id)) or []
+            results = fanout.run({
+                region_id: (self._remote_request,
+                            (query_body_unpack.get(region_id),
+                             self._generate_del_msg, head_unpack, body))
+                for region_id in site_region_id})
+            # 按历史region的顺序取第一个删除成功的region回复Client
+            remote_body = None
+            for region_id in site_region_id:
+                if region_id in results:
+                    remote_head_unpack, remote_body = results[region_id]
+                    if self._parse_remote_del_msg(remote_head_unpack):
                         break
-                    else:
-                        i += 1
+                    remote_body = None
+            if remote_body is not None:
+                self.proxy_del(head_unpack, remote_body, conn, sel, sgw_table)
             else:
                 ack_code = Constant.ACK_CLIENT_DEL_FAILED
-                fmt_head = Constant.FMT_COMMON_HEAD
                 header = [total_size, self.major, self.minor, self.src_type,
                           self.dst_type, src_id, dst_id, trans_id, sequence,
                           command, ack_code, total, offset, count]
-                head_pack = struct.pack(fmt_head, *header)
+                head_pack = HEAD.pack(*header)
                 logger.info("处理Client删除元数据的请求,回复的head为：{}".format(header))
                 logger.info("处理Client删除元数据的请求,回复的body为：{}".format(body))
                 data = head_pack + body
                 try:
-                    conn.sendall(data)
+                    send_buffers(conn, [data])
                 except socket.error:
                     sel.unregister(conn)
                     conn.close()
                     
-    def handle_file_delete(self, head_unpack, body, conn, sel, sgw_info, lock):
+    def handle_file_delete(self, head_unpack, body, conn, sel, sgw_table):
         """
         @:处理Client的删除请求
         """
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_file_delete,处理Fileportal删除元数据的请求')
-        total_size = head_unpack[0]
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        
-        fmt = Constant.FMT_TASKINFO_FIXED
-        body_unpack = struct.unpack(fmt, body[: Constant.TASKINFO_FIXED_LENGTH])
+        total_size = head_unpack.total_size
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        ack_code = head_unpack.ack_code
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
+        
+        body_unpack = TASKINFO_FIXED.unpack_from(body)
         metadata_pack = body[Constant.TASKINFO_FIXED_LENGTH:]
         metadata_unpack = json.loads(metadata_pack.decode('utf-8'))
         
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.FILE_DEL_RESP
             
         flag_local, resp_body_pack = self.handle_local_del(body_unpack,
-                                                metadata_unpack, sgw_info, lock)
+                                                metadata_unpack, sgw_table)
         if flag_local:
             ack_code = Constant.ACK_CLIENT_DEL_SUCCESS
         else:
             ack_code = Constant.ACK_CLIENT_DEL_FAILED
             
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理Client删除元数据的请求,回复的head为：{}".format(header))
         data = head_pack + resp_body_pack + metadata_pack
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -1570,23 +1332,21 @@ class Client:
             conn.close()
                 
                 
-    def proxy_del(self, head_unpack, remote_body, conn, sel, sgw_info, lock):
+    def proxy_del(self, head_unpack, remote_body, conn, sel, sgw_table):
         """
         @:代理删除
         """
         logger.info('执行proxy_del，代理删除')
-        total_size = head_unpack[0]
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        
-        fmt_body = Constant.FMT_TASKINFO_FIXED
-        remote_body_unpack = struct.unpack(fmt_body,
-                                remote_body[: Constant.TASKINFO_FIXED_LENGTH])
+        total_size = head_unpack.total_size
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        ack_code = head_unpack.ack_code
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
+        
+        remote_body_unpack = TASKINFO_FIXED.unpack_from(remote_body)
         metadata_pack = remote_body[Constant.TASKINFO_FIXED_LENGTH:]
         operation = remote_body_unpack[0]
         site_id = remote_body_unpack[2]
@@ -1600,16 +1360,16 @@ class Client:
         file_name = remote_body_unpack[13]
         metadata_len = remote_body_unpack[14]
         
-        addr, region_id = self.select_addr(sgw_info, lock)[0: 2]
+        addr, region_id = self.select_addr(sgw_table)[0: 2]
         proxy_ip = addr[0]
         proxy_port = addr[1]
         proxy_id = addr[2]
         body = [operation, region_id, site_id, app_id, timestamp, sgw_port,
                 proxy_port, sgw_ip, proxy_ip, sgw_id, proxy_id, file_len,
                 file_md5, file_name, metadata_len]
-        body_pack = struct.pack(fmt_body, *body)
+        body_pack = TASKINFO_FIXED.pack(*body)
         
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_DEL_RESP
         
@@ -1618,16 +1378,15 @@ class Client:
         else:
             ack_code = Constant.ACK_CLIENT_DEL_FAILED
             
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理Client删除元数据的请求,回复的head为：{}".format(header))
         logger.info("处理Client删除元数据的请求,回复的body为：{}".format(body))
         data = head_pack + body_pack + metadata_pack
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -1640,24 +1399,23 @@ class Client:
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行_generate_del_msg，生成向RemoteMetadataServer发起删除'
                     '记录的请求消息')
-        total_size = head_unpack[0]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
+        total_size = head_unpack.total_size
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        ack_code = head_unpack.ack_code
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
          
         dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = int(meta_src_id, 16)
         command = Constant.REMOTE_DEL
         
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type, dst_type,
                   src_id, dst_id, trans_id, sequence, command, ack_code,
                   total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("生成向RemoteMetadataServer发起删除请求消息的"
                     "head：{}".format(header))
         logger.info("生成向RemoteMetadataServer发起删除请求消息的"
@@ -1665,18 +1423,7 @@ class Client:
         data = head_pack + body
         return data        
     
-    def _send_del_msg(self, head_unpack, body, sock, meta_src_id):
-        """
-        @:向RemoteMetadataServer发送删除消息
-        """
-        logger.info('执行_send_del_msg，向RemoteMetadataServer发送删除消息')
-        data = self._generate_del_msg(head_unpack, body, meta_src_id)
-        try:
-            sock.sendall(data)
-        except socket.error:
-            sock.close()
-        
-    def handle_local_del(self, body_unpack, metadata_unpack, sgw_info, lock):
+    def handle_local_del(self, body_unpack, metadata_unpack, sgw_table):
         """
         @:MetadataServer收到删除请求后进行本地删除
         site_id    app_id    file_name    region_id    system_id    group_id
@@ -1698,7 +1445,7 @@ class Client:
         user_id = metadata_unpack.get('user_id')
         customer_id = metadata_unpack.get('customer_id')
         
-        with session_scope() as session:
+        with session_scope(site_id=site_id) as session:
             query = session.query(MetadataInfo)
             filt_ret = query.filter(and_(MetadataInfo.site_id == site_id,
                                     MetadataInfo.app_id == app_id,
@@ -1708,67 +1455,63 @@ class Client:
                                     MetadataInfo.timestamp == timestamp))
             ret = filt_ret.delete()
         if ret:
+            count_cache.invalidate([site_id])
             flag = True
-            addr, region_id = self.select_addr(sgw_info, lock)[0: 2]
+            addr, region_id = self.select_addr(sgw_table)[0: 2]
             sgw_ip = proxy_ip = addr[0]
             sgw_port = proxy_port = addr[1]
             sgw_id = proxy_id = addr[2]
             
-            fmt_body = Constant.FMT_TASKINFO_FIXED
             body = [operation, region_id, site_id, app_id, timestamp, sgw_port,
                     proxy_port, sgw_ip, proxy_ip, sgw_id, proxy_id, file_len,
                     file_md5, file_name, metadata_len]
-            body_pack = struct.pack(fmt_body, *body)
+            body_pack = TASKINFO_FIXED.pack(*body)
             logger.info("处理Client删除元数据的请求,回复的body为：{}".format(body))
         else:
             flag = False
-            fmt_body = Constant.FMT_TASKINFO_FIXED
-            body_pack = struct.pack(fmt_body, *body_unpack)
+            body_pack = TASKINFO_FIXED.pack(*body_unpack)
         return flag, body_pack    
     
-    def handle_remote_del(self, head_unpack, body, conn, sel, sgw_info, lock):
+    def handle_remote_del(self, head_unpack, body, conn, sel, sgw_table):
         """
         @:在本地删除成功后将删除成功与否的信息发给发起请求的MetadataServer
         """
 #         (total_size, major, minor, src_type, dst_type, meta_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_remote_del,处理远端MetadataServer删除元数据的请求')
-        total_size = head_unpack[0]
-        meta_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        ack_code = head_unpack[10]
-        total = head_unpack[11]
-        offset = head_unpack[12]
-        count = head_unpack[13]
-        
-        fmt_body = Constant.FMT_TASKINFO_FIXED
-        body_unpack = struct.unpack(fmt_body,
-                                 body[: Constant.TASKINFO_FIXED_LENGTH])
+        total_size = head_unpack.total_size
+        meta_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        ack_code = head_unpack.ack_code
+        total = head_unpack.total
+        offset = head_unpack.offset
+        count = head_unpack.count
+        
+        body_unpack = TASKINFO_FIXED.unpack_from(body)
         metadata_pack = body[Constant.TASKINFO_FIXED_LENGTH:]
         metadata_unpack = json.loads(metadata_pack.decode('utf-8'))
         
         dst_type = Constant.METADATA_TYPE
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = meta_src_id
         command = Constant.REMOTE_DEL_RESP
         
         flag, body_pack = self.handle_local_del(body_unpack, metadata_unpack,
-                                               sgw_info, lock)
+                                               sgw_table)
         if flag:
             ack_code = Constant.ACK_REMOTE_DEL_SUCCESS
         else:
             ack_code = Constant.ACK_REMOTE_DEL_FAILED
         
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type, dst_type,
                   src_id, dst_id, trans_id, sequence, command, ack_code,
                   total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理远端MetadataServer删除元数据的请求,回复的head为：{}".format(header))
         data = head_pack + body_pack + metadata_pack
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -1786,10 +1529,10 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_config_upgrade，处理Client配置升级的请求')
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        offset = head_unpack[12]
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        offset = head_unpack.offset
         
         body_unpack = json.loads(body.decode('utf-8'))
         site_id = body_unpack.get('site_id') 
@@ -1803,22 +1546,21 @@ class Client:
         
         total = count = len(body_pack)
         total_size = Constant.HEAD_LENGTH + total
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_CONFIG_UPGRADE_RESP
         ack_code = Constant.ACK_CLIENT_CONFIG_UPGRADE
         
         # 生成头部
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理Client配置升级的请求,回复的head为：{}".format(header))
         logger.info("处理Client配置升级的请求,回复的body为：{}".format(body_json))
         data = head_pack + body_pack
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -1838,10 +1580,10 @@ class Client:
 #         (total_size, major, minor, src_type, dst_type, client_src_id, dst_id,
 #          trans_id, sequence, command, ack_code, total, offset, count) = head_unpack
         logger.info('执行handle_client_upgrade，处理Client软件升级的请求')
-        client_src_id = head_unpack[5]
-        trans_id = head_unpack[7]
-        sequence = head_unpack[8]
-        offset = head_unpack[12]
+        client_src_id = head_unpack.src_id
+        trans_id = head_unpack.trans_id
+        sequence = head_unpack.sequence
+        offset = head_unpack.offset
         
         body_unpack = json.loads(body.decode('utf-8'))
         site_id = body_unpack.get('site_id')
@@ -1855,22 +1597,21 @@ class Client:
         
         total = count = len(body_pack)
         total_size = Constant.HEAD_LENGTH + total
-        src_id = int(Config.src_id, 16)
+        src_id = LOCAL_SRC_ID
         dst_id = client_src_id
         command = Constant.CLIENT_UPGRADE_RESP
         ack_code = Constant.ACK_CLIENT_UPGRADE
         
         # 生成头部
-        fmt_head = Constant.FMT_COMMON_HEAD
         header = [total_size, self.major, self.minor, self.src_type,
                   self.dst_type, src_id, dst_id, trans_id, sequence, command,
                   ack_code, total, offset, count]
-        head_pack = struct.pack(fmt_head, *header)
+        head_pack = HEAD.pack(*header)
         logger.info("处理Client软件升级的请求,回复的head为：{}".format(header))
         logger.info("处理Client软件升级的请求,回复的body为：{}".format(body_json))
         data = head_pack + body_pack
         try:
-            conn.sendall(data)
+            send_buffers(conn, [data])
         except socket.error:
             sel.unregister(conn)
             conn.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import time
+from concurrent.futures import TimeoutError
+
+from app.configserver import config_client
+from app.metrics import metrics
+from config import Config
+from log import logger
+
+
+class ConfCache:
+    """
+    @:站点配置缓存，保存在主进程Manager的conf_info字典中，所有工作进程共享
+    @:conf_info[str(site_id)] = (body_unpack, updated_at)，工作进程通过config_client查询到配置后写入，
+    @:主进程的ConfigServer.data_handler收到CONFIG_INFO(配置变更推送)时写入，配置变更后立即生效
+    @:读取：未超过ttl直接返回；超过ttl但未超过ttl+stale时先返回旧配置，同时向ConfigServer发起一次后台刷新；
+    @:没有缓存或已超过ttl+stale时才同步查询并最多等待wait秒，查询失败时仍然返回旧配置
+    @:同一个site的并发查询由config_client合并为一次
+    @:config_client在后台线程中连接和发送，后台刷新不阻塞请求线程，同步查询最多阻塞wait秒；
+    @:连接ConfigServer失败后的一段时间内查询立即失败，直接返回旧配置
+    """
+
+    def __init__(self, ttl=None, stale=None, wait=None):
+        self.ttl = ttl or Config.conf_cache_ttl
+        self.stale = stale or Config.conf_cache_stale
+        self.wait = wait or Config.conf_cache_wait
+
+    def _refresh(self, site_id, conf_info):
+        """
+        @:向ConfigServer查询，收到回复后写入conf_info，返回Future
+        """
+        key = str(site_id)
+
+        def store(body_unpack):
+            conf_info[key] = (body_unpack, time.time())
+
+        metrics.incr('conf_cache.refresh')
+        return config_client.query(site_id, store)
+
+    def get(self, site_id, conf_info):
+        """
+        @:返回site的配置body_unpack，查询不到时返回None
+        """
+        entry = conf_info.get(str(site_id))
+        if entry is not None:
+            body_unpack, updated_at = entry
+            age = time.time() - updated_at
+            if age < self.ttl:
+                metrics.incr('conf_cache.hit')
+                return body_unpack
+            if age < self.ttl + self.stale:
+                metrics.incr('conf_cache.stale')
+                self._refresh(site_id, conf_info)
+                return body_unpack
+        metrics.incr('conf_cache.miss')
+        try:
+            body_unpack = self._refresh(site_id, conf_info).result(self.wait)
+        except TimeoutError:
+            body_unpack = None
+        if body_unpack is not None:
+            return body_unpack
+        logger.error('执行get_conf,查询site_id:{}配置失败'.format(site_id))
+        if entry is not None:
+            return entry[0]
+        return None
+
+
+conf_cache = ConfCache()
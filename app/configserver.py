@@ -1,13 +1,18 @@
 #!/usr/bin/python3
 # -*- coding=utf-8 -*-
 import json
+import os
 import socket
 import struct
 import sys
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import psutil
 
+from app.metrics import metrics
+from app.muxconn import RemotePool
+from app.protocol import HEAD, LOCAL_SRC_ID, unpack_header
 from config import Config, Constant
 from log import logger
 
@@ -18,10 +23,28 @@ class ConfigServer:
         self.minor = Constant.MINOR_VERSION
         self.src_type = Constant.METADATA_TYPE
         self.dst_type = Constant.CONFIG_TYPE
-        self.src_id = int(Config.src_id, 16)
+        self.src_id = LOCAL_SRC_ID
         self.dst_id = int(Config.config_dst_id, 16)
 
+        # 与ConfigServer的连接在init()启动的心跳线程中建立，导入本模块时不连接
+        self.sock = None
+        self._connected = threading.Event()
+
+    def init(self, conf_info):
+        """
+        @:在主进程中启动接收线程和心跳线程，不等待与ConfigServer的连接建立，ConfigServer不可用时不阻塞启动
+        @:返回(接收线程, 心跳线程)
+        """
+        recv_thread = threading.Thread(target=self.conf_read,
+                                       args=(conf_info,))
+        recv_thread.start()
+        hb_thread = threading.Thread(target=self.send_hb)
+        hb_thread.start()
+        return recv_thread, hb_thread
+
+    def connect(self):
         self.sock = self._generate_conf_sock()
+        self._connected.set()
 
     def _generate_conf_sock(self):
         HOST = Config.config_server_ip
@@ -101,10 +124,9 @@ class ConfigServer:
         total_size = total + Constant.HEAD_LENGTH
         command = Constant.CONFIG_HB
         header = [total_size, self.major, self.minor, self.src_type,
-                  self.dst_type, self.src_id, self.dst_id, command,
-                  total, count]
-        fmt_head = '!I4BII16xI4xQ8xI4x'
-        head_pack = struct.pack(fmt_head, *header)
+                  self.dst_type, self.src_id, self.dst_id, 0, 0, command, 0,
+                  total, 0, count]
+        head_pack = HEAD.pack(*header)
         logger.info("发送给ConfigServer的心跳header:{}".format(header))
         data = head_pack + body_pack
         return data
@@ -136,6 +158,8 @@ class ConfigServer:
     def send_hb(self):
         """
         """
+        if self.sock is None:
+            self.connect()
         while True:
             logger.info('给config server定时发心跳:True')
             data = self.generate_hb()
@@ -170,10 +194,9 @@ class ConfigServer:
         command = Constant.CONFIG_QUERY
         trans_id = site_id          # 将Client的site_id放在trans_id字段
         header = [total_size, self.major, self.minor, self.src_type,
-                  self.dst_type, self.src_id, self.dst_id, trans_id,
-                  command, total, count]
-        fmt_head = '!I4BIIQ8xI4xQ8xI4x'
-        head_pack = struct.pack(fmt_head, *header)
+                  self.dst_type, self.src_id, self.dst_id, trans_id, 0,
+                  command, 0, total, 0, count]
+        head_pack = HEAD.pack(*header)
         logger.info("向ConfigServer查询的消息的head:{}".format(header))
         logger.info("向ConfigServer查询的消息的body:{}".format(body_json))
         data = head_pack + body_pack
@@ -210,15 +233,15 @@ class ConfigServer:
 
     def conf_read(self, conf_info):
         logger.info('执行conf_read,接收ConfigServer返回的消息')
+        self._connected.wait()
         while True:
-            fmt_head = Constant.FMT_COMMON_HEAD
             try:
                 header = self.recvall(Constant.HEAD_LENGTH)
-                head_unpack = struct.unpack(fmt_head, header)
+                head_unpack = unpack_header(header)
             except struct.error:
                 self.sock.close()
             else:
-                total_size = head_unpack[0]
+                total_size = head_unpack.total_size
                 body_size = total_size - Constant.HEAD_LENGTH
                 try:
                     body = self.recvall(body_size)
@@ -241,10 +264,10 @@ class ConfigServer:
         "file_md5": file_md5}
         """
         logger.info('执行data_handler,处理ConfigServer返回的消息')
-        trans_id = head_unpack[7]
+        trans_id = head_unpack.trans_id
         site_id = trans_id
         key = str(site_id)
-        command = head_unpack[9]
+        command = head_unpack.command
 
         if command == Constant.CONFIG_HB_RESP:
             logger.info('收到ConfigServer心跳回复消息')
@@ -252,16 +275,16 @@ class ConfigServer:
 
         elif command == Constant.CONFIG_QUERY_RESP:
             """
-            @:以str(site_id)为键,收到的查询消息为值放到字典conf_info中。
+            @:以str(site_id)为键,(收到的查询消息, 收到的时间)为值放到字典conf_info中，见app.confcache
             """
             logger.info('收到ConfigServer回复的查询消息')
             body_unpack = json.loads(body.decode('utf-8'))
-            conf_info[key] = body_unpack
+            conf_info[key] = (body_unpack, time.time())
 
         elif command == Constant.CONFIG_INFO:
             logger.info('配置有变更，ConfigServer主动下发通知')
             body_unpack = json.loads(body.decode('utf-8'))
-            conf_info[key] = body_unpack
+            conf_info[key] = (body_unpack, time.time())
             
             from app.tcpserver import version_info
             body_version = {}
@@ -275,17 +298,131 @@ class ConfigServer:
             logger.info('接受ConfigServer消息有误')
 
 
+class ConfigClient:
+    """
+    @:工作进程向ConfigServer查询站点配置的客户端，每个工作进程一份
+    @:查询经过长连接池(RemotePool)发送，每条连接一个读线程，
+    @:发送时为每个请求分配唯一的trans_id，按trans_id把回复交给对应的Future，不同site的查询不会互相抢回复
+    @:同一个site同时只有一个在途查询，并发的查询共用同一个Future
+    @:建立连接和发送在后台线程池中进行，query立即返回Future，调用线程不会阻塞在连接超时上
+    @:连接ConfigServer失败后connect_backoff秒内的查询直接以None结束，不再反复尝试连接
+    @:ConfigServer主动推送的CONFIG_INFO仍由主进程的ConfigServer连接(conf_read)接收
+    """
+
+    def __init__(self):
+        self.key = (Config.config_server_ip, int(Config.config_server_port),
+                    Config.config_dst_id)
+        self.timeout = Config.config_query_timeout
+        self._pool = RemotePool(max_per_host=Config.config_pool_size,
+                                timeout=self.timeout, name='config_client')
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.backoff = Config.config_connect_backoff
+        self._down_until = 0
+
+    def _get_executor(self):
+        """
+        @:线程池不会随fork进入子进程，每个工作进程第一次查询时创建
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._executor = ThreadPoolExecutor(
+                        Config.config_pool_size,
+                        thread_name_prefix='config_client')
+                    self._pid = pid
+        return self._executor
+
+    def query(self, site_id, callback=None):
+        """
+        @:查询site的配置，返回Future，结果为body_unpack，查询失败或超时为None
+        @:callback(body_unpack)在收到回复后、Future完成前调用一次，只在真正发出查询时注册，
+        @:与正在进行的查询合并时忽略
+        """
+        if time.time() < self._down_until:
+            metrics.incr('config_client.backoff')
+            future = Future()
+            future.set_result(None)
+            return future
+        with self._lock:
+            future = self._inflight.get(site_id)
+            if future is not None:
+                metrics.incr('config_client.coalesced')
+                return future
+            future = self._inflight[site_id] = Future()
+        metrics.incr('config_client.query')
+        try:
+            self._get_executor().submit(self._send, site_id, future, callback)
+        except Exception:
+            self._send_failed(site_id, future)
+        return future
+
+    def _send(self, site_id, future, callback):
+        """
+        @:在线程池中取连接(必要时建立连接)并发送查询，回复由_done处理
+        """
+        try:
+            reply = self._pool.submit(self.key,
+                                      config_server.generate_msg(site_id))
+        except Exception:
+            self._send_failed(site_id, future)
+            return
+        if reply.done() and reply.result() is None:
+            # RemotePool取不到连接时返回已经结束的Future
+            logger.error('连接ConfigServer失败，{}秒内不再查询'.format(self.backoff))
+            metrics.incr('config_client.down')
+            self._down_until = time.time() + self.backoff
+        reply.add_done_callback(
+            lambda reply: self._done(site_id, future, reply.result(), callback))
+
+    def _send_failed(self, site_id, future):
+        """
+        @:没有发出查询，结束在途的Future，否则之后对该site的查询都会合并到这个永远不完成的Future上
+        """
+        logger.exception('向ConfigServer发送site_id:{}的查询失败'.format(site_id))
+        metrics.incr('config_client.send_failed')
+        with self._lock:
+            self._inflight.pop(site_id, None)
+        future.set_result(None)
+
+    def _done(self, site_id, future, result, callback):
+        body_unpack = None
+        if result is None:
+            logger.error('向ConfigServer查询site_id:{}的配置超时'.format(site_id))
+        else:
+            head_unpack, body = result
+            if head_unpack.command == Constant.CONFIG_QUERY_RESP:
+                try:
+                    body_unpack = json.loads(body.decode('utf-8'))
+                except ValueError:
+                    logger.error('ConfigServer回复的配置无法解析')
+            else:
+                logger.error('ConfigServer回复了未知的命令字:{}'.format(
+                    head_unpack.command))
+        with self._lock:
+            self._inflight.pop(site_id, None)
+        if callback is not None and body_unpack is not None:
+            try:
+                callback(body_unpack)
+            except:
+                logger.exception('处理ConfigServer回复的配置出错')
+        future.set_result(body_unpack)
+
+
 config_server = ConfigServer()
+config_client = ConfigClient()
 
 def query(conf_info, site_id):
     for i in range(Constant.try_times):
         logger.info('第{}次发送查询信息'.format(i+1))
         config_server.send_msg(site_id)
         key = str(site_id)
-        body_unpack = conf_info.get(key)
-        if body_unpack:
-            conf_info.pop(key)
-            logger.info(body_unpack)
+        entry = conf_info.get(key)
+        if entry:
+            logger.info(entry[0])
             break
         else:
             logger.info('延时1秒发送查询请求')
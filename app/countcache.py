@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import mmap
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from app.metrics import metrics
+from config import Config
+
+
+class CountCache:
+    """
+    @:查询记录数量的结果缓存，每个工作进程一份，按LRU淘汰，超过ttl秒的结果视为过期
+    @:key由规范化后的查询条件组成(site、排序后的id列表、时间范围)，分页时重复的计数请求不再执行COUNT(*)
+    @:失效：每个site对应一个generation，保存在fork之前创建的匿名共享内存(mmap)中，
+    @:任一工作进程写入或删除某个site的记录后把它加1，缓存中generation不一致的结果即失效
+    @:site_id按slots取模映射到generation，冲突只会多失效一些缓存
+    @:远端region的记录数量无法感知变化，只依赖ttl过期
+    """
+    GENERATION = struct.Struct('=Q')
+
+    def __init__(self, max_entries=None, ttl=None, slots=None):
+        self.max_entries = max_entries or Config.count_cache_max_entries
+        self.ttl = ttl or Config.count_cache_ttl
+        self.slots = slots or Config.count_cache_slots
+        self._mm = mmap.mmap(-1, self.GENERATION.size * self.slots)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _offset(self, site_id):
+        return self.GENERATION.size * (hash(site_id) % self.slots)
+
+    def generation(self, site_id):
+        """
+        @:计数之前先取generation，计数期间发生的写入会使这次的结果在下次读取时失效
+        """
+        return self.GENERATION.unpack_from(self._mm, self._offset(site_id))[0]
+
+    def invalidate(self, site_ids):
+        """
+        @:site的记录有写入或删除，使所有进程中该site的计数缓存失效
+        @:不加锁，并发加1时丢失一次也能保证generation发生了变化
+        """
+        for site_id in set(site_ids):
+            offset = self._offset(site_id)
+            generation = self.GENERATION.unpack_from(self._mm, offset)[0]
+            self.GENERATION.pack_into(self._mm, offset, generation + 1)
+        metrics.incr('count_cache.invalidate')
+
+    @staticmethod
+    def key(kind, body_unpack):
+        """
+        @:规范化查询条件，id列表去重排序，与顺序无关；过滤条件只使用第一个site_id
+        """
+        def normalize(values):
+            return tuple(sorted(set(values or []), key=repr))
+
+        timestamp = body_unpack.get('timestamp') or []
+        return (kind, (body_unpack.get('site_id') or [None])[0],
+                normalize(body_unpack.get('app_id')),
+                normalize(body_unpack.get('user_id')),
+                normalize(body_unpack.get('customer_id')),
+                tuple(timestamp[: 2]))
+
+    def get(self, key, site_id):
+        """
+        @:返回缓存的记录数量，不存在、过期或已失效时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                count, generation, expires = entry
+                if (generation == self.generation(site_id) and
+                        expires > time.time()):
+                    self._entries.move_to_end(key)
+                    metrics.incr('count_cache.hit')
+                    return count
+                del self._entries[key]
+        metrics.incr('count_cache.miss')
+        return None
+
+    def put(self, key, generation, count):
+        """
+        @:generation为计数之前调用generation()取到的值
+        """
+        with self._lock:
+            self._entries[key] = (count, generation, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            metrics.gauge('count_cache.entries', len(self._entries))
+
+
+count_cache = CountCache()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import time
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from app.metrics import metrics
+from config import Config
+
+
+class TimedQueuePool(QueuePool):
+    """
+    @:记录取连接等待耗时的QueuePool
+    @:db.{name}.checkout_wait：从池中取连接的耗时(包括池满时的等待和新建连接)
+    @:db.{name}.checkout_timeout：等待超过pool_timeout的次数
+    @:db.{name}.checkedout：当前被取出的连接数
+    """
+    name = 'primary'
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            metrics.incr('db.{}.checkout_timeout'.format(self.name))
+            raise
+        metrics.observe('db.{}.checkout_wait'.format(self.name),
+                        time.time() - start)
+        metrics.gauge('db.{}.checkedout'.format(self.name), self.checkedout())
+        return conn
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        metrics.gauge('db.{}.checkedout'.format(self.name), self.checkedout())
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.name = self.name
+        return pool
+
+
+def create_pooled_engine(conn_str, name='primary'):
+    """
+    @:按meta.ini中[mysql_pool]的配置创建engine，连接池指标以name区分
+    @:engine和连接池不能跨fork共享，每个工作进程各自调用
+    """
+    connect_args = {}
+    if make_url(conn_str).get_backend_name() == 'mysql':
+        for key in ('connect_timeout', 'read_timeout', 'write_timeout'):
+            value = getattr(Config, 'db_' + key)
+            if value:
+                connect_args[key] = value
+    engine = create_engine(conn_str, poolclass=TimedQueuePool,
+                           pool_size=Config.db_pool_size,
+                           max_overflow=Config.db_max_overflow,
+                           pool_timeout=Config.db_pool_timeout,
+                           pool_recycle=Config.db_pool_recycle,
+                           pool_pre_ping=Config.db_pool_pre_ping,
+                           connect_args=connect_args)
+    engine.pool.name = name
+    return engine
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+from app.dbpool import create_pooled_engine
+from app.metrics import metrics
+from config import Config
+from log import logger
+
+
+class Replica:
+
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        # None表示还没有检查过，第一次健康检查通过之前不使用
+        self.healthy = None
+
+    def load(self):
+        """
+        @:当前取出的连接数，用于选择负载最小的副本
+        """
+        return self.engine.pool.checkedout()
+
+
+class DbRouter:
+    """
+    @:读写分离：写入(心跳、转存、删除)使用主库，session_scope(readonly=True)的查询发往[mysql_replicas]中的只读副本
+    @:选择：健康的副本中取出连接数最少的一个，相同时随机；没有配置或没有健康的副本时读主库
+    @:健康检查：后台线程每隔health_interval秒在每个副本上执行SELECT 1，检查通过的副本才使用
+    @:读己之写：site最近recent_write秒内有写入时，该site的查询读主库，避免复制延迟导致刚写入的记录查不到，
+    @:写入时间保存在fork之前创建的匿名共享内存(mmap)中，所有工作进程可见，site_id按slots取模映射
+    @:副本的engine和健康检查线程不会随fork进入子进程，每个工作进程第一次读副本时创建
+    """
+    LAST_WRITE = struct.Struct('=d')
+
+    def __init__(self, conn_strs=None, health_interval=None, recent_write=None,
+                 slots=None):
+        self.conn_strs = Config.db_replicas if conn_strs is None else conn_strs
+        self.health_interval = (health_interval or
+                                Config.db_replica_health_interval)
+        self.recent_write = (Config.db_recent_write if recent_write is None
+                             else recent_write)
+        self.slots = slots or Config.db_recent_write_slots
+        self._mm = mmap.mmap(-1, self.LAST_WRITE.size * self.slots)
+        self._replicas = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _offset(self, site_id):
+        return self.LAST_WRITE.size * (hash(site_id) % self.slots)
+
+    def mark_write(self, site_ids):
+        """
+        @:site的记录已提交写入，recent_write秒内该site的查询读主库
+        """
+        if not self.recent_write:
+            return
+        now = time.time()
+        for site_id in set(site_ids):
+            self.LAST_WRITE.pack_into(self._mm, self._offset(site_id), now)
+
+    def _written_recently(self, site_id):
+        if site_id is None or not self.recent_write:
+            return False
+        last_write = self.LAST_WRITE.unpack_from(self._mm,
+                                                 self._offset(site_id))[0]
+        return time.time() - last_write < self.recent_write
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._replicas = [
+                Replica('replica{}'.format(i),
+                        create_pooled_engine(conn_str,
+                                             'replica{}'.format(i)))
+                for i, conn_str in enumerate(self.conn_strs)]
+            self._pid = os.getpid()
+            t = threading.Thread(target=self._run, name='db_router')
+            t.daemon = True
+            t.start()
+
+    def read_engine(self, site_id=None):
+        """
+        @:返回执行只读查询的副本engine，应当读主库时返回None
+        """
+        if not self.conn_strs:
+            return None
+        if self._written_recently(site_id):
+            metrics.incr('db.router.recent_write')
+            return None
+        self._ensure_started()
+        healthy = [replica for replica in self._replicas if replica.healthy]
+        if not healthy:
+            metrics.incr('db.router.fallback')
+            return None
+        replica = min(healthy, key=lambda replica: (replica.load(),
+                                                    random.random()))
+        metrics.incr('db.{}.reads'.format(replica.name))
+        return replica.engine
+
+    def check(self, replica):
+        """
+        @:在副本上执行SELECT 1，返回是否可用
+        """
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute('SELECT 1')
+        except Exception:
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            for replica in self._replicas:
+                healthy = self.check(replica)
+                if healthy != replica.healthy:
+                    if healthy:
+                        logger.info('只读副本{}可用'.format(replica.name))
+                    else:
+                        logger.error('只读副本{}健康检查失败，查询改读主库或其他副本'
+                                     .format(replica.name))
+                replica.healthy = healthy
+                metrics.gauge('db.{}.healthy'.format(replica.name),
+                              int(healthy))
+            time.sleep(self.health_interval)
+
+
+db_router = DbRouter()
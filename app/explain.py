@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:对metadata_info的典型查询执行EXPLAIN，检查是否用到了复合索引
+@:用法：python3 -m app.explain --site-id 1 --app-id 1 2 --user-id 1 \
+    --customer-id c1 --start 0 --end 2000000000
+"""
+import argparse
+
+from sqlalchemy import and_, func, select
+
+from app.models import get_engine, metadata_info
+
+
+def canonical_queries(site_id, app_id, user_id, customer_id, start, end):
+    """
+    @:与Client中查询、计数、删除路径的过滤条件相同的语句
+    @:返回：[(name, statement), ...]
+    """
+    t = metadata_info.c
+    query_filter = and_(t.site_id == site_id,
+                        t.app_id.in_(app_id),
+                        t.user_id.in_(user_id),
+                        t.customer_id.in_(customer_id),
+                        t.timestamp.between(start, end))
+    file_filter = and_(t.site_id == site_id, t.timestamp.between(start, end))
+    delete_filter = and_(t.site_id == site_id,
+                         t.app_id == app_id[0],
+                         t.user_id == user_id[0],
+                         t.customer_id == customer_id[0],
+                         t.timestamp == start)
+    return [
+        ('query_data', select([metadata_info]).where(query_filter)
+         .order_by(t.timestamp)),
+        ('query_num', select([func.count()]).select_from(metadata_info)
+         .where(query_filter)),
+        ('file_query_data', select([metadata_info]).where(file_filter)
+         .order_by(t.timestamp)),
+        ('file_query_num', select([func.count()]).select_from(metadata_info)
+         .where(file_filter)),
+        ('delete', select([t.id]).where(delete_filter)),
+    ]
+
+
+def explain(statement, bind=None):
+    """
+    @:返回EXPLAIN的结果：(列名, 行列表)
+    """
+    bind = bind or get_engine()
+    sql = statement.compile(dialect=bind.dialect,
+                            compile_kwargs={'literal_binds': True})
+    result = bind.execute('EXPLAIN {}'.format(sql))
+    return result.keys(), result.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='metadata_info查询执行计划')
+    parser.add_argument('--site-id', type=int, required=True)
+    parser.add_argument('--app-id', type=int, nargs='+', default=[1])
+    parser.add_argument('--user-id', type=int, nargs='+', default=[1])
+    parser.add_argument('--customer-id', nargs='+', default=[''])
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--end', type=int, default=2 ** 31 - 1)
+    args = parser.parse_args()
+
+    for name, statement in canonical_queries(args.site_id, args.app_id,
+                                             args.user_id, args.customer_id,
+                                             args.start, args.end):
+        keys, rows = explain(statement)
+        print('== {} =='.format(name))
+        print(statement.compile(dialect=get_engine().dialect,
+                                compile_kwargs={'literal_binds': True}))
+        for row in rows:
+            print(dict(zip(keys, row)))
+        print()
+
+
+if __name__ == '__main__':
+    main()
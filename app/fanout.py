@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from app.metrics import metrics
+from config import Config
+from log import logger
+
+
+class FanOut:
+    """
+    @:并发请求site的各个历史region上的RemoteMetadataServer，总耗时取决于最慢的region而不是所有region之和
+    @:每个region的连接、收发超时由任务自己设置(Config.remote_timeout)，
+    @:run()最多等待deadline秒，超时或出错的region不影响其他region的结果(部分结果)
+    @:线程池不会随fork进入子进程，每个工作进程第一次使用时创建
+    """
+
+    def __init__(self, max_workers=None, deadline=None):
+        self.max_workers = max_workers or Config.remote_max_workers
+        self.deadline = deadline or Config.remote_deadline
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._executor = ThreadPoolExecutor(self.max_workers)
+                    self._pid = pid
+        return self._executor
+
+    def submit(self, tasks):
+        """
+        @:tasks: {region_id: (func, args)}，在线程池中并发执行func(*args)，立即返回
+        @:调用方可以先处理本地查询，再用collect()收集结果
+        """
+        executor = self._get_executor()
+        futures = {executor.submit(func, *args): region_id
+                   for region_id, (func, args) in tasks.items()}
+        return futures, time.time()
+
+    def collect(self, pending, deadline=None):
+        """
+        @:等待submit()提交的请求，从提交时算起最多等待deadline秒
+        @:返回按时成功完成的结果{region_id: result}，func返回None或抛出异常视为失败
+        """
+        futures, start = pending
+        if not futures:
+            return {}
+        remaining = (deadline or self.deadline) - (time.time() - start)
+        done, not_done = wait(futures, timeout=max(remaining, 0))
+        results = {}
+        for future in done:
+            region_id = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception('请求region {}的RemoteMetadataServer出错'.format(
+                    region_id))
+                result = None
+            if result is None:
+                metrics.incr('fanout.failed')
+                logger.error('请求region {}的RemoteMetadataServer失败'.format(
+                    region_id))
+                continue
+            results[region_id] = result
+        for future in not_done:
+            future.cancel()
+            metrics.incr('fanout.timeout')
+            logger.error('请求region {}的RemoteMetadataServer超时'.format(
+                futures[future]))
+        if len(results) < len(futures):
+            metrics.incr('fanout.partial')
+        metrics.observe('fanout.latency', time.time() - start)
+        return results
+
+    def run(self, tasks, deadline=None):
+        """
+        @:并发执行tasks并等待结果，见submit()和collect()
+        """
+        if not tasks:
+            return {}
+        return self.collect(self.submit(tasks), deadline)
+
+fanout = FanOut()
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import os
+import select
+import socket
+import threading
+import weakref
+
+from app.metrics import metrics
+from app.protocol import HEAD, Header
+from config import Constant
+
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+_send_locks = weakref.WeakKeyDictionary()
+_send_locks_guard = threading.Lock()
+
+
+class FrameError(Exception):
+    """
+    @:消息头中的total_size非法，无法继续拆分消息帧
+    """
+
+
+class FrameBuffer:
+    """
+    @:每个连接独立的接收缓冲区，由selector驱动，按公共消息头中的total_size拆分完整消息帧
+    @:状态机：
+    HEAD_PENDING(等待64字节消息头) -> BODY_PENDING(等待消息体) -> READY(已缓存完整帧)
+    @:接收数据直接recv_into到复用的bytearray中，只有完整帧才交给data_handler处理
+    """
+    HEAD_PENDING = 0
+    BODY_PENDING = 1
+    READY = 2
+
+    def __init__(self, bufsize=Constant.BUFSIZE):
+        self._bufsize = bufsize
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0             # 当前帧在缓冲区中的起始位置
+        self._end = 0               # 已接收数据在缓冲区中的结束位置
+        self.state = self.HEAD_PENDING
+        self.head_unpack = None
+        self.total_size = 0
+
+    def _pending(self):
+        """
+        @:完成当前状态还需要接收的字节数
+        """
+        avail = self._end - self._start
+        if self.state == self.BODY_PENDING:
+            return max(self.total_size - avail, 1)
+        return max(Constant.HEAD_LENGTH - avail, 1)
+
+    def _reserve(self, need):
+        """
+        @:保证缓冲区尾部至少有need字节的空闲空间，先前移未处理的数据，不够再扩容
+        """
+        if len(self._buf) - self._end >= need:
+            return
+        avail = self._end - self._start
+        if self._start:
+            self._buf[:avail] = bytes(self._view[self._start: self._end])
+            self._start = 0
+            self._end = avail
+        lack = need - (len(self._buf) - self._end)
+        if lack > 0:
+            self._view.release()
+            self._buf.extend(bytes(lack))
+            self._view = memoryview(self._buf)
+
+    def _reset(self):
+        """
+        @:缓冲区中的数据已全部处理，复位读写位置，超大帧撑大的缓冲区缩回初始大小
+        """
+        self._start = self._end = 0
+        if len(self._buf) > 16 * self._bufsize:
+            self._view.release()
+            self._buf = bytearray(self._bufsize)
+            self._view = memoryview(self._buf)
+
+    def recv_from(self, conn):
+        """
+        @:连接可读时调用一次，将数据接收到缓冲区中，不会在非阻塞socket上自旋等待
+        @:返回False表示对端已关闭连接
+        """
+        self._reserve(self._pending())
+        try:
+            nbytes = conn.recv_into(self._view[self._end:])
+        except (BlockingIOError, InterruptedError):
+            return True
+        if not nbytes:
+            return False
+        self._end += nbytes
+        return True
+
+    def feed(self, data):
+        """
+        @:将已经收到的数据追加到缓冲区中(用于asyncio等由外部收数据的场景)
+        """
+        size = len(data)
+        self._reserve(size)
+        self._buf[self._end: self._end + size] = data
+        self._end += size
+
+    def _advance(self):
+        """
+        @:根据已缓存的数据推进状态机
+        """
+        avail = self._end - self._start
+        if self.state == self.HEAD_PENDING and avail >= Constant.HEAD_LENGTH:
+            head_unpack = Header._make(HEAD.unpack_from(self._buf,
+                                                        self._start))
+            total_size = head_unpack.total_size
+            if (total_size < Constant.HEAD_LENGTH or
+                    total_size > Constant.MAX_FRAME_SIZE):
+                raise FrameError('消息头中的total_size非法:{}'.format(total_size))
+            self.head_unpack = head_unpack
+            self.total_size = total_size
+            self.state = self.BODY_PENDING
+        if self.state == self.BODY_PENDING and avail >= self.total_size:
+            self.state = self.READY
+
+    def peek(self):
+        """
+        @:返回缓冲区中下一个完整消息帧的消息头，不取出该帧，数据不足时返回None
+        """
+        self._advance()
+        if self.state != self.READY:
+            return None
+        return self.head_unpack
+
+    def next_frame(self):
+        """
+        @:取出一个完整的消息帧(head_unpack, body)，数据不足时返回None
+        """
+        self._advance()
+        if self.state != self.READY:
+            return None
+        body_start = self._start + Constant.HEAD_LENGTH
+        frame_end = self._start + self.total_size
+        body = bytes(self._view[body_start: frame_end])
+        head_unpack = self.head_unpack
+
+        self._start = frame_end
+        if self._start == self._end:
+            self._reset()
+        self.state = self.HEAD_PENDING
+        self.head_unpack = None
+        self.total_size = 0
+        return head_unpack, body
+
+    def frames(self):
+        """
+        @:依次取出缓冲区中所有完整的消息帧
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                break
+            yield frame
+
+
+def send_lock(conn):
+    """
+    @:连接的发送锁，同一连接上的多个请求被不同线程并发处理时(多路复用的RemoteMetadataServer长连接)，
+    @:持有该锁写出整条回复，避免各线程的回复字节交错
+    @:send_buffers内部会获取该锁；可重入，调用方需要连续写出多帧时可以在外层持有
+    """
+    with _send_locks_guard:
+        lock = _send_locks.get(conn)
+        if lock is None:
+            lock = _send_locks[conn] = threading.RLock()
+        return lock
+
+
+def send_buffers(conn, buffers, timeout=Constant.TIME):
+    """
+    @:用sendmsg把多个缓冲区一次写出(scatter/gather)，不拼接成一个连续的bytes
+    @:非阻塞连接上处理部分写入：跳过已经写完的缓冲区，写了一部分的缓冲区用memoryview切片后继续写；
+    @:发送缓冲区满时poll等待可写，超过timeout秒仍不可写抛出socket.timeout
+    @:每次sendmsg最多传入IOV_MAX个缓冲区
+    @:asyncio引擎下的连接没有sendmsg，交给transport.writelines
+    @:整个写出过程持有send_lock(conn)，其他线程的回复不会插在部分写入的帧中间；
+    @:帧只写出一部分就失败时关闭连接的写方向，对端不会把后续的数据拼到半个帧后面
+    """
+    with send_lock(conn):
+        if not hasattr(conn, 'sendmsg'):
+            conn.writelines(buffers)
+            return
+        views = [memoryview(buf) for buf in buffers if len(buf)]
+        start = 0
+        poller = None
+        written = False
+        try:
+            while start < len(views):
+                try:
+                    sent = conn.sendmsg(views[start: start + IOV_MAX])
+                except (BlockingIOError, InterruptedError):
+                    if poller is None:
+                        poller = select.poll()
+                        poller.register(conn, select.POLLOUT)
+                    metrics.incr('tcp.send_blocked')
+                    if not poller.poll(timeout * 1000):
+                        raise socket.timeout('等待连接可写超时')
+                    continue
+                written = written or sent > 0
+                while start < len(views) and sent >= views[start].nbytes:
+                    sent -= views[start].nbytes
+                    start += 1
+                if sent:
+                    views[start] = views[start][sent:]
+        except Exception:
+            if written and start < len(views):
+                metrics.incr('tcp.send_partial')
+                try:
+                    conn.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+            raise
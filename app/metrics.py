@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import threading
+
+
+class Metrics:
+    """
+    @:进程内的运行指标，包括计数器、瞬时值和耗时统计
+    @:每个工作进程各自一份，通过snapshot()取出后写日志或汇总到主进程
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}           # {name: [count, total, max]}
+
+    def incr(self, name, value=1):
+        """
+        @:计数器累加
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        @:记录瞬时值，如队列长度
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        """
+        @:记录一次耗时
+        """
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def snapshot(self):
+        """
+        @:取出当前所有指标
+        @:数据结构为：{name: value, ..., timer_name: {'count': n, 'avg': s, 'max': s}}
+        """
+        with self._lock:
+            snap = dict(self._counters)
+            snap.update(self._gauges)
+            for name, (count, total, max_seconds) in self._timers.items():
+                snap[name] = {'count': count,
+                              'avg': total / count,
+                              'max': max_seconds}
+        return snap
+
+    def reset(self):
+        """
+        @:清空指标，子进程启动后调用，避免带上父进程的数据
+        """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timers.clear()
+
+
+metrics = Metrics()
@@ -1,15 +1,23 @@
 '''Created on 2017年12月26日@author: litian'''
+import os
+import threading
 from contextlib import contextmanager
 from sqlalchemy import (Column, Table, MetaData, String, SmallInteger, Boolean,
-                        Integer, BigInteger, create_engine, ForeignKey)
+                        Integer, BigInteger, ForeignKey, Index,
+                        inspect)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+from app.dbpool import create_pooled_engine
+from app.dbrouter import db_router
 from config import Config
+from log import logger
 
-db_conn_str = Config.db_conn_str
-engine = create_engine(db_conn_str)
-metadata = MetaData(engine)
+engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+metadata = MetaData()
+SessionType = scoped_session(sessionmaker())
  
 client_status = Table('client_status', metadata,
                       Column('id', Integer, primary_key=True),
@@ -69,9 +77,65 @@ metadata_info = Table('metadata_info', metadata,
                  Column('group_id', Integer),
                  Column('user_id', Integer),
                  Column('customer_id', String(32)),
-                 Column('timestamp', Integer))
- 
-metadata.create_all(engine)
+                 Column('timestamp', Integer),
+                 # 查询、计数、删除都以site_id等值过滤，timestamp范围过滤放在索引最后一列
+                 Index('ix_metadata_info_site_ts', 'site_id', 'timestamp'),
+                 Index('ix_metadata_info_site_app_user_ts', 'site_id',
+                       'app_id', 'user_id', 'timestamp'))
+
+
+def init_engine():
+    """
+    @:创建本进程的数据库engine，导入本模块时不连接数据库，第一次使用时才创建
+    @:连接池中的MySQL连接不能在fork出的进程间共享，进程号变化后(工作进程中)重新创建engine，
+    @:不dispose继承来的engine，避免关闭父进程仍在使用的连接
+    """
+    global engine, _engine_pid
+    with _engine_lock:
+        if _engine_pid != os.getpid():
+            engine = create_pooled_engine(Config.db_conn_str)
+            _engine_pid = os.getpid()
+            metadata.bind = engine
+            SessionType.configure(bind=engine)
+            logger.info('当前连接的数据库信息为：{!r}，连接池大小:{}'.format(
+                engine.url, Config.db_pool_size))
+    return engine
+
+
+def get_engine():
+    if _engine_pid == os.getpid():
+        return engine
+    return init_engine()
+
+
+def migrate_indexes(bind=None):
+    """
+    @:create_all不会给已存在的表补建索引，这里对比数据库中已有的索引，创建缺少的索引
+    @:返回新创建的索引名列表
+    """
+    bind = bind or get_engine()
+    inspector = inspect(bind)
+    created = []
+    for table in metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('表{}缺少索引{}，开始创建'.format(table.name,
+                                                        index.name))
+                index.create(bind)
+                created.append(index.name)
+    return created
+
+
+def check_schema(bind=None):
+    """
+    @:建表并补建缺少的索引，tcpserver启动时在主进程fork之前执行一次，--skip-schema-check跳过
+    @:返回新创建的索引名列表
+    """
+    bind = bind or get_engine()
+    metadata.create_all(bind)
+    return migrate_indexes(bind)
+
 
 Base = declarative_base()
 
@@ -134,24 +198,25 @@ class MetadataStatus(Base):
     
 
 class MetadataInfo(Base):
-    __tablename__ = 'metadata_info'
-    
-    id = Column(Integer, primary_key=True)
-    site_id = Column(Integer)
-    app_id = Column(Integer)
-    file_name = Column(String(512))
-    region_id = Column(SmallInteger)
-    system_id = Column(Integer)
-    group_id = Column(Integer)
-    user_id = Column(Integer)
-    customer_id = Column(String(32))
-    timestamp = Column(Integer)
+    # 映射到上面的metadata_info表，列和索引只在一处定义，check_schema按它建表、补建索引
+    __table__ = metadata_info
     
     
-SessionType = scoped_session(sessionmaker(bind=engine))  
-
 @contextmanager
-def session_scope():  
+def session_scope(readonly=False, site_id=None):  
+    """
+    @:readonly为True时只读查询，由db_router选择只读副本，不提交
+    @:写入时传入site_id，提交后该site在一段时间内的查询读主库，见app.dbrouter
+    """
+    primary = get_engine()
+    if readonly:
+        session = SessionType.session_factory(
+            bind=db_router.read_engine(site_id) or primary)
+        try:
+            yield session
+        finally:
+            session.close()
+        return
     session = SessionType()
     try:
         yield session
@@ -160,27 +225,7 @@ def session_scope():
         session.rollback()
         raise
     finally:
-        session.close()
-        
-    
-    
-    
-    
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        # 不在线程中保留session，fork之后不会用到绑定在父进程engine上的session
+        SessionType.remove()
+    if site_id is not None:
+        db_router.mark_write([site_id])
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import itertools
+import os
+import select
+import socket
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from app.framing import FrameBuffer, FrameError, send_buffers
+from app.metrics import metrics
+from app.protocol import HEAD, unpack_header
+from config import Config
+from log import logger
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class MuxConnection:
+    """
+    @:到一个服务端(RemoteMetadataServer、ConfigServer)的长连接，多个请求可以同时在途
+    @:发送前把消息头中的trans_id改写为本连接内唯一的值，读线程按(trans_id, sequence)把回复交给对应请求的Future，
+    @:Future的结果中恢复原来的trans_id
+    @:读线程发现连接断开或数据出错时关闭连接，所有在途请求的结果立即为None；
+    @:超过期限仍未收到回复的请求由连接池的后台线程调用expire()结束
+    @:socket为非阻塞模式：读线程用poll等待可读，发送由send_buffers在timeout秒内完成，
+    @:对端不再读取时发送超时并关闭连接，不会一直持有发送锁阻塞该连接上的其他请求
+    """
+
+    def __init__(self, addr, timeout, name='remote_pool'):
+        self.addr = addr
+        self.name = name
+        self.sock = socket.create_connection(addr, timeout)
+        self.sock.setblocking(False)
+        self.closed = False
+        self.last_used = time.time()
+        self._trans_ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        t = threading.Thread(target=self._read_loop,
+                             name='{}-{}:{}'.format(name, *addr))
+        t.daemon = True
+        t.start()
+
+    def inflight(self):
+        return len(self._pending)
+
+    def _submit(self, data, timeout):
+        buf = bytearray(data)
+        head_unpack = unpack_header(buf)
+        future = Future()
+        with self._lock:
+            if self.closed:
+                future.set_result(None)
+                return None, future
+            key = (next(self._trans_ids), head_unpack.sequence)
+            self._pending[key] = (future, head_unpack.trans_id,
+                                  time.time() + timeout)
+        HEAD.pack_into(buf, 0, *head_unpack._replace(trans_id=key[0]))
+        try:
+            with self._send_lock:
+                send_buffers(self.sock, [buf], timeout)
+        except socket.error:
+            logger.error('向{}发送请求失败'.format(self.addr))
+            self.close()
+        self.last_used = time.time()
+        return key, future
+
+    def submit(self, data, timeout):
+        """
+        @:发送一条完整的请求消息，不等待回复
+        @:返回Future，结果为(head_unpack, body)，连接断开或超过timeout秒未收到回复时为None
+        """
+        return self._submit(data, timeout)[1]
+
+    def request(self, data, timeout):
+        """
+        @:发送一条完整的请求消息并等待回复
+        @:返回(head_unpack, body)，连接断开或超过timeout秒未收到回复返回None
+        """
+        key, future = self._submit(data, timeout)
+        try:
+            result = future.result(timeout)
+        except TimeoutError:
+            result = None
+            with self._lock:
+                self._pending.pop(key, None)
+        if result is None:
+            metrics.incr('{}.timeout'.format(self.name))
+        return result
+
+    def expire(self, now):
+        """
+        @:结束超过期限仍未收到回复的请求
+        """
+        with self._lock:
+            expired = [key for key, (_, _, deadline) in self._pending.items()
+                       if deadline < now]
+            futures = [self._pending.pop(key)[0] for key in expired]
+        for future in futures:
+            metrics.incr('{}.timeout'.format(self.name))
+            _set_result(future, None)
+
+    def _read_loop(self):
+        frame_buffer = FrameBuffer()
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        try:
+            while True:
+                poller.poll()
+                if not frame_buffer.recv_from(self.sock):
+                    break
+                for head_unpack, body in frame_buffer.frames():
+                    key = (head_unpack.trans_id, head_unpack.sequence)
+                    with self._lock:
+                        pending = self._pending.pop(key, None)
+                    if pending is None:
+                        # 请求已超时返回，丢弃迟到的回复
+                        metrics.incr('{}.late_reply'.format(self.name))
+                        continue
+                    future, trans_id = pending[: 2]
+                    _set_result(future, (head_unpack._replace(
+                        trans_id=trans_id), body))
+        except (socket.error, FrameError):
+            if not self.closed:
+                logger.exception('与{}的连接出错'.format(self.addr))
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        """
+        @:关闭连接并结束所有在途请求，调用方需持有self._lock
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for future, _, _ in self._pending.values():
+            _set_result(future, None)
+        self._pending.clear()
+        metrics.incr('{}.closed'.format(self.name))
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class RemotePool:
+    """
+    @:按(ip, port, src_id)分组的长连接池，每个工作进程一份
+    @:请求优先复用在途请求最少的连接，该连接忙且连接数未达到max_per_host时才新建连接
+    @:健康检查：读线程发现对端关闭或出错时连接立即失效，取连接时跳过；
+    @:后台线程每隔health_interval秒关闭空闲超过max_idle秒的连接，并结束超时的在途请求
+    """
+
+    def __init__(self, max_per_host=None, max_idle=None, health_interval=None,
+                 timeout=None, name='remote_pool'):
+        self.max_per_host = max_per_host or Config.remote_max_per_host
+        self.max_idle = max_idle or Config.remote_max_idle
+        self.health_interval = health_interval or Config.remote_health_interval
+        self.timeout = timeout or Config.remote_timeout
+        self.name = name
+        self._conns = {}
+        self._connecting = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pid = None
+
+    def _ensure_started(self):
+        """
+        @:连接和后台线程不会随fork进入子进程，在本进程第一次请求时重新初始化
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._conns = {}
+            self._connecting = {}
+            t = threading.Thread(target=self._run, name=self.name)
+            t.daemon = True
+            t.start()
+
+    def _acquire(self, key):
+        """
+        @:取一条可用的连接，必要时新建，连接失败返回None
+        """
+        self._ensure_started()
+        with self._cond:
+            while True:
+                conns = self._conns.setdefault(key, [])
+                conns[:] = [conn for conn in conns if not conn.closed]
+                conn = min(conns, key=MuxConnection.inflight, default=None)
+                connecting = self._connecting.get(key, 0)
+                full = len(conns) + connecting >= self.max_per_host
+                if conn is not None and (conn.inflight() == 0 or full):
+                    metrics.incr('{}.reused'.format(self.name))
+                    # 在池的锁内更新，后台线程不会把刚取出、还没有发送请求的连接当作空闲连接关闭
+                    conn.last_used = time.time()
+                    return conn
+                if not full:
+                    break
+                # 连接数已满且都还在建立中，等待其中一条建立完成
+                self._cond.wait(self.timeout)
+            self._connecting[key] = connecting + 1
+        new_conn = None
+        try:
+            new_conn = MuxConnection(key[:2], self.timeout, self.name)
+        except socket.error:
+            logger.error('该请求的地址{}无效，连接失败'.format(key[:2]))
+            metrics.incr('{}.connect_failed'.format(self.name))
+        finally:
+            with self._cond:
+                self._connecting[key] -= 1
+                if new_conn is not None:
+                    self._conns.setdefault(key, []).append(new_conn)
+                    metrics.incr('{}.created'.format(self.name))
+                self._cond.notify_all()
+        return new_conn or conn
+
+    def submit(self, key, data, timeout=None):
+        """
+        @:key: (ip, port, src_id)，data为完整的请求消息
+        @:返回Future，结果为(head_unpack, body)，连接失败、连接断开或超时为None
+        """
+        conn = self._acquire(key)
+        if conn is None:
+            future = Future()
+            future.set_result(None)
+            return future
+        return conn.submit(data, timeout or self.timeout)
+
+    def request(self, key, data, timeout=None):
+        """
+        @:key: (ip, port, src_id)，data为完整的请求消息
+        @:返回(head_unpack, body)，连接失败、连接断开或超时返回None
+        """
+        conn = self._acquire(key)
+        if conn is None:
+            return None
+        return conn.request(data, timeout or self.timeout)
+
+    def _run(self):
+        while True:
+            time.sleep(self.health_interval)
+            now = time.time()
+            idle = []
+            with self._lock:
+                conns_all = [conn for conns in self._conns.values()
+                             for conn in conns]
+                for conns in self._conns.values():
+                    for conn in conns:
+                        if (not conn.closed and conn.inflight() == 0 and
+                                now - conn.last_used > self.max_idle):
+                            idle.append(conn)
+                    conns[:] = [conn for conn in conns
+                                if not conn.closed and conn not in idle]
+                total = sum(len(conns) for conns in self._conns.values())
+            for conn in conns_all:
+                conn.expire(now)
+            for conn in idle:
+                conn.close()
+            metrics.gauge('{}.connections'.format(self.name), total)
+
+
+remote_pool = RemotePool()
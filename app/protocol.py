@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:消息编解码：预编译的struct.Struct、带字段名的公共消息头，以及在预分配缓冲区中构造消息的MessageBuffer
+@:TcpServer、Client、StorageGW、ConfigServer、StatusServer统一使用这里的编解码对象，
+@:不再在每条消息中重新解析格式字符串
+"""
+import struct
+from collections import namedtuple
+
+from config import Config, Constant
+
+
+# 公共消息头，字段顺序与Constant.FMT_COMMON_HEAD一致，仍然支持按下标访问
+Header = namedtuple('Header', ['total_size', 'major', 'minor', 'src_type',
+                               'dst_type', 'src_id', 'dst_id', 'trans_id',
+                               'sequence', 'command', 'ack_code', 'total',
+                               'offset', 'count'])
+
+HEAD = struct.Struct(Constant.FMT_COMMON_HEAD)
+TASKINFO_FIXED = struct.Struct(Constant.FMT_TASKINFO_FIXED)
+TASKINFO_SEND = struct.Struct(Constant.FMT_TASKINFO_SEND)
+CLIENT_HB = struct.Struct(Constant.FMT_CLIENT_HB)
+SGW_HB = struct.Struct(Constant.FMT_SGW_HB)
+REMOTE_ROWS_HEAD = struct.Struct(Constant.FMT_REMOTE_ROWS_HEAD)
+REMOTE_ROW = struct.Struct(Constant.FMT_REMOTE_ROW)
+
+# REMOTE_ROW中flags的取值，标记可以为空的列
+USER_ID_NULL = 0x01
+CUSTOMER_ID_NULL = 0x02
+
+# 本机的src_id，只在启动时解析一次
+LOCAL_SRC_ID = int(Config.src_id, 16)
+
+
+def unpack_header(buf, offset=0):
+    """
+    @:解析公共消息头，返回Header
+    """
+    return Header._make(HEAD.unpack_from(buf, offset))
+
+
+class MessageBuffer:
+    """
+    @:预先按消息总长度分配一个bytearray，消息体和消息头都用pack_into直接写入，
+    @:避免head_pack + body_pack逐段拼接产生的多次拷贝
+    """
+
+    def __init__(self, body_size):
+        self.buf = bytearray(HEAD.size + body_size)
+        self.offset = HEAD.size
+
+    def pack(self, codec, *values):
+        """
+        @:在当前位置写入一个定长结构
+        """
+        codec.pack_into(self.buf, self.offset, *values)
+        self.offset += codec.size
+
+    def write(self, data):
+        """
+        @:在当前位置写入变长数据
+        """
+        end = self.offset + len(data)
+        self.buf[self.offset: end] = data
+        self.offset = end
+
+    def finish(self, *fields):
+        """
+        @:写入消息头，fields为total_size之后的各字段，total_size为缓冲区长度
+        """
+        HEAD.pack_into(self.buf, 0, len(self.buf), *fields)
+        return self.buf
+
+
+def pack_remote_rows(rows, addr, columnar=False):
+    """
+    @:把查询结果打包为MetadataServer之间传输的二进制消息体，返回缓冲区列表，交给send_buffers
+    @:rows的每条记录为(id, site_id, app_id, file_name, region_id, user_id, customer_id, timestamp)，
+    @:addr为(sgw_ip, sgw_port, sgw_id)，所有记录相同，只在REMOTE_ROWS_HEAD中写一次
+    @:columnar为True时按列排列(FMT_REMOTE_COLUMNS)，否则按行(FMT_REMOTE_ROW)
+    """
+    rows = list(rows)
+    count = len(rows)
+    sgw_ip, sgw_port, sgw_id = addr
+    buffers = [REMOTE_ROWS_HEAD.pack(count, sgw_ip, sgw_port, sgw_id)]
+    names = []
+    customer_ids = []
+    flags = []
+    for (_, _, _, file_name, _, user_id, customer_id, _) in rows:
+        names.append(file_name.encode('utf-8'))
+        customer_ids.append(b'' if customer_id is None else
+                            customer_id.encode('utf-8'))
+        flags.append((USER_ID_NULL if user_id is None else 0) |
+                     (CUSTOMER_ID_NULL if customer_id is None else 0))
+    if columnar:
+        columns = list(zip(*rows)) if rows else [()] * 8
+        (row_ids, site_ids, app_ids, _, region_ids, user_ids, _,
+         timestamps) = columns
+        buffers.append(struct.pack(
+            Constant.FMT_REMOTE_COLUMNS.format(count), *row_ids, *site_ids,
+            *app_ids, *timestamps, *[user_id or 0 for user_id in user_ids],
+            *region_ids, *flags, *[len(name) for name in names],
+            *[len(customer_id) for customer_id in customer_ids]))
+        buffers.append(b''.join(names))
+        buffers.append(b''.join(customer_ids))
+        return buffers
+    size = REMOTE_ROW.size
+    fixed = bytearray(size * count)
+    view = memoryview(fixed)
+    for i, (row_id, site_id, app_id, _, region_id, user_id, _,
+            timestamp) in enumerate(rows):
+        REMOTE_ROW.pack_into(fixed, i * size, row_id, site_id, app_id,
+                             timestamp, user_id or 0, region_id, flags[i],
+                             len(names[i]), len(customer_ids[i]))
+        buffers.append(view[i * size: (i + 1) * size])
+        buffers.append(names[i])
+        buffers.append(customer_ids[i])
+    return buffers
+
+
+def unpack_remote_rows(body, columnar=False):
+    """
+    @:解析pack_remote_rows生成的消息体，返回(rows, addr)，rows中每条记录的列顺序与打包时相同
+    """
+    count, sgw_ip, sgw_port, sgw_id = REMOTE_ROWS_HEAD.unpack_from(body)
+    offset = REMOTE_ROWS_HEAD.size
+    rows = []
+    if columnar:
+        fmt = Constant.FMT_REMOTE_COLUMNS.format(count)
+        values = struct.unpack_from(fmt, body, offset)
+        offset += struct.calcsize(fmt)
+        (row_ids, site_ids, app_ids, timestamps, user_ids, region_ids, flags,
+         name_lens, customer_id_lens) = [values[i * count: (i + 1) * count]
+                                         for i in range(9)]
+        names = []
+        for size in name_lens:
+            names.append(body[offset: offset + size].decode('utf-8'))
+            offset += size
+        for i, size in enumerate(customer_id_lens):
+            customer_id = body[offset: offset + size].decode('utf-8')
+            offset += size
+            rows.append((row_ids[i], site_ids[i], app_ids[i], names[i],
+                         region_ids[i],
+                         None if flags[i] & USER_ID_NULL else user_ids[i],
+                         None if flags[i] & CUSTOMER_ID_NULL else customer_id,
+                         timestamps[i]))
+        return rows, (sgw_ip, sgw_port, sgw_id)
+    for _ in range(count):
+        (row_id, site_id, app_id, timestamp, user_id, region_id, flag,
+         name_len, customer_id_len) = REMOTE_ROW.unpack_from(body, offset)
+        offset += REMOTE_ROW.size
+        file_name = body[offset: offset + name_len].decode('utf-8')
+        offset += name_len
+        customer_id = body[offset: offset + customer_id_len].decode('utf-8')
+        offset += customer_id_len
+        rows.append((row_id, site_id, app_id, file_name, region_id,
+                     None if flag & USER_ID_NULL else user_id,
+                     None if flag & CUSTOMER_ID_NULL else customer_id,
+                     timestamp))
+    return rows, (sgw_ip, sgw_port, sgw_id)
@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import itertools
+import mmap
+import random
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import Lock
+
+from config import Config, Constant
+
+
+SgwRecord = namedtuple('SgwRecord', ['sgw_id', 'disk_free', 'last_seen',
+                                     'conn_state', 'group_id', 'ip',
+                                     'cpu_percent', 'port'])
+
+
+class SgwRoutingTable:
+    """
+    @:存储网关路由表，保存在fork之前创建的匿名共享内存(mmap)中，所有工作进程共享，
+    @:选择存储网关时不需要Manager进程的IPC，也不需要全局锁
+    @:内存布局：表头(generation(Q), version(Q)) + max_sgw条定长记录
+    @:记录：(sgw_id, disk_free, last_seen, conn_state, group_id, ip, cpu_percent,
+    port, used)
+    @:写者(sgw心跳、掉线检查)之间用writer_lock互斥，修改前后各把generation加1(seqlock)，
+    @:generation为奇数表示正在写；读者不加锁，前后两次读到相同的偶数generation即为一致的快照
+    @:version只在网关增删或影响选择的字段(容量、cpu、连接数、地址、group)变化时加1，
+    @:心跳只刷新last_seen时不变，选择网关时按version缓存排好序的候选网关
+    """
+    HEADER = struct.Struct('=QQ')
+    GENERATION = struct.Struct('=Q')
+    VERSION = struct.Struct('=Q')
+    RECORD = struct.Struct('=QQQQIIIHH')
+
+    def __init__(self, max_sgw=None):
+        self.max_sgw = max_sgw or Config.max_sgw
+        self.size = self.HEADER.size + self.RECORD.size * self.max_sgw
+        self._mm = mmap.mmap(-1, self.size)
+        self._writer_lock = Lock()
+        self._cache_generation = None
+        self._cache_records = []
+        self._prepared = None
+        self._schedule = None
+        self._rr = itertools.count()
+
+    def _generation(self):
+        return self.GENERATION.unpack_from(self._mm, 0)[0]
+
+    def _set_generation(self, generation):
+        self.GENERATION.pack_into(self._mm, 0, generation)
+
+    def _bump_version(self):
+        """
+        @:在_write中调用，影响选择的数据发生了变化
+        """
+        offset = self.GENERATION.size
+        version = self.VERSION.unpack_from(self._mm, offset)[0]
+        self.VERSION.pack_into(self._mm, offset, version + 1)
+
+    def version(self):
+        """
+        @:读取路由表的version，与snapshot()一样按seqlock协议读取
+        """
+        while True:
+            generation = self._generation()
+            if generation & 1:
+                continue
+            version = self.VERSION.unpack_from(self._mm, self.GENERATION.size)[0]
+            if self._generation() == generation:
+                return version
+
+    def _record_offset(self, slot):
+        return self.HEADER.size + self.RECORD.size * slot
+
+    def snapshot(self):
+        """
+        @:读取路由表中的有效记录，generation未变化时直接返回本进程缓存的结果
+        @:返回：[SgwRecord, ...]
+        """
+        while True:
+            generation = self._generation()
+            if generation & 1:
+                continue
+            if generation == self._cache_generation:
+                return self._cache_records
+            data = self._mm[self.HEADER.size: self.size]
+            if self._generation() != generation:
+                continue
+            break
+        records = []
+        for record in self.RECORD.iter_unpack(data):
+            if record[-1]:
+                records.append(SgwRecord._make(record[:-1]))
+        self._cache_records = records
+        self._cache_generation = generation
+        return records
+
+    def _write(self, func):
+        """
+        @:持有writer_lock并按seqlock协议修改路由表
+        """
+        with self._writer_lock:
+            generation = self._generation()
+            self._set_generation(generation + 1)
+            try:
+                return func()
+            finally:
+                self._set_generation(generation + 2)
+
+    def upsert(self, sgw_id, group_id, ip, port, disk_free, cpu_percent=0,
+               conn_state=0):
+        """
+        @:sgw心跳时注册或更新网关记录
+        @:返回True表示该sgw_id是新注册(或掉线后重新注册)的网关
+        """
+        def _pack(slot):
+            self.RECORD.pack_into(self._mm, self._record_offset(slot), sgw_id,
+                                  disk_free, int(time.time()), conn_state,
+                                  group_id, ip, cpu_percent, port, 1)
+
+        def _upsert():
+            free_slot = None
+            for slot in range(self.max_sgw):
+                offset = self._record_offset(slot)
+                record = self.RECORD.unpack_from(self._mm, offset)
+                if record[-1] and record[0] == sgw_id:
+                    if (record[1], record[3: 8]) != (
+                            disk_free,
+                            (conn_state, group_id, ip, cpu_percent, port)):
+                        self._bump_version()
+                    _pack(slot)
+                    return False
+                if not record[-1] and free_slot is None:
+                    free_slot = slot
+            if free_slot is None:
+                raise OverflowError('sgw路由表已满，请调大meta.ini中的max_sgw')
+            _pack(free_slot)
+            self._bump_version()
+            return True
+        return self._write(_upsert)
+
+    def expire(self, max_age):
+        """
+        @:删除超过max_age秒未发心跳的网关，返回被删除的sgw_id列表
+        """
+        now = int(time.time())
+        expired = [record.sgw_id for record in self.snapshot()
+                   if now - record.last_seen > max_age]
+        if not expired:
+            return []
+
+        def _expire():
+            removed = []
+            for slot in range(self.max_sgw):
+                offset = self._record_offset(slot)
+                record = self.RECORD.unpack_from(self._mm, offset)
+                record = SgwRecord._make(record[:-1]) if record[-1] else None
+                if (record and record.sgw_id in expired and
+                        now - record.last_seen > max_age):
+                    self._mm[offset: offset + self.RECORD.size] = \
+                        bytes(self.RECORD.size)
+                    removed.append(record.sgw_id)
+            if removed:
+                self._bump_version()
+            return removed
+        return self._write(_expire)
+
+    @staticmethod
+    def weight(record):
+        """
+        @:网关权重：可用磁盘容量越大、cpu占用越低、当前连接数越少，权重越大
+        """
+        idle = max(100 - record.cpu_percent, 1) / 100
+        return max(record.disk_free * idle / (1 + record.conn_state), 1)
+
+    def _prepare(self):
+        """
+        @:version变化时重新计算候选网关，按权重降序排好：[(weight, SgwRecord), ...]
+        @:sgw心跳只刷新last_seen时version不变，直接使用缓存的结果
+        """
+        version = self.version()
+        if self._prepared is not None and self._prepared[0] == version:
+            return self._prepared[1]
+        candidates = sorted(((self.weight(record), record)
+                             for record in self.snapshot()),
+                            key=lambda item: item[0], reverse=True)
+        self._prepared = (version, candidates)
+        return candidates
+
+    def _wrr_schedule(self, candidates):
+        """
+        @:平滑加权轮询的调度序列(候选网关的下标)，只在wrr策略下使用，
+        @:候选网关未重新计算时直接返回，按权重折算的轮询份数变化时才重新生成
+        """
+        if self._schedule is not None and self._schedule[0] is candidates:
+            return self._schedule[2]
+        top = candidates[0][0]
+        slots = tuple(max(int(Constant.SGW_WRR_SLOTS * weight / top), 1)
+                      for weight, _ in candidates)
+        if self._schedule is not None and self._schedule[1] == slots:
+            self._schedule = (candidates, slots, self._schedule[2])
+            return self._schedule[2]
+        total = sum(slots)
+        schedule = []
+        current = [0] * len(slots)
+        for _ in range(total):
+            for i, slot in enumerate(slots):
+                current[i] += slot
+            best = max(range(len(slots)), key=current.__getitem__)
+            current[best] -= total
+            schedule.append(best)
+        self._schedule = (candidates, slots, schedule)
+        return schedule
+
+    def select(self, policy=None):
+        """
+        @:选择一个存储网关地址，policy取值(默认为meta.ini中的sgw_select)：
+        @:p2c: 随机取两个网关，选权重大的(power of two choices)
+        @:wrr: 按权重平滑加权轮询
+        @:max_free: 选取可用磁盘容量最大的group，在组内轮询
+        @:返回：addr, region_id, system_id, group_id；addr = (ip, port, sgw_id)
+        """
+        policy = policy or Config.sgw_select
+        candidates = self._prepare()
+        if not candidates:
+            raise LookupError('sgw还没有发心跳消息注册，无存储网关信息')
+        if policy == 'p2c':
+            first = candidates[random.randrange(len(candidates))]
+            second = candidates[random.randrange(len(candidates))]
+            record = max(first, second, key=lambda item: item[0])[1]
+        elif policy == 'wrr':
+            schedule = self._wrr_schedule(candidates)
+            record = candidates[schedule[next(self._rr) % len(schedule)]][1]
+        else:
+            record = self._select_max_free(candidates)
+        addr = (record.ip, record.port, record.sgw_id)
+        return addr, Config.region_id, Config.system_id, record.group_id
+
+    def _select_max_free(self, candidates):
+        group_free = {}
+        for _, record in candidates:
+            if record.disk_free > group_free.get(record.group_id, -1):
+                group_free[record.group_id] = record.disk_free
+        group_id = max(group_free, key=group_free.get)
+        records = sorted((record for _, record in candidates
+                          if record.group_id == group_id),
+                         key=lambda record: record.sgw_id)
+        return records[next(self._rr) % len(records)]
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def __str__(self):
+        return str(self.snapshot())
@@ -2,7 +2,6 @@
 # -*- coding=utf-8 -*-
 import socket
 import threading
-import struct
 import json
 import sys
 import time
@@ -11,6 +10,7 @@ import psutil
 from log import logger
 from config import Config, Constant
 from app.models import MetadataStatus, session_scope
+from app.protocol import HEAD, LOCAL_SRC_ID
 
 
 class StatusServer:
@@ -20,7 +20,7 @@ class StatusServer:
         self.minor = Constant.MINOR_VERSION
         self.src_type = Constant.METADATA_TYPE
         self.dst_type = Constant.STATUS_TYPE
-        self.src_id = int(Config.src_id, 16)
+        self.src_id = LOCAL_SRC_ID
         self.dst_id = int(Config.status_dst_id, 16)
         self.command = Constant.METADATA_HB
         
@@ -156,9 +156,9 @@ class StatusServer:
         total = count = len(body.encode('utf-8'))
         length = total + Constant.HEAD_LENGTH
         header = [length, self.major, self.minor, self.src_type, self.dst_type,
-                  self.src_id, self.dst_id, self.command, total, count]
-        fmt_head = '!I4BII16xI4xQ8xI4x'
-        head_pack = struct.pack(fmt_head, *header)
+                  self.src_id, self.dst_id, 0, 0, self.command, 0, total, 0,
+                  count]
+        head_pack = HEAD.pack(*header)
         data = head_pack + body.encode('utf-8')
         return data
 
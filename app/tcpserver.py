@@ -1,25 +1,142 @@
 #!/usr/bin/python3
 # -*- coding=utf-8 -*-
+import argparse
+import os
 import sys
 import socket
-import struct
 import selectors
+import signal
 import threading
-from collections import deque
-from multiprocessing import Process, Manager, Lock
+import time
+import weakref
+from multiprocessing import Process, Manager
 
 from log import logger
 from config import Config, Constant
+from app import aioserver
 from app.storagegw import StorageGW
 from app.client import Client
+from app.framing import FrameBuffer, FrameError
+from app.metrics import metrics
+from app.models import check_schema, get_engine, init_engine
+from app.protocol import SGW_HB
+from app.routing import SgwRoutingTable
+from app.workerpool import WorkerPool
+from app.writebehind import flush_all
 from app.configserver import config_server
 from app.status import StatusServer
 
       
 class TcpServer:
+    # 命令字对应的线程池，背压按线程池分别处理
+    COMMAND_POOLS = {Constant.SGW_HB: 'hb',
+                     Constant.CLIENT_HB: 'hb',
+                     Constant.CLIENT_UPLOAD_ROUTE: 'upload',
+                     Constant.CLIENT_DEL: 'upload',
+                     Constant.REMOTE_DEL: 'upload',
+                     Constant.CLIENT_QUERY_NUM: 'query',
+                     Constant.CLIENT_QUERY_DATA: 'query',
+                     Constant.REMOTE_QUERY_NUM: 'query',
+                     Constant.REMOTE_QUERY_DATA: 'query',
+                     Constant.CLIENT_CONFIG_UPGRADE: 'query',
+                     Constant.CLIENT_UPGRADE: 'query'}
        
     def __init__(self):
-        pass
+        self.frame_buffers = weakref.WeakKeyDictionary()
+        self.paused = {}
+        self.pools = {}
+        self.last_report = time.time()
+        self.worker_index = None
+        self.worker_stats = None
+        
+    def set_monitor(self, worker_index, worker_stats):
+        """
+        @:设置工作进程序号和主进程共享的worker_stats，用于汇报每个工作进程的连接数等指标
+        """
+        self.worker_index = worker_index
+        self.worker_stats = worker_stats
+        
+    def start_pools(self):
+        """
+        @:在工作进程中启动处理业务的线程池
+        @:hb处理sgw和Client心跳，upload处理转存和删除，query处理查询和配置请求
+        """
+        metrics.reset()
+        queue_size = Config.pool_queue_size
+        self.pools = {'hb': WorkerPool('hb', Config.hb_pool_size, queue_size),
+                      'upload': WorkerPool('upload', Config.upload_pool_size,
+                                           queue_size),
+                      'query': WorkerPool('query', Config.query_pool_size,
+                                          queue_size)}
+        for pool in self.pools.values():
+            pool.start()
+            
+    def dispatch(self, kind, func, *args):
+        """
+        @:将业务处理提交到对应的线程池
+        """
+        self.pools[kind].submit(func, *args)
+        
+    def blocked_on(self, frame_buffer):
+        """
+        @:缓冲区中下一个完整消息帧要提交的线程池队列已满时返回该线程池名，否则返回None
+        @:只有发往已满线程池的连接暂停读取，查询线程池满时心跳、转存仍然正常处理
+        """
+        head_unpack = frame_buffer.peek()
+        if head_unpack is None:
+            return None
+        kind = self.COMMAND_POOLS.get(head_unpack.command)
+        if kind is not None and self.pools[kind].full():
+            return kind
+        return None
+    
+    def pause(self, conn, sel, kind):
+        """
+        @:kind线程池队列已满，暂停读取该连接，未处理的消息帧留在缓冲区中
+        """
+        try:
+            sel.unregister(conn)
+        except (KeyError, ValueError):
+            return
+        self.paused[conn] = kind
+        metrics.incr('tcp.paused')
+        metrics.incr('tcp.paused.{}'.format(kind))
+        
+    def resume_paused(self, sel):
+        """
+        @:线程池队列有空闲后恢复读取等待该线程池的连接，并先处理缓冲区中已收到的消息帧
+        """
+        for conn, kind in list(self.paused.items()):
+            if self.pools[kind].full():
+                continue
+            del self.paused[conn]
+            if conn.fileno() == -1:
+                self.frame_buffers.pop(conn, None)
+                continue
+            sel.register(conn, selectors.EVENT_READ, self.read)
+            self.handle_frames(conn, sel, self.frame_buffers.get(conn))
+            
+    def report_stats(self):
+        """
+        @:定时将本进程的运行指标写入日志，并汇报到主进程的worker_stats中
+        @:worker_stats数据结构为：{worker_index: {'pid': pid, 'tcp.connections': n, ...}}
+        """
+        now = time.time()
+        if now - self.last_report < Constant.TIME:
+            return
+        self.last_report = now
+        for name, pool in self.pools.items():
+            metrics.gauge('pool.{}.queue_depth'.format(name), pool.qsize())
+        metrics.gauge('tcp.paused_conns', len(self.paused))
+        metrics.gauge('tcp.connections', len(self.frame_buffers))
+        snapshot = metrics.snapshot()
+        logger.info('进程运行指标:{}'.format(snapshot))
+        if self.worker_stats is not None:
+            snapshot['pid'] = os.getpid()
+            try:
+                self.worker_stats[self.worker_index] = snapshot
+            except:
+                logger.error('汇报工作进程运行指标失败')
        
     def accept(self, sock, sel):
         """
@@ -32,50 +149,65 @@ class TcpServer:
             logger.error('Connection error message: {}'.format(e))
         else:
             conn.setblocking(False)
+            self.frame_buffers[conn] = FrameBuffer()
+            metrics.incr('tcp.accepted')
             sel.register(conn, selectors.EVENT_READ, self.read)
-                           
-    def recvall(self, conn, sel, length):
+            
+    def close(self, conn, sel):
         """
+        @:注销并关闭连接
         """
-        blocks = []
-        while length:
-            try:
-                block = conn.recv(length)
-            except OSError:
-                pass
-#                 sel.unregister(conn)
-#                 conn.close()
-#                 break
-            else:
-                length -= len(block)
-                blocks.append(block)
-        return b''.join(blocks)
+        self.frame_buffers.pop(conn, None)
+        try:
+            sel.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
        
     def read(self, conn, sel):
         """
+        @:连接可读时接收一次数据，只有缓存到完整的消息帧才交给data_handler处理
         """
-        fmt_head = Constant.FMT_COMMON_HEAD
+        frame_buffer = self.frame_buffers.get(conn)
+        if frame_buffer is None:
+            frame_buffer = self.frame_buffers[conn] = FrameBuffer()
         try:
-            header = self.recvall(conn, sel, Constant.HEAD_LENGTH)
-            head_unpack = struct.unpack(fmt_head, header)
-        except struct.error:
-            sel.unregister(conn)
-            conn.close()
-        except:
-            sel.unregister(conn)
-            conn.close()
-        else:
-            total_size = head_unpack[0]
-            body_size = total_size - Constant.HEAD_LENGTH
-            try:
-                body = self.recvall(conn, sel, body_size)
+            alive = frame_buffer.recv_from(conn)
+        except OSError as e:
+            logger.error('TcpServer接收数据出错:{}'.format(e))
+            self.close(conn, sel)
+            return
+        if not alive:
+            logger.info('对端已关闭连接')
+            self.close(conn, sel)
+            return
+        self.handle_frames(conn, sel, frame_buffer)
+        
+    def handle_frames(self, conn, sel, frame_buffer):
+        """
+        @:依次处理缓冲区中的完整消息帧，下一帧要提交的线程池队列已满时暂停读取该连接
+        """
+        try:
+            while True:
+                kind = self.blocked_on(frame_buffer)
+                if kind is not None:
+                    self.pause(conn, sel, kind)
+                    break
+                frame = frame_buffer.next_frame()
+                if frame is None:
+                    break
+                head_unpack, body = frame
                 logger.info("TcpServer收到的head_unpack:{}".format(head_unpack))
                 logger.info("TcpServer收到的body:{}".format(body))
                 self.data_handler(head_unpack, body, conn, sel)
-            except:
-                logger.error('TcpServer数据处理出现错误')
-                sel.unregister(conn)
-                conn.close()
+                if conn.fileno() == -1:
+                    break
+        except FrameError as e:
+            logger.error('TcpServer拆分消息帧出错:{}'.format(e))
+            self.close(conn, sel)
+        except:
+            logger.error('TcpServer数据处理出现错误')
+            self.close(conn, sel)
        
     def data_handler(self, head_unpack, body, conn, sel):
         """
@@ -83,7 +215,7 @@ class TcpServer:
         (total_size, major, minor, src_type, dst_type, src_id, dst_id, trans_id,
          sequence, command, ack_code, total, offset, count) = head_unpack 
         """
-        command = head_unpack[9]
+        command = head_unpack.command
             
         if command == Constant.SGW_HB:
             """
@@ -91,23 +223,16 @@ class TcpServer:
             """
             logger.info('收到sgw心跳消息')
             try:
-                fmt = '!5IH2xII8Q'
-                body_unpack = struct.unpack(fmt, body)
+                body_unpack = SGW_HB.unpack(body)
                 logger.info("收到sgw心跳消息body:{}".format(body_unpack))
             except:
                 logger.error('sgw心跳的消息体解析出错')
-                sel.unregister(conn)
-                conn.close()
+                self.close(conn, sel)
             else:
-                sgw_id = head_unpack[5]
+                sgw_id = head_unpack.src_id
                 storagegw = StorageGW(sgw_id, *body_unpack)
-                t1 = threading.Thread(target=storagegw.handle_hb,
-                                      args=(head_unpack, conn, sel, sgw_info,
-                                            lock, sgw_id_info, addr_list))
-                t1.start()
-                logger.info('当前sgw的sgw_id信息为：{}'.format(sgw_id_info))
-                logger.info('当前sgw的addr_list列表为：{}'.format(addr_list))
-                logger.info("sgw注册后的数据结构：{}".format(sgw_info))
+                self.dispatch('hb', storagegw.handle_hb,
+                              head_unpack, conn, sel, sgw_table)
                 
         elif command == Constant.CLIENT_HB:
             """
@@ -115,23 +240,20 @@ class TcpServer:
             """
             logger.info('收到Client心跳消息')
             client = Client()
-            t2 = threading.Thread(target=client.handle_hb,
-                                 args=(head_unpack, body, conn, sel,
-                                       conf_info, version_info))
-            t2.start()
+            self.dispatch('hb', client.handle_hb,
+                          head_unpack, body, conn, sel, conf_info,
+                          version_info)
                
         elif command == Constant.CLIENT_UPLOAD_ROUTE:
             """
             @:处理Client转存路径请求
             """
             logger.info('收到Client转存路径请求')
-            logger.info(sgw_info)
+            logger.info(sgw_table)
             client = Client()
             try:
-                t3 = threading.Thread(target=client.handle_upload,
-                                     args=(head_unpack, body, conn, sel, sgw_info,
-                                           lock))
-                t3.start()
+                self.dispatch('upload', client.handle_upload,
+                              head_unpack, body, conn, sel, sgw_table)
             except:
                 logger.error('sgw还没有发心跳消息注册，无存储网关信息')
                
@@ -147,9 +269,8 @@ class TcpServer:
             """
             logger.info('收到Client查询记录数量的请求')
             client = Client()
-            t4 = threading.Thread(target=client.handle_query_num,
-                                  args=(head_unpack, body, conn, sel, conf_info))
-            t4.start()
+            self.dispatch('query', client.handle_query_num,
+                          head_unpack, body, conn, sel, conf_info)
             
         elif command == Constant.FILE_QUERY_NUM:
             """
@@ -157,9 +278,8 @@ class TcpServer:
             """
             logger.info('收到Fileportal查询记录数量的请求')
             client = Client()
-            t13 = threading.Thread(target=client.handle_file_query_num,
-                                  args=(head_unpack, body, conn, sel))
-            t13.start()
+            self.dispatch('query', client.handle_file_query_num,
+                          head_unpack, body, conn, sel)
                
         elif command == Constant.CLIENT_QUERY_DATA:
             """
@@ -167,10 +287,9 @@ class TcpServer:
             """
             logger.info('收到Client查询数据的请求')
             client = Client()
-            t5 = threading.Thread(target=client.handle_query_data,
-                                  args=(head_unpack, body, conn, sel, sgw_info,
-                                        lock, conf_info))
-            t5.start()
+            self.dispatch('query', client.handle_query_data,
+                          head_unpack, body, conn, sel, sgw_table,
+                          conf_info)
                 
         elif command == Constant.FILE_QUERY_DATA:
             """
@@ -178,10 +297,8 @@ class TcpServer:
             """
             logger.info('收到Fileportal查询数据的请求')
             client = Client()
-            t12 = threading.Thread(target=client.handle_file_query_data,
-                                  args=(head_unpack, body, conn, sel, sgw_info,
-                                        lock))
-            t12.start()
+            self.dispatch('query', client.handle_file_query_data,
+                          head_unpack, body, conn, sel, sgw_table)
                        
         elif command == Constant.REMOTE_QUERY_NUM:
             """
@@ -189,9 +306,8 @@ class TcpServer:
             """
             logger.info('收到RemoteMetadataServer查询记录数量的请求')
             client = Client()
-            t6 = threading.Thread(target=client.handle_remote_query_num,
-                                  args=(head_unpack, body, conn, sel))
-            t6.start()
+            self.dispatch('query', client.handle_remote_query_num,
+                          head_unpack, body, conn, sel)
            
         elif command == Constant.REMOTE_QUERY_DATA:
             """
@@ -199,10 +315,8 @@ class TcpServer:
             """
             logger.info('收到RemoteMetadataServer查询数据的请求')
             client = Client()
-            t7 = threading.Thread(target=client.handle_remote_query_data,
-                                  args=(head_unpack, body, conn, sel, sgw_info,
-                                        lock))
-            t7.start()
+            self.dispatch('query', client.handle_remote_query_data,
+                          head_unpack, body, conn, sel, sgw_table)
                
         elif command == Constant.CLIENT_DEL:
             """
@@ -210,10 +324,9 @@ class TcpServer:
             """
             logger.info('收到Client删除元数据的请求')
             client = Client()
-            t8 = threading.Thread(target=client.handle_delete,
-                                  args=(head_unpack, body, conn, sel, sgw_info,
-                                        lock, conf_info))
-            t8.start()
+            self.dispatch('upload', client.handle_delete,
+                          head_unpack, body, conn, sel, sgw_table,
+                          conf_info)
             
         elif command == Constant.FILE_DEL:
             """
@@ -221,10 +334,8 @@ class TcpServer:
             """
             logger.info('收到Fileportal删除元数据的请求')
             client = Client()
-            t14 = threading.Thread(target=client.handle_file_delete,
-                                  args=(head_unpack, body, conn, sel, sgw_info,
-                                        lock))
-            t14.start()
+            self.dispatch('upload', client.handle_file_delete,
+                          head_unpack, body, conn, sel, sgw_table)
                
         elif command == Constant.REMOTE_DEL:
             """
@@ -232,10 +343,8 @@ class TcpServer:
             """
             logger.info('收到RemoteMetadataServer的删除元数据的请求')
             client = Client()
-            t9 = threading.Thread(target=client.handle_remote_del,
-                                  args=(head_unpack, body, conn, sel, sgw_info,
-                                        lock))
-            t9.start()
+            self.dispatch('upload', client.handle_remote_del,
+                          head_unpack, body, conn, sel, sgw_table)
                
         elif command == Constant.CLIENT_CONFIG_UPGRADE:
             """
@@ -243,9 +352,8 @@ class TcpServer:
             """
             logger.info('收到Client配置升级的请求')
             client = Client()
-            t10 = threading.Thread(target=client.handle_config_upgrade,
-                                   args=(head_unpack, body, conn, sel, conf_info))
-            t10.start()
+            self.dispatch('query', client.handle_config_upgrade,
+                          head_unpack, body, conn, sel, conf_info)
                
         elif command == Constant.CLIENT_UPGRADE:
             """
@@ -253,28 +361,16 @@ class TcpServer:
             """
             logger.info('收到Client软件升级的请求')
             client = Client()
-            t11 = threading.Thread(target=client.handle_client_upgrade,
-                                   args=(head_unpack, body, conn, sel, conf_info))
-            t11.start()
+            self.dispatch('query', client.handle_client_upgrade,
+                          head_unpack, body, conn, sel, conf_info)
         else:
             logger.error('解析到未定义的命令字')
           
-    def run(self):
-#         conf_recv_thread1 = threading.Thread(target=config_server.conf_read,
-#                                              args=(conf_info,))
-#         conf_recv_thread1.start()
-        sel = selectors.DefaultSelector()
-        sel.register(listener, selectors.EVENT_READ, self.accept)
-        while True:
-            events = sel.select()
-            for key, _ in events:
-                callback = key.data
-                callback(key.fileobj, sel)
-                
 
-def _generate_srv_sock():
+def _generate_srv_sock(reuse_port=False):
     """
     @:生成监听套接字并绑定到配置的ip和port
+    @:reuse_port为True时设置SO_REUSEPORT，每个工作进程各自打开监听套接字，由内核均衡分配连接
     """
     HOST = Config.listening_ip
     try:
@@ -296,6 +392,13 @@ def _generate_srv_sock():
     except socket.error as e:
         logger.error('Setsockopt SO_REUSEADDR Failed:{}'.format(e))
         sys.exit()
+        
+    if reuse_port:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except (AttributeError, socket.error) as e:
+            logger.error('Setsockopt SO_REUSEPORT Failed:{}'.format(e))
+            sys.exit()
     
     try:
         sock.bind(ADDR)
@@ -304,7 +407,7 @@ def _generate_srv_sock():
         sys.exit()
         
     try:
-        sock.listen(100)
+        sock.listen(Config.listening_backlog)
     except socket.error as e:
         logger.error('Listen Failed:{}'.format(e))
         sys.exit()
@@ -326,58 +429,80 @@ def _get_workers():
     return workers   
 
 def run(listener, sel, tcp_server):
+    tcp_server.start_pools()
     sel.register(listener, selectors.EVENT_READ, tcp_server.accept)
     while True:
-        events = sel.select()
+        events = sel.select(Constant.SELECT_TIMEOUT)
         for key, _ in events:
             callback = key.data
             callback(key.fileobj, sel)
+        tcp_server.resume_paused(sel)
+        tcp_server.report_stats()
+        
+def worker_main(worker_index, listener, tcp_server, worker_stats):
+    """
+    @:工作进程入口
+    @:listener为None时(reuse_port模式)在本进程中创建SO_REUSEPORT监听套接字
+    """
+    if listener is None:
+        listener = _generate_srv_sock(reuse_port=True)
+    tcp_server.set_monitor(worker_index, worker_stats)
+    init_engine()
+    # 收到SIGTERM时正常退出，退出前写出后写队列中剩余的数据
+    # (multiprocessing的子进程退出时不执行atexit)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if Config.listening_engine == 'asyncio':
+            aioserver.run(listener, tcp_server)
+        else:
+            run(listener, selectors.DefaultSelector(), tcp_server)
+    finally:
+        flush_all()
+        
+def monitor_workers(worker_stats):
+    """
+    @:主进程定时输出每个工作进程的连接数
+    """
+    while True:
+        time.sleep(Constant.TIME)
+        connections = {index: stats.get('tcp.connections', 0)
+                       for index, stats in worker_stats.items()}
+        logger.info('各工作进程当前连接数:{}'.format(connections))
     
 if __name__ == '__main__':
     """
     @:version_info,保存Client版本信息,用于回复Client心跳
     @:数据结构为：{str(site_id): {'config_version': config_version,
                               'client_version': client_version}}
-    @:sgw_info,保存sgw信息，用于给Client轮询选择存储网关地址
-    @:数据结构为：
-    @:{group_id1: [disk_free1, [deque[addr1, addr2, ...], region_id, system_id, group_id1]],
-       group_id2: [disk_free2, [deque[addr3, addr4, ...], region_id, system_id, group_id2]],
-        ...}
-       addr = (ip, port, sgw_id)
-    @:sgw_id_info,保存sgw的sgw_id信息，用于判断是否将sgw的信息写入数据库中的sgw_static表，也用于判断是否掉线
-    @:数据结构为：{sgw_id1: timestamp,
-                sgw_id2: timestamp,
-                sgw_id3: timestamp, ...}
-    @:addr_list,保存sgw的addr信息,用于更新sgw_info
-    @:数据结构为：[(self.listen_ip1, self.listen_port1, sgw_id1), ...]
+    @:sgw_table,共享内存中的存储网关路由表，用于给Client选择存储网关地址，也用于判断sgw是否掉线
+    @:记录为：(sgw_id, disk_free, last_seen, conn_state, group_id, ip, cpu_percent,
+    port)，详见app.routing
     @:conf_info,用于向ConfigServer查询时，保存ConfigServer回复的信息
     @:数据结构为：{str(id): query_body_unpack, ...}
      
     """
-    lock = Lock()
+    parser = argparse.ArgumentParser(description='MetadataServer')
+    parser.add_argument('--skip-schema-check', action='store_true',
+                        help='跳过启动前在主进程中建表、补建缺少的索引')
+    args = parser.parse_args()
+    if not args.skip_schema_check:
+        logger.info('检查数据库表结构，新建的索引:{}'.format(check_schema()))
+        # 检查时建立的连接不能随fork进入工作进程
+        get_engine().dispose()
+    
     m = Manager()
     version_info = m.dict()
-    sgw_info = m.dict()
-    sgw_id_info = m.dict()
     client_id_info = m.dict()
-    addr_list = m.list()
-    sgw_info = {2: [1024000, [deque([(3232252929, 8000, 1000),
-                                     (3232252930, 8000, 1001),
-                                     (3232252931, 8000, 1002)]), 1, 1, 2]]}
+    sgw_table = SgwRoutingTable()
     conf_info = m.dict()
-    conf_recv_thread = threading.Thread(target=config_server.conf_read,
-                                        args=(conf_info,))
-    conf_recv_thread.start()
- 
-    conf_sendhb_timer = threading.Thread(target=config_server.send_hb)
-    conf_sendhb_timer.start()
+    conf_recv_thread, conf_sendhb_timer = config_server.init(conf_info)
     
     status_server = StatusServer()
     status_server_timer = threading.Thread(target=status_server.send_hb)
     status_server_timer.start()
     
     check_sgw_hb_thread = threading.Thread(target=StorageGW.check_sgw_hb,
-                                           args=(sgw_id_info, addr_list))
+                                           args=(sgw_table,))
     check_sgw_hb_thread.start()
     
     logger.info("conf_recv_thread's name:{}".format(conf_recv_thread.name))
@@ -399,21 +524,26 @@ if __name__ == '__main__':
     logger.info('get_ident:{}'.format(threading.get_ident()))
      
     workers = _get_workers()
-    listener = _generate_srv_sock()
+    if Config.listening_reuse_port:
+        listener = None
+    else:
+        listener = _generate_srv_sock()
     tcp_server = TcpServer()
+    worker_stats = m.dict()
+    monitor_thread = threading.Thread(target=monitor_workers,
+                                      args=(worker_stats,))
+    monitor_thread.start()
      
-    logger.info('Starting TCP services...')
-    logger.info('Listening at:{}'.format(listener.getsockname()))
+    logger.info('Starting TCP services with {} engine...'.format(
+        Config.listening_engine))
+    if listener is None:
+        logger.info('Listening at:{} with SO_REUSEPORT per worker'.format(
+            (Config.listening_ip, Config.listening_port)))
+    else:
+        logger.info('Listening at:{}'.format(listener.getsockname()))
 
     for i in range(workers):
         logger.info('开始启动第{0}个子进程, 总共{1}个子进程'.format(i+1, workers))
-        sel = selectors.DefaultSelector()
-        p = Process(target=run, args=(listener, sel, tcp_server))
+        p = Process(target=worker_main,
+                    args=(i, listener, tcp_server, worker_stats))
         p.start()
-        
-
-
-
-
-
-    
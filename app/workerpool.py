@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import queue
+import threading
+import time
+
+from app.metrics import metrics
+from log import logger
+
+
+class WorkerPool:
+    """
+    @:固定线程数、有界任务队列的线程池，替代每条消息新建一个线程
+    @:队列满时submit阻塞，TcpServer在队列满之前就停止读取socket(背压)
+    """
+
+    def __init__(self, name, size, queue_size):
+        self.name = name
+        self.size = size
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+
+    def start(self):
+        """
+        @:启动工作线程，必须在fork出的子进程中调用
+        """
+        for i in range(self.size):
+            t = threading.Thread(target=self._worker,
+                                 name='{}-{}'.format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        logger.info('线程池{}已启动，线程数:{}'.format(self.name, self.size))
+
+    def submit(self, func, *args):
+        """
+        @:提交任务
+        """
+        self._queue.put((time.time(), func, args))
+        metrics.incr('pool.{}.submitted'.format(self.name))
+        metrics.gauge('pool.{}.queue_depth'.format(self.name),
+                      self._queue.qsize())
+
+    def full(self):
+        return self._queue.full()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        """
+        @:从任务队列取任务执行，统计排队等待时间
+        """
+        while True:
+            enqueued, func, args = self._queue.get()
+            metrics.observe('pool.{}.wait'.format(self.name),
+                            time.time() - enqueued)
+            metrics.gauge('pool.{}.queue_depth'.format(self.name),
+                          self._queue.qsize())
+            try:
+                func(*args)
+            except:
+                logger.exception('线程池{}执行任务{}出错'.format(self.name,
+                                                           func.__name__))
+                metrics.incr('pool.{}.failed'.format(self.name))
+            else:
+                metrics.incr('pool.{}.completed'.format(self.name))
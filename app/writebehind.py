@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from app.countcache import count_cache
+from app.dbrouter import db_router
+from app.metrics import metrics
+from app.models import get_engine, client_status, sgw_status, metadata_info
+from config import Config
+from log import logger
+
+
+class WriteTicket:
+    """
+    @:等待某一行数据写入数据库的结果，用于写入提交后才回复的场景
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.ok = False
+
+    def set(self, ok):
+        self.ok = ok
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """
+        @:返回True表示已成功写入数据库
+        """
+        return self._event.wait(timeout) and self.ok
+
+
+class WriteBehindQueue:
+    """
+    @:高频写入(心跳状态行)的后写队列，每个工作进程一份
+    @:put只把行数据放进有界缓冲区，由后台线程在攒够batch_size行或等待flush_interval秒后
+    @:用一条多行INSERT(executemany)写入数据库，数据库提交次数不再随心跳数量增长
+    @:缓冲区超过max_pending行时按overflow策略处理：
+    @:drop: 丢弃新行并计数；spill: 由调用线程同步写出最早的一批数据后再放入
+    @:on_flush(rows)在一批数据成功写入后调用
+    @:写入失败的一批数据放回缓冲区头部，等待retry_interval秒后重试，每行最多重试max_retries次后才丢弃；
+    @:放回时同样不超过max_pending行，放不下的行丢弃并计数
+    @:带WriteTicket的行等待超时后可以用withdraw撤回，撤回后不会再写入数据库
+    @:工作进程退出时调用flush_all()写出缓冲区中剩余的数据
+    """
+
+    def __init__(self, name, table, batch_size=None, flush_interval=None,
+                 max_pending=None, overflow=None, on_flush=None,
+                 max_retries=None, retry_interval=None):
+        self.name = name
+        self.table = table
+        self.batch_size = batch_size or Config.wb_batch_size
+        self.flush_interval = flush_interval or Config.wb_flush_interval
+        self.max_pending = max_pending or Config.wb_max_pending
+        self.overflow = overflow or Config.wb_overflow
+        self.on_flush = on_flush
+        self.max_retries = (Config.wb_max_retries if max_retries is None
+                            else max_retries)
+        self.retry_interval = retry_interval or Config.wb_retry_interval
+        self._rows = deque()        # (row, ticket, 已重试次数)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._writing = set()       # 正在写入的一批数据中的WriteTicket
+        self._written = threading.Condition(self._lock)
+        self._pid = None
+
+    def _ensure_started(self):
+        """
+        @:后台线程不会随fork进入子进程，在本进程第一次put时启动
+        """
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            t = threading.Thread(target=self._run,
+                                 name='writebehind-{}'.format(self.name))
+            t.daemon = True
+            t.start()
+
+    def _take(self):
+        """
+        @:从缓冲区取出最多batch_size行，调用方需持有self._cond
+        """
+        size = min(len(self._rows), self.batch_size)
+        batch = [self._rows.popleft() for _ in range(size)]
+        self._writing.update(ticket for _, ticket, _ in batch
+                             if ticket is not None)
+        return batch
+
+    def put(self, row, ticket=None):
+        """
+        @:放入一行待写入的数据，返回False表示该行被丢弃
+        @:ticket为WriteTicket时，写入完成(或失败、被丢弃)后通过ticket通知调用方
+        """
+        self._ensure_started()
+        spill = None
+        with self._cond:
+            if len(self._rows) >= self.max_pending:
+                if self.overflow == 'spill':
+                    spill = self._take()
+                else:
+                    metrics.incr('wb.{}.dropped'.format(self.name))
+                    if ticket is not None:
+                        ticket.set(False)
+                    return False
+            self._rows.append((row, ticket, 0))
+            metrics.gauge('wb.{}.pending'.format(self.name), len(self._rows))
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        if spill:
+            metrics.incr('wb.{}.spilled'.format(self.name), len(spill))
+            self._flush(spill)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._rows) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                batch = self._take()
+                metrics.gauge('wb.{}.pending'.format(self.name),
+                              len(self._rows))
+            if batch and not self._flush(batch):
+                # 数据库不可用时不要立即重试
+                time.sleep(self.retry_interval)
+
+    def _flush(self, batch):
+        """
+        @:用一条多行INSERT写入一批数据，并通知等待中的WriteTicket
+        @:写入失败时未超过重试次数的行放回缓冲区头部，返回是否写入成功
+        """
+        start = time.time()
+        rows = [row for row, _, _ in batch]
+        try:
+            with get_engine().begin() as connection:
+                connection.execute(self.table.insert(), rows)
+        except:
+            ok = False
+            retry = [(row, ticket, attempts + 1)
+                     for row, ticket, attempts in batch
+                     if attempts < self.max_retries]
+            done = [entry for entry in batch if entry[2] >= self.max_retries]
+            with self._cond:
+                # 数据库长时间不可用时缓冲区也不能超过max_pending
+                room = max(self.max_pending - len(self._rows), 0)
+                overflow = retry[room:]
+                retry = retry[:room]
+                self._rows.extendleft(reversed(retry))
+            done.extend(overflow)
+            logger.exception('后写队列{}写入数据库失败，{}行稍后重试，丢弃{}行'.format(
+                self.name, len(retry), len(done)))
+            metrics.incr('wb.{}.retried'.format(self.name), len(retry))
+            metrics.incr('wb.{}.failed'.format(self.name), len(done))
+            metrics.incr('wb.{}.dropped'.format(self.name), len(overflow))
+        else:
+            ok = True
+            done = batch
+            metrics.incr('wb.{}.flushed'.format(self.name), len(rows))
+            metrics.incr('wb.{}.batches'.format(self.name))
+            if self.on_flush is not None:
+                self.on_flush(rows)
+        for _, ticket, _ in done:
+            if ticket is not None:
+                ticket.set(ok)
+        with self._cond:
+            self._writing.difference_update(ticket for _, ticket, _ in batch)
+            self._written.notify_all()
+        metrics.observe('wb.{}.flush_time'.format(self.name),
+                        time.time() - start)
+        return ok
+
+    def withdraw(self, ticket):
+        """
+        @:撤回带ticket的行，用于等待写入结果超时后回复失败的场景
+        @:该行还在缓冲区中时取出丢弃；正在写入时等待这次写入的结果，失败放回缓冲区的同样取出
+        @:返回True表示该行没有写入、以后也不会写入数据库，False表示已经写入
+        """
+        with self._cond:
+            while ticket in self._writing:
+                self._written.wait()
+            for i, (_, queued, _) in enumerate(self._rows):
+                if queued is ticket:
+                    del self._rows[i]
+                    break
+            else:
+                return not ticket.ok
+        metrics.incr('wb.{}.withdrawn'.format(self.name))
+        ticket.set(False)
+        return True
+
+    def flush(self):
+        """
+        @:同步写出缓冲区中的全部数据，写入失败的行按重试次数重试，超过后丢弃
+        """
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                break
+            if not self._flush(batch):
+                time.sleep(self.retry_interval)
+
+
+def metadata_info_flushed(rows):
+    """
+    @:metadata_info的一批数据已提交，计数缓存失效，这些site随后的查询读主库
+    """
+    site_ids = [row['site_id'] for row in rows]
+    count_cache.invalidate(site_ids)
+    db_router.mark_write(site_ids)
+
+
+def flush_all():
+    """
+    @:写出所有后写队列中剩余的数据，工作进程退出前调用
+    """
+    for writer in (client_status_writer, sgw_status_writer,
+                   metadata_info_writer):
+        if writer._pid == os.getpid():
+            writer.flush()
+
+
+client_status_writer = WriteBehindQueue('client_status', client_status)
+sgw_status_writer = WriteBehindQueue('sgw_status', sgw_status)
+metadata_info_writer = WriteBehindQueue('metadata_info', metadata_info,
+                                        Config.upload_batch_size,
+                                        Config.upload_max_latency,
+                                        Config.upload_max_pending,
+                                        Config.upload_overflow,
+                                        metadata_info_flushed,
+                                        Config.upload_max_retries)
+atexit.register(flush_all)
@@ -27,15 +27,93 @@ class Config:
     status_dst_id = conf.get('local_config', 'status_dst_id')
     config_dst_id = conf.get('local_config', 'config_dst_id')
     _workers = conf.get('local_config', 'workers')
+    max_sgw = conf.getint('local_config', 'max_sgw', fallback=256)
+    sgw_select = conf.get('local_config', 'sgw_select', fallback='p2c')
+    hb_pool_size = conf.getint('local_config', 'hb_pool_size', fallback=8)
+    query_pool_size = conf.getint('local_config', 'query_pool_size',
+                                  fallback=16)
+    upload_pool_size = conf.getint('local_config', 'upload_pool_size',
+                                   fallback=8)
+    pool_queue_size = conf.getint('local_config', 'pool_queue_size',
+                                  fallback=1000)
+    
+    db_pool_size = (conf.getint('mysql_pool', 'pool_size', fallback=0) or
+                    hb_pool_size + query_pool_size + upload_pool_size)
+    db_max_overflow = conf.getint('mysql_pool', 'max_overflow', fallback=10)
+    db_pool_timeout = conf.getfloat('mysql_pool', 'pool_timeout', fallback=10.0)
+    db_pool_recycle = conf.getint('mysql_pool', 'pool_recycle', fallback=3600)
+    db_pool_pre_ping = conf.getboolean('mysql_pool', 'pool_pre_ping',
+                                       fallback=True)
+    db_connect_timeout = conf.getint('mysql_pool', 'connect_timeout',
+                                     fallback=10)
+    db_read_timeout = conf.getint('mysql_pool', 'read_timeout', fallback=0)
+    db_write_timeout = conf.getint('mysql_pool', 'write_timeout', fallback=0)
+    db_replicas = [conf.get(name.strip(), 'conn_str') for name in
+                   conf.get('mysql_replicas', 'replicas', fallback='').split(',')
+                   if name.strip()]
+    db_replica_health_interval = conf.getfloat('mysql_replicas',
+                                               'health_interval', fallback=5.0)
+    db_recent_write = conf.getfloat('mysql_replicas', 'recent_write',
+                                    fallback=5.0)
+    db_recent_write_slots = conf.getint('mysql_replicas', 'slots',
+                                        fallback=4096)
+    
+    wb_batch_size = conf.getint('write_behind', 'batch_size', fallback=500)
+    wb_flush_interval = conf.getfloat('write_behind', 'flush_interval',
+                                      fallback=1.0)
+    wb_max_pending = conf.getint('write_behind', 'max_pending', fallback=10000)
+    wb_overflow = conf.get('write_behind', 'overflow', fallback='drop')
+    wb_max_retries = conf.getint('write_behind', 'max_retries', fallback=3)
+    wb_retry_interval = conf.getfloat('write_behind', 'retry_interval',
+                                      fallback=1.0)
+    
+    upload_batch_size = conf.getint('upload_batch', 'batch_size', fallback=200)
+    upload_max_latency = conf.getfloat('upload_batch', 'max_latency',
+                                       fallback=0.05)
+    upload_max_pending = conf.getint('upload_batch', 'max_pending',
+                                     fallback=20000)
+    upload_overflow = conf.get('upload_batch', 'overflow', fallback='spill')
+    upload_ack_mode = conf.get('upload_batch', 'ack_mode', fallback='enqueue')
+    upload_max_retries = conf.getint('upload_batch', 'max_retries',
+                                     fallback=10)
+    
+    query_stream_rows = conf.getint('query', 'stream_rows', fallback=500)
+    
+    conf_cache_ttl = conf.getfloat('conf_cache', 'ttl', fallback=300.0)
+    conf_cache_stale = conf.getfloat('conf_cache', 'stale', fallback=3600.0)
+    conf_cache_wait = conf.getfloat('conf_cache', 'wait', fallback=3.0)
+    
+    count_cache_max_entries = conf.getint('count_cache', 'max_entries',
+                                          fallback=10000)
+    count_cache_ttl = conf.getfloat('count_cache', 'ttl', fallback=30.0)
+    count_cache_slots = conf.getint('count_cache', 'slots', fallback=4096)
+    
+    remote_timeout = conf.getfloat('remote', 'timeout', fallback=3.0)
+    remote_deadline = conf.getfloat('remote', 'deadline', fallback=5.0)
+    remote_max_workers = conf.getint('remote', 'max_workers', fallback=16)
+    remote_row_format = conf.get('remote', 'row_format', fallback='binary')
+    remote_max_per_host = conf.getint('remote', 'max_per_host', fallback=4)
+    remote_max_idle = conf.getfloat('remote', 'max_idle', fallback=60.0)
+    remote_health_interval = conf.getfloat('remote', 'health_interval',
+                                           fallback=10.0)
     
     status_server_ip = conf.get('status_server', 'ip')
     status_server_port = conf.get('status_server', 'port')
     
     config_server_ip = conf.get('config_server', 'ip')
     config_server_port = conf.get('config_server', 'port')
+    config_pool_size = conf.getint('config_server', 'pool_size', fallback=2)
+    config_query_timeout = conf.getfloat('config_server', 'query_timeout',
+                                         fallback=3.0)
+    config_connect_backoff = conf.getfloat('config_server', 'connect_backoff',
+                                           fallback=5.0)
     
     listening_ip = conf.get('listening', 'ip')
     listening_port = conf.get('listening', 'port')
+    listening_engine = conf.get('listening', 'engine', fallback='selectors')
+    listening_backlog = conf.getint('listening', 'backlog', fallback=1024)
+    listening_reuse_port = conf.getboolean('listening', 'reuse_port',
+                                           fallback=False)
     
 class Constant:
     HEAD_LENGTH = 64
@@ -51,15 +129,40 @@ class Constant:
     CPU_NUMS = os.cpu_count()
     DEFAULT_WORKERS = int(3/4*CPU_NUMS)
     BUFSIZE = 4096
+    MAX_FRAME_SIZE = 64 * 1024 * 1024
     METADATA_VERSION = 1
 #     TIME = 5.0
     TIME = 10.0
     DELAYED = 15.0
+    SGW_WRR_SLOTS = 20
+    SELECT_TIMEOUT = 0.5
     try_times = 3
     
     FMT_COMMON_HEAD = '!I4BIIQQIIQQI4x'
     FMT_TASKINFO_FIXED = '!HHIIIHH4IQ33s512sH'
+    # 查询元数据时允许排序的列
+    METADATA_ORDER_KEYS = ('site_id', 'app_id', 'file_name', 'region_id',
+                           'system_id', 'group_id', 'user_id', 'customer_id',
+                           'timestamp')
     FMT_TASKINFO_SEND = '!2xHIIIHH4I8x33x512sH'
+    # MetadataServer之间查询结果的二进制编码：记录数、网关地址，
+    # 按行时每条记录为定长部分(id, site_id, app_id, timestamp, user_id, region_id,
+    # flags, file_name长度, customer_id长度) + file_name + customer_id
+    FMT_REMOTE_ROWS_HEAD = '!IIH2xI'
+    FMT_REMOTE_ROW = '!QIIIIHBxHH'
+    # 按列时各列依次排列，{0}为记录数
+    FMT_REMOTE_COLUMNS = '!{0}Q{0}I{0}I{0}I{0}I{0}H{0}B{0}H{0}H'
+    # REMOTE_QUERY_DATA请求头的minor为请求方希望的编码，回复头的minor为实际使用的编码，
+    # 老版本的MetadataServer忽略minor，回复JSON(minor为0)
+    REMOTE_ROWS_JSON = 0
+    REMOTE_ROWS_BINARY = 1
+    REMOTE_ROWS_COLUMNAR = 2
+    REMOTE_ROW_FORMATS = {'json': REMOTE_ROWS_JSON,
+                          'binary': REMOTE_ROWS_BINARY,
+                          'columnar': REMOTE_ROWS_COLUMNAR}
+    # Client心跳消息体、sgw心跳消息体
+    FMT_CLIENT_HB = '!IQQHHII'
+    FMT_SGW_HB = '!5IH2xII8Q'
     # client与metadata server通信 命令字
     CLIENT_UPLOAD_ROUTE = int(0x00000001)
     CLIENT_UPLOAD_ROUTE_RESP = int(0x00000002)
@@ -80,8 +183,10 @@ class Constant:
     # client与metadata server通信 响应码
     ACK_CLIENT_UPLOAD_ROUTE = 200
     ACK_CLIENT_UPLOAD_ROUTE_NOTFOUND = 404
+    ACK_CLIENT_UPLOAD_ROUTE_FAILED = 500
     ACK_CLIENT_QUERY_NUM = 200
     ACK_CLIENT_QUERY_DATA = 200
+    ACK_CLIENT_QUERY_DATA_PARTIAL = 206
     ACK_CLIENT_CONFIG_UPGRADE = 200
     ACK_CLIENT_UPGRADE = 200
     ACK_CLIENT_DEL_SUCCESS = 200
@@ -119,5 +224,4 @@ class Constant:
     ACK_REMOTE_DEL_SUCCESS = 200
     ACK_REMOTE_DEL_FAILED = 404
     
-print('当前连接的数据库信息为：{}'.format(Config.db_conn_str))
 
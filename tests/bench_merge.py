@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:对比多region查询结果的两种合并方式：全部拼接后整体排序再切片，与k路归并取到offset+count条即停止
+@:用法：python3 tests/bench_merge.py [--regions 5] [--rows 100000] [--repeat 3]
+@:每个region的结果与RemoteMetadataServer返回的一样，已按timestamp、id排好序
+"""
+import argparse
+import heapq
+import random
+import time
+from itertools import islice
+from operator import itemgetter
+
+
+KEY = itemgetter('timestamp', 'id')
+
+
+def make_regions(regions, rows):
+    result = []
+    for region_id in range(regions):
+        region_ret = [dict(id=i, site_id=1, app_id=i % 10, region_id=region_id,
+                           file_name='file_{}'.format(i), user_id=i % 100,
+                           customer_id='c{}'.format(i % 7),
+                           timestamp=1500000000 + random.randrange(10 ** 7))
+                      for i in range(rows)]
+        region_ret.sort(key=KEY)
+        result.append(region_ret)
+    return result
+
+
+def sort_all(region_rets, offset, count):
+    """
+    @:原来的方式：拼接所有region的结果后整体排序
+    """
+    rets = []
+    for region_ret in region_rets:
+        rets.extend(region_ret)
+    return sorted(rets, key=KEY)[offset: offset + count]
+
+
+def merge(region_rets, offset, count):
+    """
+    @:k路归并，取到offset+count条后停止
+    """
+    return list(islice(heapq.merge(*region_rets, key=KEY), offset,
+                       offset + count))
+
+
+def bench(func, region_rets, offset, count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rets = func(region_rets, offset, count)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多region查询结果合并的耗时对比')
+    parser.add_argument('--regions', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    region_rets = make_regions(args.regions, args.rows)
+    print('regions: {}, rows per region: {}'.format(args.regions, args.rows))
+    print('{:>8} {:>6} {:>10} {:>10} {:>8}'.format('offset', 'count', 'sort',
+                                                  'merge', 'speedup'))
+    total = args.regions * args.rows
+    for offset, count in [(0, 100), (1000, 100), (total // 2, 100),
+                          (total - 100, 100), (0, total)]:
+        sort_time, sort_rets = bench(sort_all, region_rets, offset, count,
+                                     args.repeat)
+        merge_time, merge_rets = bench(merge, region_rets, offset, count,
+                                       args.repeat)
+        assert sort_rets == merge_rets
+        print('{:>8} {:>6} {:>9.4f}s {:>9.4f}s {:>7.1f}x'.format(
+            offset, count, sort_time, merge_time, sort_time / merge_time))
+
+
+if __name__ == '__main__':
+    main()
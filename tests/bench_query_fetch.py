@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:对比查询一页metadata_info时ORM对象与只取列(元组)两种方式的耗时
+@:用法：python3 tests/bench_query_fetch.py [--db sqlite://] [--rows 10000] [--repeat 5]
+@:默认使用内存SQLite，也可以传入MySQL连接串对真实数据库测试(会创建并删除bench_metadata_info表)
+"""
+import argparse
+import json
+import struct
+import time
+
+from sqlalchemy import Column, Integer, SmallInteger, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from config import Constant
+
+
+Base = declarative_base()
+
+
+class BenchMetadataInfo(Base):
+    __tablename__ = 'bench_metadata_info'
+
+    id = Column(Integer, primary_key=True)
+    site_id = Column(Integer)
+    app_id = Column(Integer)
+    file_name = Column(String(512))
+    region_id = Column(SmallInteger)
+    system_id = Column(Integer)
+    group_id = Column(Integer)
+    user_id = Column(Integer)
+    customer_id = Column(String(32))
+    timestamp = Column(Integer)
+
+
+COLUMNS = (BenchMetadataInfo.id, BenchMetadataInfo.site_id,
+           BenchMetadataInfo.app_id, BenchMetadataInfo.file_name,
+           BenchMetadataInfo.region_id, BenchMetadataInfo.user_id,
+           BenchMetadataInfo.customer_id, BenchMetadataInfo.timestamp)
+TASKINFO_SEND = struct.Struct(Constant.FMT_TASKINFO_SEND)
+ADDR = (0xC0A80101, 8080, 1)
+
+
+def fill(session, rows):
+    session.bulk_insert_mappings(BenchMetadataInfo, [
+        dict(site_id=1, app_id=i % 10, file_name='file_{}'.format(i),
+             region_id=1, system_id=1, group_id=1, user_id=i % 100,
+             customer_id='c{}'.format(i % 7), timestamp=1500000000 + i)
+        for i in range(rows)])
+    session.commit()
+
+
+def fetch_orm(session, rows):
+    """
+    @:原来的方式：取回ORM对象，再逐个属性拷贝后打包
+    """
+    sgw_ip, sgw_port, sgw_id = ADDR
+    body_tmp = []
+    ret = (session.query(BenchMetadataInfo)
+           .order_by(BenchMetadataInfo.timestamp).limit(rows).all())
+    for metadata_info in ret:
+        metadata = {}
+        metadata['user_id'] = metadata_info.user_id
+        metadata['customer_id'] = metadata_info.customer_id
+        metadata_pack = json.dumps(metadata).encode('utf-8')
+        body_resp = [metadata_info.region_id, metadata_info.site_id,
+                     metadata_info.app_id, metadata_info.timestamp, sgw_port,
+                     sgw_port, sgw_ip, sgw_ip, sgw_id, sgw_id,
+                     metadata_info.file_name.encode('utf-8'),
+                     len(metadata_pack)]
+        body_pack = struct.pack(Constant.FMT_TASKINFO_SEND, *body_resp)
+        body_tmp.append(body_pack + metadata_pack)
+    return b''.join(body_tmp)
+
+
+def fetch_columns(session, rows):
+    """
+    @:只取需要的列，元组直接打包
+    """
+    sgw_ip, sgw_port, sgw_id = ADDR
+    pack = TASKINFO_SEND.pack
+    body_tmp = []
+    ret = (session.query(*COLUMNS)
+           .order_by(BenchMetadataInfo.timestamp).limit(rows))
+    for (_, site_id, app_id, file_name, region_id, user_id, customer_id,
+         timestamp) in ret:
+        metadata_pack = json.dumps({'user_id': user_id,
+                                    'customer_id': customer_id}
+                                   ).encode('utf-8')
+        body_tmp.append(pack(region_id, site_id, app_id, timestamp, sgw_port,
+                             sgw_port, sgw_ip, sgw_ip, sgw_id, sgw_id,
+                             file_name.encode('utf-8'), len(metadata_pack)))
+        body_tmp.append(metadata_pack)
+    return b''.join(body_tmp)
+
+
+def bench(session_factory, func, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        session = session_factory()
+        start = time.perf_counter()
+        body = func(session, rows)
+        elapsed = time.perf_counter() - start
+        session.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ORM与只取列查询的耗时对比')
+    parser.add_argument('--db', default='sqlite://')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    try:
+        fill(session_factory(), args.rows)
+        orm_time, orm_size = bench(session_factory, fetch_orm, args.rows,
+                                   args.repeat)
+        col_time, col_size = bench(session_factory, fetch_columns, args.rows,
+                                   args.repeat)
+        assert orm_size == col_size
+        print('rows: {}'.format(args.rows))
+        print('orm:     {:.4f}s'.format(orm_time))
+        print('columns: {:.4f}s ({:.1f}x)'.format(col_time,
+                                                  orm_time / col_time))
+    finally:
+        Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:测量MetadataServer的启动耗时：各模块在新解释器中的导入耗时，以及从启动进程到监听端口可以连接的耗时
+@:用法：python3 tests/bench_startup.py [--repeat 3] [--timeout 60] [--skip-schema-check]
+@:在仓库根目录运行，使用meta.ini中的[listening]地址；ConfigServer、数据库不可用时也能测到监听耗时
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from config import Config
+
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULES = ['config', 'app.models', 'app.configserver', 'app.client',
+           'app.tcpserver']
+
+
+def run_python(code):
+    env = dict(os.environ, PYTHONPATH=basedir)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=basedir, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   check=True)
+    return time.perf_counter() - start
+
+
+def bench_import(module, repeat):
+    """
+    @:新解释器导入module的耗时，减去解释器本身的启动耗时
+    """
+    baseline = min(run_python('pass') for _ in range(repeat))
+    return min(run_python('import {}'.format(module))
+               for _ in range(repeat)) - baseline
+
+
+def wait_listening(addr, proc, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(addr, 0.1).close()
+            return True
+        except socket.error:
+            time.sleep(0.01)
+    return False
+
+
+def bench_listening(args):
+    """
+    @:启动tcpserver，直到监听端口可以连接为止的耗时，超时或进程退出返回None
+    """
+    addr = (Config.listening_ip, int(Config.listening_port))
+    cmd = [sys.executable, '-m', 'app.tcpserver']
+    if args.skip_schema_check:
+        cmd.append('--skip-schema-check')
+    env = dict(os.environ, PYTHONPATH=basedir)
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=basedir, env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    try:
+        if wait_listening(addr, proc, args.timeout):
+            return time.perf_counter() - start
+        return None
+    finally:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MetadataServer启动耗时')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--skip-schema-check', action='store_true',
+                        help='启动时带上--skip-schema-check')
+    args = parser.parse_args()
+
+    print('{:<20} {:>10}'.format('import', 'time'))
+    for module in MODULES:
+        try:
+            elapsed = bench_import(module, args.repeat)
+        except subprocess.CalledProcessError:
+            print('{:<20} {:>10}'.format(module, 'failed'))
+        else:
+            print('{:<20} {:>9.3f}s'.format(module, elapsed))
+
+    print()
+    results = [bench_listening(args) for _ in range(args.repeat)]
+    for i, elapsed in enumerate(results):
+        if elapsed is None:
+            print('run {}: not listening after {}s'.format(i + 1, args.timeout))
+        else:
+            print('run {}: time to listening {:.3f}s'.format(i + 1, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:记录数量缓存CountCache：site的记录在其他工作进程中写入或删除后缓存的计数失效，其他site不受影响
+@:用法：python3 tests/test_countcache.py，或 python3 -m pytest tests/test_countcache.py
+@:在仓库根目录运行
+"""
+import os
+
+from app.countcache import CountCache, count_cache
+from app.writebehind import metadata_info_flushed
+
+
+def query(site_id, app_ids=(1, 2)):
+    return {'site_id': [site_id], 'app_id': list(app_ids), 'user_id': [1],
+            'customer_id': ['c'], 'timestamp': [0, 100]}
+
+
+def in_child(func, *args):
+    """
+    @:在fork出的子进程(相当于另一个工作进程)中执行func
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func(*args)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def cache_counts(cache, counts):
+    for site_id, count in counts.items():
+        cache.put(cache.key('query', query(site_id)),
+                  cache.generation(site_id), count)
+
+
+def cached(cache, site_id):
+    return cache.get(cache.key('query', query(site_id)), site_id)
+
+
+def test_insert_in_other_process_invalidates_site():
+    cache_counts(count_cache, {1: 10, 2: 20})
+    assert cached(count_cache, 1) == 10
+    # 其他工作进程的后写队列提交了site 1的记录
+    in_child(metadata_info_flushed, [{'site_id': 1}, {'site_id': 1}])
+    assert cached(count_cache, 1) is None
+    assert cached(count_cache, 2) == 20
+
+
+def test_delete_in_other_process_invalidates_site():
+    cache = CountCache(max_entries=10, ttl=60, slots=64)
+    cache_counts(cache, {1: 10, 2: 20, 3: 30})
+    in_child(cache.invalidate, [2, 3])
+    assert cached(cache, 1) == 10
+    assert cached(cache, 2) is None
+    assert cached(cache, 3) is None
+    # 重新计数后再次缓存
+    cache_counts(cache, {2: 19})
+    assert cached(cache, 2) == 19
+
+
+def test_write_during_count():
+    cache = CountCache(max_entries=10, ttl=60, slots=64)
+    key = cache.key('query', query(1))
+    generation = cache.generation(1)
+    # 计数期间发生了写入，这次的结果不能再被读到
+    in_child(cache.invalidate, [1])
+    cache.put(key, generation, 10)
+    assert cache.get(key, 1) is None
+
+
+def test_key_and_eviction():
+    cache = CountCache(max_entries=2, ttl=60, slots=64)
+    assert (cache.key('query', query(1, (2, 1, 2))) ==
+            cache.key('query', query(1, (1, 2))))
+    assert cache.key('query', query(1)) != cache.key('file_query', query(1))
+    cache_counts(cache, {1: 10, 2: 20})
+    assert cached(cache, 1) == 10
+    cache_counts(cache, {3: 30})
+    # site 2最久没有使用，被淘汰
+    assert cached(cache, 2) is None
+    assert cached(cache, 1) == 10
+    assert cached(cache, 3) == 30
+
+    expired = CountCache(max_entries=2, ttl=-1, slots=64)
+    cache_counts(expired, {1: 10})
+    assert cached(expired, 1) is None
+
+
+if __name__ == '__main__':
+    test_insert_in_other_process_invalidates_site()
+    test_delete_in_other_process_invalidates_site()
+    test_write_during_count()
+    test_key_and_eviction()
+    print('ok')
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:读写分离DbRouter：选择取出连接数最少的副本、跳过健康检查失败的副本、写入后recent_write秒内读主库
+@:用法：python3 tests/test_dbrouter.py，或 python3 -m pytest tests/test_dbrouter.py
+@:在仓库根目录运行；只读副本为临时目录中的sqlite数据库，不连接meta.ini中配置的数据库
+"""
+import os
+import tempfile
+import time
+
+from app.dbrouter import DbRouter
+
+
+def replica_url(directory, name):
+    return 'sqlite:///{}?check_same_thread=false'.format(
+        os.path.join(directory, name))
+
+
+def started(router, timeout=5):
+    """
+    @:等待第一次健康检查完成
+    """
+    router._ensure_started()
+    deadline = time.time() + timeout
+    while any(replica.healthy is None for replica in router._replicas):
+        assert time.time() < deadline, '健康检查没有完成'
+        time.sleep(0.01)
+    return router
+
+
+def test_least_loaded_replica():
+    with tempfile.TemporaryDirectory() as directory:
+        router = started(DbRouter([replica_url(directory, 'r0.db'),
+                                   replica_url(directory, 'r1.db')],
+                                  health_interval=60, recent_write=0))
+        replica0, replica1 = router._replicas
+        assert router.read_engine(1) in (replica0.engine, replica1.engine)
+        held = [replica0.engine.connect()]
+        try:
+            assert all(router.read_engine(1) is replica1.engine
+                       for _ in range(20))
+            held.extend([replica1.engine.connect(), replica1.engine.connect()])
+            assert all(router.read_engine(1) is replica0.engine
+                       for _ in range(20))
+        finally:
+            for connection in held:
+                connection.close()
+
+
+def test_skip_unhealthy_replica():
+    with tempfile.TemporaryDirectory() as directory:
+        missing = os.path.join(directory, 'missing')
+        router = started(DbRouter([replica_url(missing, 'r0.db'),
+                                   replica_url(directory, 'r1.db')],
+                                  health_interval=60, recent_write=0))
+        bad, good = router._replicas
+        assert bad.healthy is False and good.healthy is True
+        # 健康的副本连接数更多也不选择不可用的副本
+        held = good.engine.connect()
+        try:
+            assert all(router.read_engine(1) is good.engine
+                       for _ in range(20))
+        finally:
+            held.close()
+
+        router = started(DbRouter([replica_url(missing, 'r0.db')],
+                                  health_interval=60, recent_write=0))
+        assert router.read_engine(1) is None
+        # 没有配置副本时读主库
+        assert DbRouter([], recent_write=0).read_engine(1) is None
+
+
+def test_recent_write_reads_primary():
+    with tempfile.TemporaryDirectory() as directory:
+        router = started(DbRouter([replica_url(directory, 'r0.db')],
+                                  health_interval=60, recent_write=0.5,
+                                  slots=64))
+        replica = router._replicas[0]
+        assert router.read_engine(5) is replica.engine
+        # 其他工作进程写入了site 5
+        pid = os.fork()
+        if pid == 0:
+            try:
+                router.mark_write([5])
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert router.read_engine(5) is None
+        assert router.read_engine(6) is replica.engine
+        assert router.read_engine(None) is replica.engine
+        time.sleep(0.6)
+        assert router.read_engine(5) is replica.engine
+
+
+if __name__ == '__main__':
+    test_least_loaded_replica()
+    test_skip_unhealthy_replica()
+    test_recent_write_reads_primary()
+    print('ok')
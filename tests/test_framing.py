@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:FrameBuffer按消息头中的total_size拆分消息帧：逐字节到达、一次收到多帧、超大帧、不完整的消息头
+@:用法：python3 tests/test_framing.py，或 python3 -m pytest tests/test_framing.py
+@:在仓库根目录运行
+"""
+import socket
+
+from app.framing import FrameBuffer, FrameError
+from app.protocol import HEAD
+from config import Constant
+
+
+def frame(trans_id, body, total_size=None):
+    if total_size is None:
+        total_size = Constant.HEAD_LENGTH + len(body)
+    return HEAD.pack(total_size, Constant.MAJOR_VERSION,
+                     Constant.MINOR_VERSION, 1, 2, 0, 0, trans_id, 0, 0, 0, 0,
+                     0, 0) + body
+
+
+def test_feed_byte_by_byte():
+    data = frame(1, b'hello') + frame(2, b'') + frame(3, b'x' * 100)
+    frame_buffer = FrameBuffer(bufsize=16)
+    frames = []
+    for i in range(len(data)):
+        frame_buffer.feed(data[i: i + 1])
+        frames.extend(frame_buffer.frames())
+        if i < Constant.HEAD_LENGTH + 4:
+            assert frames == []
+    assert [(head.trans_id, body) for head, body in frames] == [
+        (1, b'hello'), (2, b''), (3, b'x' * 100)]
+    assert frame_buffer.next_frame() is None
+
+
+def test_several_frames_in_one_recv():
+    sender, receiver = socket.socketpair()
+    try:
+        bodies = [b'a' * 10, b'', b'b' * 5000, b'c']
+        # 最后一帧只发送一半，留在缓冲区中等待后续数据
+        data = b''.join(frame(i, body) for i, body in enumerate(bodies))
+        tail = frame(9, b'd' * 50)
+        sender.sendall(data + tail[:30])
+        frame_buffer = FrameBuffer()
+        frames = []
+        while len(frames) < len(bodies):
+            assert frame_buffer.recv_from(receiver)
+            frames.extend(frame_buffer.frames())
+        assert [body for _, body in frames] == bodies
+        assert frame_buffer.peek() is None
+        sender.sendall(tail[30:])
+        assert frame_buffer.recv_from(receiver)
+        head, body = frame_buffer.next_frame()
+        assert (head.trans_id, body) == (9, b'd' * 50)
+        sender.close()
+        assert not frame_buffer.recv_from(receiver)
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_peek_does_not_consume():
+    frame_buffer = FrameBuffer()
+    frame_buffer.feed(frame(5, b'body'))
+    assert frame_buffer.peek().trans_id == 5
+    assert frame_buffer.peek().trans_id == 5
+    head, body = frame_buffer.next_frame()
+    assert (head.trans_id, body) == (5, b'body')
+    assert frame_buffer.peek() is None
+
+
+def test_oversize_frame():
+    frame_buffer = FrameBuffer()
+    frame_buffer.feed(frame(1, b'', Constant.MAX_FRAME_SIZE + 1))
+    try:
+        frame_buffer.next_frame()
+    except FrameError:
+        pass
+    else:
+        assert False, 'total_size超过MAX_FRAME_SIZE时应抛出FrameError'
+
+
+def test_total_size_smaller_than_header():
+    frame_buffer = FrameBuffer()
+    frame_buffer.feed(frame(1, b'', Constant.HEAD_LENGTH - 1))
+    try:
+        frame_buffer.next_frame()
+    except FrameError:
+        pass
+    else:
+        assert False, 'total_size小于消息头长度时应抛出FrameError'
+
+
+def test_truncated_header():
+    frame_buffer = FrameBuffer()
+    frame_buffer.feed(frame(1, b'body')[:Constant.HEAD_LENGTH - 1])
+    assert frame_buffer.next_frame() is None
+    assert frame_buffer.state == FrameBuffer.HEAD_PENDING
+    frame_buffer.feed(frame(1, b'body')[Constant.HEAD_LENGTH - 1:])
+    head, body = frame_buffer.next_frame()
+    assert (head.trans_id, body) == (1, b'body')
+
+
+if __name__ == '__main__':
+    test_feed_byte_by_byte()
+    test_several_frames_in_one_recv()
+    test_peek_does_not_consume()
+    test_oversize_frame()
+    test_total_size_smaller_than_header()
+    test_truncated_header()
+    print('ok')
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:多region查询结果的归并：旧版本RemoteMetadataServer回复的JSON记录中没有id
+@:用法：python3 tests/test_merge_regions.py，或 python3 -m pytest tests/test_merge_regions.py
+@:在仓库根目录运行
+"""
+import json
+from itertools import islice
+
+from app.client import Client
+from app.protocol import Header
+from config import Constant
+
+
+def local_rows():
+    return [dict(id=i, site_id=1, app_id=1, file_name='local_{}'.format(i),
+                 region_id=1, user_id=1, customer_id='c', timestamp=ts)
+            for i, ts in enumerate([100, 200, 200, 400], 1)]
+
+
+def legacy_reply():
+    """
+    @:旧版本的JSON回复，记录按timestamp排序，没有id
+    """
+    rows = [dict(site_id=1, app_id=1, file_name='legacy_{}'.format(ts),
+                 region_id=2, user_id=1, customer_id='c', timestamp=ts,
+                 sgw_ip=1, sgw_port=2, sgw_id=3)
+            for ts in [150, 200, 300]]
+    body = json.dumps({'site_id': rows}).encode('utf-8')
+    head = Header(Constant.HEAD_LENGTH + len(body), Constant.MAJOR_VERSION,
+                  Constant.REMOTE_ROWS_JSON, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0)
+    return head, body
+
+
+def test_merge_legacy_json_region():
+    client = Client()
+    legacy = client._parse_remote_rows(*legacy_reply())
+    rets = list(client._merge_regions([local_rows(), legacy], ['timestamp'],
+                                      False))
+    assert [ret['timestamp'] for ret in rets] == [100, 150, 200, 200, 200,
+                                                  300, 400]
+    assert len(rets) == 7
+
+
+def test_merge_legacy_json_region_desc():
+    client = Client()
+    legacy = client._parse_remote_rows(*legacy_reply())
+    rets = list(islice(client._merge_regions(
+        [reversed(local_rows()), reversed(legacy)], ['timestamp'], True),
+        1, 4))
+    assert [ret['timestamp'] for ret in rets] == [300, 200, 200]
+
+
+def test_cursor_position_without_id():
+    client = Client()
+    legacy = client._parse_remote_rows(*legacy_reply())
+    merge_key = client._merge_key(['timestamp'])
+    assert merge_key(legacy[0]) == (150, 0)
+    assert merge_key(local_rows()[0]) == (100, 1)
+    assert client._merge_key(None)(legacy[0]) == (0,)
+
+
+if __name__ == '__main__':
+    test_merge_legacy_json_region()
+    test_merge_legacy_json_region_desc()
+    test_cursor_position_without_id()
+    print('ok')
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:游标分页：游标的生成与解析、翻到最后一页时next_cursor为null、排序值相同时按id定位、非法或被篡改的游标
+@:用法：python3 tests/test_query_cursor.py，或 python3 -m pytest tests/test_query_cursor.py
+@:在仓库根目录运行；SQL部分使用临时的sqlite内存数据库，不连接meta.ini中配置的数据库
+"""
+import base64
+import json
+from operator import itemgetter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.client import Client
+from app.models import metadata, metadata_info
+from app.protocol import Header
+from config import Config, Constant
+
+
+ORDER_BY = ['timestamp']
+QUERY = {'site_id': [1], 'app_id': [1], 'user_id': [1], 'customer_id': ['c'],
+         'timestamp': [0, 10 ** 9]}
+ROWS = [dict(id=row_id, site_id=1, app_id=1, file_name='f{}'.format(row_id),
+             region_id=Config.region_id, user_id=1, customer_id='c',
+             timestamp=1000 + row_id % 4)
+        for row_id in range(1, 31)]
+
+
+def sorted_rows(desc=False):
+    return sorted(ROWS, key=itemgetter('timestamp', 'id'), reverse=desc)
+
+
+class CursorClient(Client):
+    """
+    @:本地region的查询用ROWS代替数据库，按请求中的after定位，回复记录在pages中
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pages = []
+
+    def _get_local_query_data(self, head_unpack, body, sgw_table):
+        body_unpack = json.loads(body.decode('utf-8'))
+        desc = body_unpack.get('desc')
+        after = body_unpack.get('after')
+        rows = sorted_rows(desc)
+        if after:
+            after = tuple(after)
+            rows = [row for row in rows
+                    if ((row['timestamp'], row['id']) < after if desc else
+                        (row['timestamp'], row['id']) > after)]
+        return [dict(row) for row in rows[:head_unpack.count]]
+
+    def proxy_query_data(self, head_unpack, rets, conn, sel, sgw_table,
+                         next_cursor=None, stream=False):
+        self.pages.append((rets, next_cursor))
+
+    def query(self, cursor, count, desc=False):
+        body_unpack = dict(QUERY, order_by=ORDER_BY, desc=desc, cursor=cursor)
+        head_unpack = Header(Constant.HEAD_LENGTH, Constant.MAJOR_VERSION,
+                             Constant.MINOR_VERSION, 1, 2, 1, 0, 1, 1, 0, 0, 0,
+                             0, count)
+        self.handle_query_data_cursor(head_unpack, body_unpack, None, None,
+                                      None, None)
+        return self.pages[-1]
+
+    def page_through(self, count, desc=False):
+        pages = []
+        cursor = None
+        while True:
+            rets, cursor = self.query(cursor, count, desc)
+            pages.append(rets)
+            if cursor is None:
+                return pages
+
+
+def test_cursor_round_trip():
+    client = Client()
+    positions = {'1': [1003, 7], '2': [1001, 12]}
+    cursor = client._encode_cursor(ORDER_BY, False, positions)
+    assert isinstance(cursor, str)
+    assert client._decode_cursor(cursor, ORDER_BY, False) == positions
+    # 排序方式与生成游标时不一致，从第一页开始
+    assert client._decode_cursor(cursor, ORDER_BY, True) == {}
+    assert client._decode_cursor(cursor, ['app_id'], False) == {}
+    assert client._decode_cursor(None, ORDER_BY, False) == {}
+
+
+def test_page_to_end():
+    for count, desc in ((7, False), (10, False), (7, True)):
+        client = CursorClient()
+        pages = client.page_through(count, desc)
+        rows = [(ret['timestamp'], ret['id']) for page in pages for ret in page]
+        assert rows == [(row['timestamp'], row['id'])
+                        for row in sorted_rows(desc)]
+        assert all(len(page) == count for page in pages[:-1])
+        # 30条正好是10的整数倍时，最后一页为空
+        assert len(pages[-1]) == len(ROWS) % count
+        assert len(pages) == len(ROWS) // count + 1
+
+
+def test_invalid_cursor_starts_from_first_page():
+    client = Client()
+    key_count = len(client._order_keys(ORDER_BY))
+
+    def encode(value):
+        return base64.urlsafe_b64encode(
+            json.dumps(value).encode('utf-8')).decode()
+
+    valid = client._encode_cursor(ORDER_BY, False, {'1': [1002, 5]})
+    for cursor in ['not a cursor!', valid[:-4], valid[:-1] + 'x', 123,
+                   ['a'], encode([1, 2]), encode('text'),
+                   encode({'order_by': ORDER_BY, 'desc': False,
+                           'after': [1002, 5]}),
+                   encode({'order_by': ORDER_BY, 'desc': False,
+                           'after': {'1': [1002]}}),
+                   encode({'order_by': ORDER_BY, 'desc': False,
+                           'after': {'1': 'x' * key_count}})]:
+        assert client._decode_cursor(cursor, ORDER_BY, False) == {}, cursor
+
+    client = CursorClient()
+    rets, _ = client.query('not a cursor!', 5)
+    assert [ret['id'] for ret in rets] == [
+        row['id'] for row in sorted_rows()[:5]]
+
+
+def test_seek_tie_break_on_id():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    engine.execute(metadata_info.insert(), ROWS)
+    client = Client()
+    session = Session(bind=engine)
+    try:
+        criterion = client._query_filter(QUERY)
+        for desc in (False, True):
+            expected = [row['id'] for row in sorted_rows(desc)]
+            # 从timestamp相同的一组记录中间开始，只有id更大(desc时更小)的记录在后面
+            after_row = sorted_rows(desc)[9]
+            body_unpack = {'order_by': ORDER_BY, 'desc': desc,
+                           'after': [after_row['timestamp'], after_row['id']]}
+            rows = client._query_page(session, criterion, body_unpack, 100, 8)
+            assert [row[0] for row in rows] == expected[10:18]
+            assert rows[0][-1] == after_row['timestamp']
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    test_cursor_round_trip()
+    test_page_to_end()
+    test_invalid_cursor_starts_from_first_page()
+    test_seek_tie_break_on_id()
+    print('ok')
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:MetadataServer之间查询结果的编码：二进制按行、按列编码的打包与解析，
+@:以及请求头minor的协商(对端回复minor=0时按JSON解析，老版本的请求方收到JSON)
+@:用法：python3 tests/test_remote_rows.py，或 python3 -m pytest tests/test_remote_rows.py
+@:在仓库根目录运行；查询使用临时的sqlite内存数据库，不连接meta.ini中配置的数据库
+"""
+import json
+import socket
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.client import Client
+from app.framing import FrameBuffer
+from app.models import metadata, metadata_info
+from app.protocol import Header, pack_remote_rows, unpack_remote_rows
+from app.routing import SgwRoutingTable
+from config import Constant
+
+
+ADDR = (0x0a000001, 8001, 7)
+ROWS = [(1, 1, 2, '报表_2017.xlsx', 3, 10, '客户甲', 1500000000),
+        (2, 1, 2, 'plain.txt', 3, None, None, 1500000001),
+        (3, 1, 2, '', 3, 0, '', 1500000002),
+        (4, 1, 2, 'ファイル' * 40, 3, 2 ** 32 - 1, 'ß' * 10, 2 ** 32 - 1)]
+QUERY = {'site_id': [1], 'app_id': [2], 'user_id': [10, 0, 2 ** 32 - 1],
+         'customer_id': ['客户甲', '', 'ß' * 10], 'timestamp': [0, 2 ** 32 - 1],
+         'order_by': ['timestamp'], 'desc': False}
+
+
+def join(buffers):
+    return b''.join(bytes(buf) for buf in buffers)
+
+
+def test_round_trip():
+    for columnar in (False, True):
+        body = join(pack_remote_rows(ROWS, ADDR, columnar))
+        assert unpack_remote_rows(body, columnar) == (ROWS, ADDR)
+        body = join(pack_remote_rows([], ADDR, columnar))
+        assert unpack_remote_rows(body, columnar) == ([], ADDR)
+
+
+class RemoteClient(Client):
+    """
+    @:handle_remote_query_data读临时的sqlite数据库
+    """
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+
+    @contextmanager
+    def _read_session(self, body_unpack):
+        session = Session(bind=self.engine)
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+def remote_query(client, sgw_table, minor):
+    """
+    @:以minor发送远端查询请求，返回回复的(head_unpack, body)
+    """
+    body = json.dumps(QUERY).encode('utf-8')
+    head_unpack = Header(Constant.HEAD_LENGTH + len(body),
+                         Constant.MAJOR_VERSION, minor, 1, 2, 0x10, 0, 5, 1,
+                         Constant.REMOTE_QUERY_DATA, 0, 0, 0, 100)
+    server, peer = socket.socketpair()
+    try:
+        client.handle_remote_query_data(head_unpack, body, server, None,
+                                        sgw_table)
+        frame_buffer = FrameBuffer()
+        while True:
+            assert frame_buffer.recv_from(peer)
+            frame = frame_buffer.next_frame()
+            if frame is not None:
+                return frame
+    finally:
+        server.close()
+        peer.close()
+
+
+def test_minor_negotiation():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    engine.execute(metadata_info.insert(), [
+        dict(id=row_id, site_id=site_id, app_id=app_id, file_name=file_name,
+             region_id=region_id, user_id=user_id, customer_id=customer_id,
+             timestamp=timestamp)
+        for (row_id, site_id, app_id, file_name, region_id, user_id,
+             customer_id, timestamp) in ROWS])
+    sgw_table = SgwRoutingTable(max_sgw=2)
+    sgw_table.upsert(ADDR[2], 1, ADDR[0], ADDR[1], 100)
+    client = RemoteClient(engine)
+    expected = None
+    # 0为老版本的请求方，不认识的编码也回复JSON
+    for minor, reply_minor in ((Constant.REMOTE_ROWS_JSON,
+                                Constant.REMOTE_ROWS_JSON),
+                               (Constant.REMOTE_ROWS_BINARY,
+                                Constant.REMOTE_ROWS_BINARY),
+                               (Constant.REMOTE_ROWS_COLUMNAR,
+                                Constant.REMOTE_ROWS_COLUMNAR),
+                               (9, Constant.REMOTE_ROWS_JSON)):
+        head_unpack, body = remote_query(client, sgw_table, minor)
+        assert head_unpack.minor == reply_minor
+        rets = client._parse_remote_rows(head_unpack, body)
+        # NULL的user_id、customer_id不在查询条件中，查不到
+        assert [ret['file_name'] for ret in rets] == [
+            row[3] for row in ROWS if row[5] is not None]
+        if expected is None:
+            expected = rets
+        assert rets == expected
+
+
+if __name__ == '__main__':
+    test_round_trip()
+    test_minor_negotiation()
+    print('ok')
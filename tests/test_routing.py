@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+"""
+@:共享内存路由表SgwRoutingTable：注册、更新、掉线删除，version使候选网关缓存失效，各选择策略的分布
+@:用法：python3 tests/test_routing.py，或 python3 -m pytest tests/test_routing.py
+@:在仓库根目录运行
+"""
+import os
+import random
+import time
+from collections import Counter
+from itertools import groupby
+
+import app.routing
+from app.routing import SgwRoutingTable
+
+
+class FakeTime:
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def select_counts(table, policy, times):
+    return Counter(table.select(policy)[0][2] for _ in range(times))
+
+
+def test_upsert_update_expire():
+    table = SgwRoutingTable(max_sgw=4)
+    clock = app.routing.time = FakeTime(1000)
+    try:
+        assert table.upsert(1, 1, 11, 8001, 100)
+        assert table.upsert(2, 1, 12, 8002, 200)
+        assert not table.upsert(1, 1, 11, 8001, 150, cpu_percent=10)
+        assert len(table) == 2
+        record = [r for r in table.snapshot() if r.sgw_id == 1][0]
+        assert (record.disk_free, record.cpu_percent, record.last_seen) == (
+            150, 10, 1000)
+
+        clock.now = 1020
+        table.upsert(2, 1, 12, 8002, 200)
+        assert table.expire(10) == [1]
+        assert [r.sgw_id for r in table.snapshot()] == [2]
+        # 掉线后重新注册是新网关，使用空出来的位置
+        assert table.upsert(1, 1, 11, 8001, 100)
+        assert sorted(r.sgw_id for r in table.snapshot()) == [1, 2]
+        for sgw_id in (3, 4):
+            table.upsert(sgw_id, 1, 10 + sgw_id, 8000 + sgw_id, 100)
+        try:
+            table.upsert(5, 1, 15, 8005, 100)
+        except OverflowError:
+            pass
+        else:
+            assert False, '路由表已满时应抛出OverflowError'
+    finally:
+        app.routing.time = time
+
+
+def test_shared_between_processes():
+    table = SgwRoutingTable(max_sgw=4)
+    assert len(table) == 0
+    pid = os.fork()
+    if pid == 0:
+        try:
+            table.upsert(7, 1, 17, 8007, 700)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert [r.sgw_id for r in table.snapshot()] == [7]
+    assert table.version() == 1
+
+
+def test_version_invalidates_candidates():
+    table = SgwRoutingTable(max_sgw=4)
+    table.upsert(1, 1, 11, 8001, 100)
+    table.upsert(2, 1, 12, 8002, 200)
+    version = table.version()
+    candidates = table._prepare()
+    assert [record.sgw_id for _, record in candidates] == [2, 1]
+
+    # 心跳只刷新last_seen：snapshot重新读取，version和候选网关缓存不变
+    snapshot = table.snapshot()
+    table.upsert(1, 1, 11, 8001, 100)
+    assert table.snapshot() is not snapshot
+    assert table.version() == version
+    assert table._prepare() is candidates
+
+    # 容量变化影响选择：version加1，候选网关重新排序
+    table.upsert(1, 1, 11, 8001, 300)
+    assert table.version() == version + 1
+    assert [record.sgw_id for _, record in table._prepare()] == [1, 2]
+
+    table.expire(-1)
+    assert table.version() == version + 2
+    assert table._prepare() == []
+
+
+def test_select_p2c():
+    random.seed(1)
+    table = SgwRoutingTable(max_sgw=4)
+    for sgw_id, disk_free in ((1, 300), (2, 200), (3, 100)):
+        table.upsert(sgw_id, 1, 10 + sgw_id, 8000 + sgw_id, disk_free)
+    times = 9000
+    counts = select_counts(table, 'p2c', times)
+    # 两次随机取到的网关中选权重大的：5/9, 3/9, 1/9
+    for sgw_id, expected in ((1, 5 / 9), (2, 3 / 9), (3, 1 / 9)):
+        assert abs(counts[sgw_id] / times - expected) < 0.03, counts
+
+
+def test_select_wrr():
+    table = SgwRoutingTable(max_sgw=4)
+    for sgw_id, disk_free in ((1, 400), (2, 200), (3, 100)):
+        table.upsert(sgw_id, 1, 10 + sgw_id, 8000 + sgw_id, disk_free)
+    schedule = table._wrr_schedule(table._prepare())
+    counts = select_counts(table, 'wrr', len(schedule) * 10)
+    assert counts == {1: 200, 2: 100, 3: 50}
+    # 平滑加权轮询：权重最大的网关不会连续被选中太多次
+    window = [table.select('wrr')[0][2] for _ in range(len(schedule))]
+    assert Counter(window) == {1: 20, 2: 10, 3: 5}
+    assert max(len(list(run)) for sgw_id, run in groupby(window)
+               if sgw_id == 1) <= 2
+
+
+def test_select_max_free():
+    table = SgwRoutingTable(max_sgw=4)
+    table.upsert(1, 1, 11, 8001, 500)
+    table.upsert(2, 2, 12, 8002, 900)
+    table.upsert(3, 2, 13, 8003, 100)
+    table.upsert(4, 1, 14, 8004, 600)
+    # 可用容量最大的网关在group 2，组内的网关轮流选择
+    counts = select_counts(table, 'max_free', 100)
+    assert counts == {2: 50, 3: 50}
+    addr, _, _, group_id = table.select('max_free')
+    assert group_id == 2 and addr[:2] in ((12, 8002), (13, 8003))
+
+
+if __name__ == '__main__':
+    test_upsert_update_expire()
+    test_shared_between_processes()
+    test_version_invalidates_candidates()
+    test_select_p2c()
+    test_select_wrr()
+    test_select_max_free()
+    print('ok')